@@ -0,0 +1,82 @@
+"""
+Module for testing forks borrowing objects through their alternates
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from backend.packs import read_stored_object, is_stored_object, add_alternate, read_alternates, write_pack
+from providers import MaintenanceProvider
+from utils import store_object, create_repository
+
+
+class AlternatesTest(unittest.TestCase):
+    """Test reading the objects a repository borrows from other object stores."""
+
+    def setUp(self) -> None:
+        self.storage_path = tempfile.mkdtemp()
+        self.original_path = create_repository(self.storage_path, "original")
+        self.fork_path = create_repository(self.storage_path, "fork")
+        add_alternate(self.fork_path, self.original_path)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.storage_path)
+
+    def test_read_alternates(self):
+        """Should list the borrowed store, stored relative to the fork"""
+        self.assertListEqual(read_alternates(self.fork_path), [os.path.normpath(self.original_path)])
+        with open(os.path.join(self.fork_path, "info", "alternates"), "r") as f:
+            self.assertFalse(os.path.isabs(f.read().strip()))
+
+    def test_read_borrowed_object(self):
+        """Should read loose and packed objects of the original through the fork"""
+        loose = store_object(self.original_path, "blob", b"loose data")
+        packed_data = zlib.compress(b"packed data")
+        packed = "ab" * 20
+        write_pack(self.original_path, [(packed, packed_data)])
+
+        self.assertEqual(zlib.decompress(read_stored_object(self.fork_path, loose)), b"loose data")
+        self.assertEqual(bytes(read_stored_object(self.fork_path, packed)), packed_data)
+        self.assertTrue(is_stored_object(self.fork_path, loose))
+
+    def test_without_alternates(self):
+        """Should not read borrowed objects when alternates are disabled"""
+        loose = store_object(self.original_path, "blob", b"loose data")
+
+        self.assertIsNone(read_stored_object(self.fork_path, loose, alternates=False))
+        self.assertFalse(is_stored_object(self.fork_path, loose, alternates=False))
+
+    def test_original_does_not_borrow(self):
+        """Should not read the objects of a fork from the original"""
+        own = store_object(self.fork_path, "blob", b"fork data")
+
+        self.assertIsNotNone(read_stored_object(self.fork_path, own))
+        self.assertIsNone(read_stored_object(self.original_path, own))
+
+    def test_fork_of_forks(self):
+        """Should read the objects of the original from any depth of forks, through a single hop"""
+        sha1 = store_object(self.original_path, "blob", b"deep data")
+        previous = self.fork_path
+        for i in range(8):
+            current = create_repository(self.storage_path, f"fork{i}")
+            add_alternate(current, previous)
+            previous = current
+            self.assertIn(os.path.normpath(self.original_path), read_alternates(current))
+            self.assertIsNotNone(read_stored_object(current, sha1))
+
+        dependents = MaintenanceProvider(self.storage_path).find_dependent_repositories("original")
+        self.assertListEqual(dependents, ["fork"] + [f"fork{i}" for i in range(8)])
+
+    def test_alternates_not_chained(self):
+        """Should not follow the alternates of an alternate"""
+        sha1 = store_object(self.original_path, "blob", b"original data")
+        other_path = create_repository(self.storage_path, "other")
+        # Written by hand, add_alternate would have listed the original as well
+        os.makedirs(os.path.join(other_path, "info"))
+        with open(os.path.join(other_path, "info", "alternates"), "w") as f:
+            f.write(os.path.relpath(self.fork_path, other_path) + "\n")
+
+        self.assertIsNone(read_stored_object(other_path, sha1))
+        self.assertIsNotNone(read_stored_object(self.fork_path, sha1))
@@ -0,0 +1,92 @@
+"""
+Module for testing how pushed objects are verified and stored
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from backend.packs import write_pack, freshen_stored_object
+from providers.FileSystemProvider import verify_object, PackIngester
+from utils import store_object, create_repository
+
+
+class IngestionTest(unittest.TestCase):
+    """Test verifying the hashes of pushed objects, and writing them to the objects database."""
+
+    def setUp(self) -> None:
+        self.storage_path = tempfile.mkdtemp()
+        self.objects_path = create_repository(self.storage_path, "repo")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.storage_path)
+
+    def test_verify_object(self):
+        """Should accept data that hashes to the sha, and reject anything else"""
+        data = b"verified data"
+        sha1 = hashlib.sha1(f"blob{len(data)}".encode() + b"\x00" + data).hexdigest()
+
+        self.assertTrue(verify_object(sha1, zlib.compress(data)))
+        self.assertFalse(verify_object(sha1, zlib.compress(b"other data")))
+        self.assertFalse(verify_object(sha1, b"not compressed"))
+
+    def test_ingester_rejects_mismatch(self):
+        """Should raise on an object that does not match its sha, and never write it"""
+        sha1 = hashlib.sha1(b"blob4\x00real").hexdigest()
+        ingester = PackIngester(self.objects_path)
+        ingester.add(sha1, zlib.compress(b"fake"))
+
+        self.assertRaises(ValueError, ingester.close)
+        self.assertFalse(os.path.exists(os.path.join(self.objects_path, sha1[:2], sha1[2:])))
+
+    def test_ingester_writes_objects(self):
+        """Should write the objects whose data matches their sha"""
+        data = b"pushed data"
+        sha1 = hashlib.sha1(f"blob{len(data)}".encode() + b"\x00" + data).hexdigest()
+        ingester = PackIngester(self.objects_path)
+        ingester.add(sha1, zlib.compress(data))
+        ingester.close()
+
+        with open(os.path.join(self.objects_path, sha1[:2], sha1[2:]), "rb") as f:
+            self.assertEqual(zlib.decompress(f.read()), data)
+
+    def test_ingester_freshens_stored_objects(self):
+        """Should refresh the modification time of objects that are skipped as already stored"""
+        sha1 = store_object(self.objects_path, "blob", b"stored data")
+        path = os.path.join(self.objects_path, sha1[:2], sha1[2:])
+        os.utime(path, (time.time() - 3600, time.time() - 3600))
+
+        ingester = PackIngester(self.objects_path)
+        ingester.add(sha1, zlib.compress(b"stored data"))
+        ingester.close()
+        self.assertGreater(os.stat(path).st_mtime, time.time() - 60)
+
+    def test_ingester_rewrites_pruned_object(self):
+        """Should write an object again if it was pruned after the ingestion started"""
+        data = b"pruned while pushing"
+        sha1 = store_object(self.objects_path, "blob", data)
+        ingester = PackIngester(self.objects_path)
+        ingester.add(sha1, zlib.compress(data))
+        ingester.flush()
+
+        # The maintenance job prunes the object, and the rest of the pack repeats it
+        os.remove(os.path.join(self.objects_path, sha1[:2], sha1[2:]))
+        ingester.add(sha1, zlib.compress(data))
+        ingester.close()
+        with open(os.path.join(self.objects_path, sha1[:2], sha1[2:]), "rb") as f:
+            self.assertEqual(zlib.decompress(f.read()), data)
+
+    def test_freshen_packed_object(self):
+        """Should refresh the pack holding an object that is skipped as already stored"""
+        data = b"packed data"
+        sha1 = hashlib.sha1(f"blob{len(data)}".encode() + b"\x00" + data).hexdigest()
+        name = write_pack(self.objects_path, [(sha1, zlib.compress(data))])
+        pack_path = os.path.join(self.objects_path, "pack", f"{name}.pack")
+        os.utime(pack_path, (time.time() - 3600, time.time() - 3600))
+
+        self.assertTrue(freshen_stored_object(self.objects_path, sha1))
+        self.assertGreater(os.stat(pack_path).st_mtime, time.time() - 60)
+        self.assertFalse(freshen_stored_object(self.objects_path, "0" * 40))
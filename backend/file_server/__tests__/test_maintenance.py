@@ -0,0 +1,130 @@
+"""
+Module for testing the repacking and pruning of the repositories
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from filelock import FileLock
+
+from backend.packs import add_alternate, load_packs, read_stored_object
+from providers import FileSystemProvider, MaintenanceProvider
+from utils import store_object, store_commit, create_repository
+
+# Old enough to be pruned with the default grace period
+OLD = time.time() - 24 * 60 * 60
+
+
+def make_old(objects_path: str, sha1: str):
+    """Sets the modification time of a loose object to before the grace period"""
+    os.utime(os.path.join(objects_path, sha1[:2], sha1[2:]), (OLD, OLD))
+
+
+def list_loose_objects(objects_path: str) -> set[str]:
+    return {folder + name for folder in os.listdir(objects_path) if len(folder) == 2
+            for name in os.listdir(os.path.join(objects_path, folder))}
+
+
+class MaintenanceTest(unittest.TestCase):
+    """Test what repacking keeps, packs and removes."""
+
+    def setUp(self) -> None:
+        self.storage_path = tempfile.mkdtemp()
+        self.objects_path = create_repository(self.storage_path, "repo")
+        self.file_system = FileSystemProvider(self.storage_path, "repo", cache=None)
+        self.maintenance = MaintenanceProvider(self.storage_path)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.storage_path)
+
+    def assertStored(self, objects_path: str, sha1: str):
+        self.assertIsNotNone(read_stored_object(objects_path, sha1), f"{sha1} is missing")
+
+    def assertNotStored(self, objects_path: str, sha1: str):
+        self.assertIsNone(read_stored_object(objects_path, sha1), f"{sha1} was not pruned")
+
+    def test_reachable_across_branches_and_forks(self):
+        """Should keep the history of every branch, and of the forks borrowing objects, and prune the rest"""
+        main = store_commit(self.objects_path, "", b"main")
+        dev = store_commit(self.objects_path, main, b"dev")
+        forked = store_commit(self.objects_path, main, b"only reachable from the fork")
+        garbage = store_object(self.objects_path, "blob", b"garbage")
+        for sha1 in list_loose_objects(self.objects_path):
+            make_old(self.objects_path, sha1)
+        self.file_system.update_head_commit("main", main)
+        self.file_system.update_head_commit("dev", dev)
+
+        fork_path = create_repository(self.storage_path, "fork")
+        add_alternate(fork_path, self.objects_path)
+        FileSystemProvider(self.storage_path, "fork", cache=None).update_head_commit("main", forked)
+
+        result = self.maintenance.repack("repo")
+        self.assertEqual(result.pruned, 1)
+        self.assertSetEqual(list_loose_objects(self.objects_path), set())
+        for sha1 in (main, dev, forked):
+            self.assertStored(self.objects_path, sha1)
+            self.assertStored(fork_path, sha1)
+        self.assertEqual(self.file_system.extract_commit_data(dev)[2], main)
+        self.assertNotStored(self.objects_path, garbage)
+
+    def test_loose_grace_period(self):
+        """Should keep unreachable loose objects younger than the grace period"""
+        self.file_system.update_head_commit("main", store_commit(self.objects_path, "", b"main"))
+        young = store_object(self.objects_path, "blob", b"pushed, the branch did not move yet")
+        old = store_object(self.objects_path, "blob", b"abandoned")
+        make_old(self.objects_path, old)
+
+        self.maintenance.repack("repo")
+        self.assertSetEqual(list_loose_objects(self.objects_path), {young})
+        self.assertNotStored(self.objects_path, old)
+
+    def test_pack_grace_period(self):
+        """Should keep a young pack that holds unreachable objects, and remove it once it is old"""
+        first = store_commit(self.objects_path, "", b"first")
+        self.file_system.update_head_commit("main", first)
+        self.maintenance.repack("repo")
+
+        # The branch moves away from the packed commit, without keeping it in its history
+        second = store_commit(self.objects_path, "", b"second")
+        self.file_system.update_head_commit("main", second)
+        self.assertEqual(self.maintenance.repack("repo").removed_packs, 0)
+        self.assertEqual(len(load_packs(self.objects_path, refresh=True)), 2)
+        self.assertStored(self.objects_path, first)
+
+        self.assertEqual(MaintenanceProvider(self.storage_path, prune_grace_period=0).repack("repo").removed_packs, 1)
+        self.assertEqual(len(load_packs(self.objects_path, refresh=True)), 1)
+        self.assertNotStored(self.objects_path, first)
+        self.assertStored(self.objects_path, second)
+
+    def test_replaced_packs_removed(self):
+        """Should replace the previous packs with a single pack holding every reachable object"""
+        first = store_commit(self.objects_path, "", b"first")
+        self.file_system.update_head_commit("main", first)
+        self.maintenance.repack("repo")
+        second = store_commit(self.objects_path, first, b"second")
+        self.file_system.update_head_commit("main", second)
+
+        result = self.maintenance.repack("repo")
+        self.assertEqual(result.removed_packs, 1)
+        self.assertEqual(result.packed, 6)
+        packs = load_packs(self.objects_path, refresh=True)
+        self.assertEqual(len(packs), 1)
+        self.assertEqual(len(packs[0]), 6)
+        self.assertSetEqual(list_loose_objects(self.objects_path), set())
+
+    def test_lock_respected(self):
+        """Should skip a repository that is already being repacked, without touching it"""
+        self.file_system.update_head_commit("main", store_commit(self.objects_path, "", b"main"))
+        garbage = store_object(self.objects_path, "blob", b"garbage")
+        make_old(self.objects_path, garbage)
+        loose = list_loose_objects(self.objects_path)
+
+        with FileLock(os.path.join(self.storage_path, "repo", "gc.lock")):
+            self.assertIsNone(self.maintenance.repack("repo"))
+        self.assertSetEqual(list_loose_objects(self.objects_path), loose)
+        self.assertEqual(load_packs(self.objects_path, refresh=True), [])
+
+        self.assertIsNotNone(self.maintenance.repack("repo"))
+        self.assertNotStored(self.objects_path, garbage)
@@ -0,0 +1,50 @@
+"""
+Module for testing the cache of the stored objects
+"""
+import unittest
+
+from ObjectCache import ObjectCache, MAX_CACHED_OBJECT_FRACTION
+
+
+class ObjectCacheTest(unittest.TestCase):
+    """Test the LRU eviction and the size bound of the object cache."""
+
+    def setUp(self) -> None:
+        self.cache = ObjectCache(max_bytes=100)
+
+    def test_evicts_least_recently_used(self):
+        """Should evict the least recently used objects once the cache is full"""
+        for i in range(10):
+            self.cache.put("repo", str(i), bytes(10))
+        # Reading 0 makes 1 the least recently used object
+        self.assertIsNotNone(self.cache.get("repo", "0"))
+        self.cache.put("repo", "new", bytes(10))
+
+        self.assertIsNone(self.cache.get("repo", "1"))
+        self.assertIsNotNone(self.cache.get("repo", "0"))
+        self.assertIsNotNone(self.cache.get("repo", "new"))
+
+    def test_size_bound(self):
+        """Should never hold more bytes than its size, nor objects bigger than its fraction"""
+        for i in range(20):
+            self.cache.put("repo", str(i), bytes(10))
+            self.assertLessEqual(self.cache.stats()["bytes"], 100)
+
+        self.cache.put("repo", "big", bytes(100 // MAX_CACHED_OBJECT_FRACTION + 1))
+        self.assertIsNone(self.cache.get("repo", "big"))
+
+    def test_keyed_by_repository(self):
+        """Should not share objects between repositories"""
+        self.cache.put("repo", "a", b"data")
+        self.assertIsNone(self.cache.get("other", "a"))
+
+    def test_get_or_load(self):
+        """Should load an object once, and count hits and misses"""
+        loads = []
+        loader = lambda: loads.append(1) or b"loaded"
+
+        self.assertEqual(self.cache.get_or_load("repo", "a", loader), b"loaded")
+        self.assertEqual(self.cache.get_or_load("repo", "a", loader), b"loaded")
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
@@ -0,0 +1,86 @@
+"""
+Module for testing the parsing of pushed packfiles
+"""
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from providers.FileSystemProvider import PackfileParser, PackIngester, PACK_ENTRY_LENGTH_DIGITS
+
+# providers exports the FileSystemProvider class under the name of its module
+file_system_module = sys.modules["providers.FileSystemProvider"]
+from utils import create_repository
+
+
+def create_entry(sha1: str, compressed_data: bytes) -> bytes:
+    """Returns a packfile entry, as the client sends it"""
+    return f"{sha1} {str(len(compressed_data)).zfill(PACK_ENTRY_LENGTH_DIGITS)}".encode() + compressed_data + b"\n"
+
+
+def blob_sha(data: bytes) -> str:
+    return hashlib.sha1(f"blob{len(data)}".encode() + b"\x00" + data).hexdigest()
+
+
+class PackfileTest(unittest.TestCase):
+    """Test receiving packfiles in chunks, including objects larger than the memory bound."""
+
+    def setUp(self) -> None:
+        self.storage_path = tempfile.mkdtemp()
+        self.objects_path = create_repository(self.storage_path, "repo")
+        # Objects over 1KiB are received into temporary files
+        patcher = mock.patch.object(file_system_module, "LARGE_OBJECT_SIZE", 1024)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.storage_path)
+
+    def push(self, pack: bytes, chunk_size=300):
+        """Feeds a compressed packfile to a parser in chunks"""
+        parser = PackfileParser(PackIngester(self.objects_path))
+        compressed = zlib.compress(pack)
+        for start in range(0, len(compressed), chunk_size):
+            parser.feed(compressed[start:start + chunk_size])
+        parser.close()
+
+    def read_loose_object(self, sha1: str) -> bytes:
+        with open(os.path.join(self.objects_path, sha1[:2], sha1[2:]), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def temporary_files(self) -> list[str]:
+        return [name for name in os.listdir(self.objects_path) if name.startswith("tmp_")]
+
+    def test_small_and_large_objects(self):
+        """Should store objects below and above the large object size the same way"""
+        small = b"small object"
+        large = os.urandom(64 * 1024)
+        self.push(create_entry(blob_sha(small), zlib.compress(small))
+                  + create_entry(blob_sha(large), zlib.compress(large))
+                  + create_entry(blob_sha(small + b"!"), zlib.compress(small + b"!")))
+
+        self.assertEqual(self.read_loose_object(blob_sha(small)), small)
+        self.assertEqual(self.read_loose_object(blob_sha(large)), large)
+        self.assertEqual(self.read_loose_object(blob_sha(small + b"!")), small + b"!")
+        self.assertListEqual(self.temporary_files(), [])
+
+    def test_large_object_mismatch(self):
+        """Should reject a large object that does not match its sha, and remove its temporary file"""
+        large = os.urandom(64 * 1024)
+        sha1 = blob_sha(b"something else")
+
+        self.assertRaises(ValueError, self.push, create_entry(sha1, zlib.compress(large)))
+        self.assertFalse(os.path.exists(os.path.join(self.objects_path, sha1[:2], sha1[2:])))
+        self.assertListEqual(self.temporary_files(), [])
+
+    def test_truncated_large_object(self):
+        """Should reject a packfile that ends inside a large object, and remove its temporary file"""
+        large = os.urandom(64 * 1024)
+        entry = create_entry(blob_sha(large), zlib.compress(large))
+
+        self.assertRaises(ValueError, self.push, entry[:len(entry) // 2])
+        self.assertListEqual(self.temporary_files(), [])
@@ -0,0 +1,77 @@
+"""
+Module for testing how pushes move the branches of a repository
+"""
+import shutil
+import tempfile
+import unittest
+
+from CommandHandler import CommandHandler
+from globals import create_pkt_line, ResponseCode
+from providers import FileSystemProvider
+from utils import store_commit, create_repository
+
+
+class PushingUser:
+    branch = "main"
+
+
+class UpdateHeadTest(unittest.TestCase):
+    """Test the compare and swap of the branch heads."""
+
+    def setUp(self) -> None:
+        self.storage_path = tempfile.mkdtemp()
+        self.objects_path = create_repository(self.storage_path, "repo")
+        self.file_system = FileSystemProvider(self.storage_path, "repo", cache=None)
+        self.commands = CommandHandler(self.file_system, PushingUser())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.storage_path)
+
+    def update_head(self, payload: str) -> list[bytes]:
+        return list(self.commands.handle(ResponseCode.UPDATE_HEAD.value, payload.encode()))
+
+    def test_update_head_commit_mismatch(self):
+        """Should not move a branch that no longer points to the expected head"""
+        first = store_commit(self.objects_path, "", b"first")
+        second = store_commit(self.objects_path, first, b"second")
+        self.assertTrue(self.file_system.update_head_commit("main", first))
+
+        self.assertFalse(self.file_system.update_head_commit("main", second, old_head=""))
+        self.assertEqual(self.file_system.get_head_commit("main"), first)
+        self.assertTrue(self.file_system.update_head_commit("main", second, old_head=first))
+        self.assertEqual(self.file_system.get_head_commit("main"), second)
+
+    def test_push_on_moved_branch(self):
+        """Should refuse a push computed against an older head of the branch"""
+        first = store_commit(self.objects_path, "", b"first")
+        second = store_commit(self.objects_path, first, b"second")
+        other = store_commit(self.objects_path, first, b"other")
+        self.file_system.update_head_commit("main", second)
+
+        response = self.update_head(f"{first} {other}")
+        self.assertTrue(response[0].startswith(create_pkt_line(ResponseCode.ERROR, "")))
+        self.assertEqual(self.file_system.get_head_commit("main"), second)
+
+    def test_push_not_following_head(self):
+        """Should refuse a push whose history does not contain the head it claims to follow"""
+        first = store_commit(self.objects_path, "", b"first")
+        unrelated = store_commit(self.objects_path, "", b"unrelated")
+        self.file_system.update_head_commit("main", first)
+
+        response = self.update_head(f"{first} {unrelated}")
+        self.assertTrue(response[0].startswith(create_pkt_line(ResponseCode.ERROR, "")))
+        self.assertEqual(self.file_system.get_head_commit("main"), first)
+
+    def test_push_fast_forward(self):
+        """Should move the branch to a commit that follows its head"""
+        first = store_commit(self.objects_path, "", b"first")
+        second = store_commit(self.objects_path, first, b"second")
+        self.file_system.update_head_commit("main", first)
+
+        self.update_head(f"{first} {second}")
+        self.assertEqual(self.file_system.get_head_commit("main"), second)
+
+    def test_malformed_update_head(self):
+        """Should answer a payload without both heads with an error"""
+        self.assertEqual(self.update_head("deadbeef"),
+                         [create_pkt_line(ResponseCode.ERROR, "stash: Invalid head update")])
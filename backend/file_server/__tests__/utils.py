@@ -0,0 +1,27 @@
+import hashlib
+import os
+import zlib
+
+
+def store_object(objects_path: str, type_: str, data: bytes) -> str:
+    """Stores a loose object the way the server does, returns its hash"""
+    sha1 = hashlib.sha1(f"{type_}{len(data)}".encode() + b"\x00" + data).hexdigest()
+    os.makedirs(os.path.join(objects_path, sha1[:2]), exist_ok=True)
+    with open(os.path.join(objects_path, sha1[:2], sha1[2:]), "wb") as f:
+        f.write(zlib.compress(data))
+    return sha1
+
+
+def store_commit(objects_path: str, parent: str, content: bytes, message="commit") -> str:
+    """Stores a commit whose tree holds a single file with the given content, returns the commit hash"""
+    blob = store_object(objects_path, "blob", content)
+    tree = store_object(objects_path, "tree", f"blob {blob} file.txt\n".encode())
+    return store_object(objects_path, "commit", f"parent {parent}\ntree {tree}\n\n{message}".encode())
+
+
+def create_repository(storage_path: str, repo_id: str) -> str:
+    """Creates an empty repository in the storage, returns its objects path"""
+    os.makedirs(os.path.join(storage_path, repo_id, "refs", "head"))
+    objects_path = os.path.join(storage_path, repo_id, "objects")
+    os.makedirs(objects_path)
+    return objects_path
@@ -0,0 +1,152 @@
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import Session
+
+from CommandHandler import CommandHandler
+from providers import AuthenticationProvider, EncryptionProvider, FileSystemProvider, SessionProvider
+from providers.EncryptionProvider import FRAME_HEADER, MAX_FRAME_SIZE
+from globals import parse_pkt, MAX_PACKET_DATA_SIZE
+
+# Seconds that running connections get to finish once the server is asked to shut down
+SHUTDOWN_GRACE_PERIOD = 30
+
+
+class AsyncClient:
+    """
+    Serves a single client as a coroutine.
+    Waiting on the network costs no thread, the crypto, disk and database work runs on the shared executor.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, engine, repos_loc: str,
+                 executor: ThreadPoolExecutor):
+        self.reader = reader
+        self.writer = writer
+        self.engine = engine
+        self.repos_abs_path = repos_loc
+        self.executor = executor
+
+        self.sessions = SessionProvider()
+        self.enc = EncryptionProvider(None, self.sessions)
+
+    async def offload(self, function, *args):
+        """Runs blocking work on the executor"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def read_packet(self) -> bytearray:
+        """Reads and decrypts the next frame"""
+        encrypted_data_length = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))[0]
+        if encrypted_data_length > MAX_FRAME_SIZE:
+            raise ValueError("stash: Incoming packet has an invalid size.")
+        return await self.offload(self.enc.decrypt_frame, await self.reader.readexactly(encrypted_data_length))
+
+    def encrypt_pkt_lines(self, pkt_lines) -> list:
+        """Produces and encrypts the next pkt lines of a response, about a packet worth of them. [] once it is over"""
+        frames = []
+        size = 0
+        for pkt_line in pkt_lines:
+            frames.append(self.enc.encrypt_packet(pkt_line))
+            size += len(frames[-1])
+            if size >= MAX_PACKET_DATA_SIZE:
+                break
+        return frames
+
+    async def send_pkt_lines(self, pkt_lines):
+        """
+        Encrypts and sends the pkt lines of a response as they are produced, waiting for the client only when its
+        buffer is full. Responses produced by generators read the disk on the executor, never on the event loop.
+        """
+        pkt_lines = iter(pkt_lines)
+        while frames := await self.offload(self.encrypt_pkt_lines, pkt_lines):
+            self.writer.writelines(frames)
+            await self.writer.drain()
+
+    async def authenticate(self):
+        """Runs the handshake and the login, returns (repo id, AuthenticatedUser) or None"""
+        while True:
+            hello = await self.reader.read(1024)
+            if not hello:
+                return None
+            reply, is_done, session = await self.offload(self.enc.handshake_step, hello.decode())
+            self.writer.write(reply)
+            await self.writer.drain()
+            if is_done:
+                break
+
+        login_command, data = parse_pkt(await self.read_packet())
+
+        # Every connection gets its own database session, used only while it logs in
+        with Session(self.engine) as db_session:
+            auth = AuthenticationProvider(None, db_session, self.enc, self.sessions, self.repos_abs_path)
+            response, authenticated = await self.offload(auth.login, login_command, data, session)
+        await self.send_pkt_lines([response])
+        return authenticated
+
+    async def run(self):
+        """Client coroutine main loop"""
+        try:
+            authenticated = await self.authenticate()
+            if authenticated is None:
+                return
+
+            repo_id, user = authenticated
+            commands = CommandHandler(FileSystemProvider(self.repos_abs_path, repo_id), user)
+            while True:
+                command_name, data = parse_pkt(await self.read_packet())
+                await self.send_pkt_lines(await self.offload(commands.handle, command_name, data))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            # The client closed the connection, or sent a corrupted packet
+            pass
+        except Exception as e:
+            # A failing command only ends its own connection, never the event loop serving the others
+            print(f"stash: Connection failed: {e}")
+        finally:
+            self.writer.close()
+
+
+class AsyncServer:
+    """File server where every connection is a coroutine, and blocking work is bounded by the executor size"""
+
+    def __init__(self, host: str, port: int, engine, repos_loc: str, max_workers: int = 32):
+        self.host = host
+        self.port = port
+        self.engine = engine
+        self.repos_abs_path = repos_loc
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.clients = set()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        try:
+            await AsyncClient(reader, writer, self.engine, self.repos_abs_path, self.executor).run()
+        finally:
+            self.clients.discard(task)
+
+    async def serve(self, sock=None):
+        """
+        Serves clients until SIGTERM or SIGINT. listens on sock if it is given, or on host and port.
+        On shutdown, new connections are refused and running ones get SHUTDOWN_GRACE_PERIOD seconds to finish
+        """
+        if sock is not None:
+            server = await asyncio.start_server(self.handle_connection, sock=sock)
+        else:
+            server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, server.close)
+
+        try:
+            # close() stops serve_forever by cancelling it
+            await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+        if len(self.clients) > 0:
+            await asyncio.wait(self.clients, timeout=SHUTDOWN_GRACE_PERIOD)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def listen(self, sock=None):
+        asyncio.run(self.serve(sock))
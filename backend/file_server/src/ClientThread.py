@@ -1,11 +1,8 @@
-import hashlib
-import zlib
+import select
 
-from pyDH import pyDH
-
-from backend.models import PullRequest
-from providers import AuthenticationProvider, EncryptionProvider, FileSystemProvider
-from globals import parse_pkt, create_pkt_line, ResponseCode
+from CommandHandler import CommandHandler
+from providers import AuthenticationProvider, EncryptionProvider, FileSystemProvider, SessionProvider
+from globals import parse_pkt
 
 
 ###
@@ -16,6 +13,9 @@ from globals import parse_pkt, create_pkt_line, ResponseCode
 
 ###
 
+# Responses buffered while pipelined requests are pending are flushed once they reach this size
+MAX_PENDING_OUTPUT = 4 * 1024 * 1024
+
 
 class ClientThread:
     def __init__(self, conn, db_session, repos_loc: str):
@@ -25,68 +25,50 @@ class ClientThread:
 
         self.conn = conn
         self.db_session = db_session
-        self.df = pyDH.DiffieHellman()
-        self.enc = EncryptionProvider(self.conn)
-        self.auth = AuthenticationProvider(self.conn, self.db_session, self.enc, repos_loc)
+        self.sessions = SessionProvider()
+        self.enc = EncryptionProvider(self.conn, self.sessions)
+        self.auth = AuthenticationProvider(self.conn, self.db_session, self.enc, self.sessions, repos_loc)
         self.repo_id = None
         self.file_system: FileSystemProvider
-        self.buffer = []
+        self.commands: CommandHandler
+        self.pending_output = []
+        self.pending_output_size = 0
+
+    def __has_pending_input(self):
+        """Returns True or False whether the client already sent more data"""
+        readable, _, _ = select.select([self.conn], [], [], 0)
+        return len(readable) > 0
+
+    def __flush(self):
+        """Sends the buffered responses at once"""
+        if len(self.pending_output) > 0:
+            self.conn.sendall(b"".join(self.pending_output))
+            self.pending_output.clear()
+            self.pending_output_size = 0
 
     def __handle_client(self):
         """Handle client command communications"""
         command_name, data = parse_pkt(self.enc.decrypt_incoming_packet())
+        for pkt_line in self.commands.handle(command_name, data):
+            frame = self.enc.encrypt_packet(pkt_line)
+            self.pending_output.append(frame)
+            self.pending_output_size += len(frame)
 
-        if command_name == ResponseCode.RECEIVE_OBJECT.value:
-            data = data.decode()
-            data = self.file_system.get_server_object(data[:2], data[2:])
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.SEND_OBJECT, data)))
-            return
-
-        if command_name == ResponseCode.RECEIVE_HEAD_COMMIT.value:
-            data = data.decode()
-            data = self.file_system.get_head_commit(data)
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.SEND_OBJECT, data)))
-            return
-
-        if command_name == ResponseCode.UPDATE_HEAD.value:
-            head_cmt = data.decode()
-
-            self.file_system.update_head_commit(self.user.branch, head_cmt)
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.OK,
-                                                                   f"stash: Remote branch updated."
-                                                                   f" '{self.user.branch}' is up to date")))
-            return
-
-        if command_name == ResponseCode.SEND_STREAM.value:
-            # Add to the buffer
-            self.buffer.append(data)
-            return
-
-        if command_name == ResponseCode.SEND_PACKFILE.value:
-            if len(self.buffer) > 0:
-                data = zlib.decompress(b"".join(self.buffer))
-                self.buffer.clear()
-            try:
-                self.file_system.execute_packfile(data)
-            except Exception as e:
-                print(e)
-                self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: Uploading failed")))
-            finally:
-                self.conn.send(
-                    self.enc.encrypt_packet(create_pkt_line(ResponseCode.OK, "stash: Uploading was successful")))
-            return
-
-        self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: Unknown command")))
+        # Pipelined requests are answered back to back, and their responses are flushed together
+        # once no request is waiting
+        if self.pending_output_size >= MAX_PENDING_OUTPUT or not self.__has_pending_input():
+            self.__flush()
 
     def run(self):
         """Client thread main loop"""
-        # Exchange cryptography keys, and establish a secured session
-        self.enc.exchange_keys()
+        # Exchange cryptography keys, and establish a secured session, or resume a previous one
+        session = self.enc.exchange_keys()
 
         # Authenticate user
-        self.repo_id, self.user = self.auth.authenticate_user()
+        self.repo_id, self.user = self.auth.authenticate_user(session)
 
         self.file_system = FileSystemProvider(self.repos_abs_path, self.repo_id)
+        self.commands = CommandHandler(self.file_system, self.user)
 
         while True:
             self.__handle_client()
@@ -0,0 +1,131 @@
+from globals import create_pkt_line, ResponseCode, MAX_PACKET_DATA_SIZE
+from providers import FileSystemProvider
+from providers.FileSystemProvider import is_valid_sha
+
+
+def stream_pkt_lines(code: ResponseCode, data: bytes) -> list[bytes]:
+    """Returns the pkt lines of a response that may be bigger than a packet: stream packets followed by the code"""
+    index = 0
+    pkt_lines = []
+    while len(data) - index > MAX_PACKET_DATA_SIZE:
+        pkt_lines.append(create_pkt_line(ResponseCode.SEND_STREAM, data[index:index + MAX_PACKET_DATA_SIZE]))
+        index += MAX_PACKET_DATA_SIZE
+    pkt_lines.append(create_pkt_line(code, data[index:]))
+    return pkt_lines
+
+
+def stream_pkt_chunks(code: ResponseCode, chunks):
+    """Yields the pkt lines of a response produced in chunks: stream packets as data arrives, followed by the code"""
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) > MAX_PACKET_DATA_SIZE:
+            yield create_pkt_line(ResponseCode.SEND_STREAM, bytes(pending[:MAX_PACKET_DATA_SIZE]))
+            del pending[:MAX_PACKET_DATA_SIZE]
+    yield create_pkt_line(code, bytes(pending))
+
+
+class CommandHandler:
+    """
+    Handles the commands of an authenticated client, without any network I/O.
+    Both the threaded and the asyncio servers feed it decrypted packets, and send back the pkt lines it returns.
+    Large responses are returned as generators, so their pkt lines are produced while they are sent.
+    """
+
+    def __init__(self, file_system: FileSystemProvider, user):
+        self.file_system = file_system
+        self.user = user
+        self.packfile = None
+        self.packfile_error = None
+        self.upload_failed = False
+
+    def handle(self, command_name: str, data: bytes):
+        """Handles a single command, and returns an iterable of the pkt lines of its response"""
+        if command_name == ResponseCode.RECEIVE_PACKFILE.value:
+            # branch\n followed by the commits the client already has, one per line
+            branch, *haves = data.decode().split("\n")
+            head_cmt = self.file_system.get_head_commit(branch)
+            if not head_cmt:
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Remote branch has no commits")]
+            try:
+                prep_file = self.file_system.generate_history_prep_file(head_cmt, set(haves))
+            except ValueError:
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Invalid object hash")]
+            return stream_pkt_chunks(ResponseCode.SEND_PACKFILE, self.file_system.generate_pack_file(prep_file))
+
+        if command_name == ResponseCode.FILTER_OBJECTS.value:
+            try:
+                missing = self.file_system.filter_missing_objects(data.decode().split("\n"))
+            except ValueError:
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Invalid object hash")]
+            return stream_pkt_lines(ResponseCode.SEND_OBJECT, "\n".join(missing).encode())
+
+        if command_name == ResponseCode.RECEIVE_OBJECT.value:
+            data = data.decode()
+            if not is_valid_sha(data):
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Invalid object hash")]
+            data = self.file_system.get_server_object(data[:2], data[2:])
+            if data is None:
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Requested object was not found")]
+            return [create_pkt_line(ResponseCode.SEND_OBJECT, data)]
+
+        if command_name == ResponseCode.RECEIVE_HEAD_COMMIT.value:
+            data = data.decode()
+            data = self.file_system.get_head_commit(data)
+            return [create_pkt_line(ResponseCode.SEND_OBJECT, data)]
+
+        if command_name == ResponseCode.UPDATE_HEAD.value:
+            # old head new head, the branch is only updated if it still points to the old head
+            fields = data.decode().split(" ")
+            if len(fields) != 2:
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Invalid head update")]
+            old_head, head_cmt = fields
+            if not is_valid_sha(head_cmt) or (old_head != "" and not is_valid_sha(old_head)):
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Invalid object hash")]
+
+            # A branch never moves to objects that were rejected, or were never received
+            if self.upload_failed:
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Uploading failed, the remote branch was not"
+                                                            " updated.")]
+            if not self.file_system.has_commit(head_cmt):
+                return [create_pkt_line(ResponseCode.ERROR, f"stash: Remote is missing commit {head_cmt}, the remote"
+                                                            f" branch was not updated.")]
+            # The pushed history must build on the head it was computed against, or the branch would lose commits
+            if not self.file_system.is_ancestor(old_head, head_cmt):
+                return [create_pkt_line(ResponseCode.ERROR, f"stash: Commit {head_cmt} does not follow the remote"
+                                                            f" branch '{self.user.branch}'. pull, and push again.")]
+            if not self.file_system.update_head_commit(self.user.branch, head_cmt, old_head):
+                return [create_pkt_line(ResponseCode.ERROR, f"stash: Remote branch '{self.user.branch}' was updated"
+                                                            f" by another push. pull, and push again.")]
+            return [create_pkt_line(ResponseCode.OK, f"stash: Remote branch updated."
+                                                     f" '{self.user.branch}' is up to date")]
+
+        if command_name == ResponseCode.SEND_STREAM.value:
+            # Objects are written as soon as they arrive, so only the current object is held in memory
+            if self.packfile is None:
+                self.packfile = self.file_system.open_packfile()
+            if self.packfile_error is None:
+                try:
+                    self.packfile.feed(data)
+                except Exception as e:
+                    self.packfile_error = e
+            return []
+
+        if command_name == ResponseCode.SEND_PACKFILE.value:
+            packfile, error = self.packfile, self.packfile_error
+            self.packfile, self.packfile_error = None, None
+            try:
+                if error is not None:
+                    raise error
+                if packfile is not None:
+                    packfile.close()
+                else:
+                    self.file_system.execute_packfile(data)
+            except Exception as e:
+                print(e)
+                self.upload_failed = True
+                return [create_pkt_line(ResponseCode.ERROR, "stash: Uploading failed")]
+            self.upload_failed = False
+            return [create_pkt_line(ResponseCode.OK, "stash: Uploading was successful")]
+
+        return [create_pkt_line(ResponseCode.ERROR, "stash: Unknown command")]
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+# Stored objects are immutable and addressed by their hash, so cached entries never need to be invalidated
+OBJECT_CACHE_SIZE = 64 * 1024 * 1024
+# Objects bigger than this part of the cache are not cached, so a single large blob does not evict everything
+MAX_CACHED_OBJECT_FRACTION = 8
+
+
+class ObjectCache:
+    """
+    Process-wide, byte-bounded LRU cache of the stored object data, keyed by (repo id, sha1).
+    Shared by all the client threads, hits and misses are counted.
+    """
+
+    def __init__(self, max_bytes: int = OBJECT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, repo_id: str, sha1: str) -> bytes | None:
+        """Returns the cached data of an object, or None if it is not cached"""
+        key = (repo_id, sha1)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, repo_id: str, sha1: str, data: bytes):
+        """Caches the data of an object, evicting the least recently used objects until it fits"""
+        if len(data) > self.max_bytes // MAX_CACHED_OBJECT_FRACTION:
+            return
+        key = (repo_id, sha1)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_load(self, repo_id: str, sha1: str, loader) -> bytes | None:
+        """Returns the data of an object, loading and caching it on a miss. loader returns None for missing objects"""
+        data = self.get(repo_id, sha1)
+        if data is None:
+            # Loading happens outside the lock, two threads may load the same object but the result is identical
+            data = loader()
+            if data is not None:
+                self.put(repo_id, sha1, data)
+        return data
+
+    def stats(self) -> dict:
+        """Returns the counters of the cache"""
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "objects": len(self.entries), "bytes": self.size}
+
+
+object_cache = ObjectCache()
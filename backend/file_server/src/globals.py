@@ -13,6 +13,11 @@ class ResponseCode(Enum):
     UPDATE_HEAD = "stash-update-head"
     SEND_STREAM = "stash-send-stream"
     RECEIVE_PACKFILE = "stash-receive-packfile"
+    FILTER_OBJECTS = "stash-filter-objects"
+
+
+# Largest data sent in a single packet, bigger responses are split to stream packets
+MAX_PACKET_DATA_SIZE = 4 * 1024 * 1024
 
 
 def parse_pkt(data: bytes) -> (str, bytes):
@@ -0,0 +1,29 @@
+import argparse
+
+from providers.MaintenanceProvider import MaintenanceProvider, PRUNE_GRACE_PERIOD
+from backend.file_server.src.server import REPOSITORY_SAVING_ABS_PTH
+
+# Repacks the repositories of the file server, the same job the server runs with --maintenance-interval
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stash repository maintenance")
+    parser.add_argument("repositories", nargs="*",
+                        help="ids of the repositories to repack, all the repositories if none are given")
+    parser.add_argument("--storage", default=REPOSITORY_SAVING_ABS_PTH,
+                        help="the directory where the repositories are stored")
+    parser.add_argument("--prune-grace-period", type=int, default=PRUNE_GRACE_PERIOD,
+                        help="seconds an unreachable loose object is kept before it is pruned")
+    args = parser.parse_args()
+
+    maintenance = MaintenanceProvider(args.storage, args.prune_grace_period)
+    if len(args.repositories) > 0:
+        results = {repo_id: maintenance.repack(repo_id) for repo_id in args.repositories}
+    else:
+        results = maintenance.repack_all()
+
+    for repo_id, result in results.items():
+        if result is None:
+            print(f"{repo_id}: skipped, the repository is busy")
+        else:
+            print(f"{repo_id}: packed {result.packed} objects, pruned {result.pruned},"
+                  f" removed {result.removed_packs} old packs")
@@ -5,7 +5,8 @@ import sys
 import bcrypt
 from sqlalchemy.orm import Session
 
-from backend.file_server.src.providers.EncryptionProvider import EncryptionProvider
+from providers.EncryptionProvider import EncryptionProvider
+from providers.SessionProvider import SessionProvider, SessionTicket
 from globals import parse_pkt, create_pkt_line, ResponseCode
 from backend.models import User, Repository
 
@@ -23,64 +24,73 @@ class AuthenticatedUser:
 
 
 class AuthenticationProvider:
-    def __init__(self, conn, db_session: Session, enc: EncryptionProvider, repos_location: str):
+    def __init__(self, conn, db_session: Session, enc: EncryptionProvider, sessions: SessionProvider,
+                 repos_location: str):
         self.conn = conn
         self.db_session = db_session
         self.enc = enc
+        self.sessions = sessions
         self.repos_abs_path = repos_location
 
-    def authenticate_user(self):
-        """Authenticate user, uses recv"""
+    def authenticate_user(self, session: SessionTicket = None):
+        """
+        Authenticate user, uses recv.
+        A resumed session already proved the user's password, so its login carries no password.
+        """
         login_command, data = parse_pkt(self.enc.decrypt_incoming_packet())
-        if login_command != "stash-login":
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: Unauthenticated")))
+        response, authenticated = self.login(login_command, data, session)
+        self.conn.sendall(self.enc.encrypt_packet(response))
+        if authenticated is None:
             self.conn.close()
             sys.exit(1)
+        return authenticated
+
+    def login(self, login_command: str, data: bytes, session: SessionTicket = None):
+        """
+        Checks a login packet, without any network I/O.
+        Returns the response pkt line, and (repo id, AuthenticatedUser) or None if the login failed.
+        """
+        if login_command != "stash-login":
+            return create_pkt_line(ResponseCode.ERROR, "stash: Unauthenticated"), None
         d = data.decode().split("@")
 
         if len(d) != 4:
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: Invalid Login "
-                                                                                       "credentials")))
-            self.conn.close()
-            sys.exit(1)
+            return create_pkt_line(ResponseCode.ERROR, "stash: Invalid Login credentials"), None
 
         username, repo_name, branch, password = d
 
         db_user = self.db_session.query(User).where(User.username == username).one_or_none()
 
         if db_user is None:
-            self.conn.send(self.enc.encrypt_packet(
-                create_pkt_line(ResponseCode.ERROR, "stash: Login credentials are invalid")))
-            self.conn.close()
-            sys.exit(1)
+            return create_pkt_line(ResponseCode.ERROR, "stash: Login credentials are invalid"), None
 
-        if not bcrypt.checkpw(password.encode(), db_user.password):
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: Login "
-                                                                                       "credentials are "
-                                                                                       "invalid")))
-            self.conn.close()
-            sys.exit(1)
+        if session is not None:
+            is_valid_login = session.user_id == db_user.id and session.username == username
+        else:
+            is_valid_login = bcrypt.checkpw(password.encode(), db_user.password)
+
+        if not is_valid_login:
+            return create_pkt_line(ResponseCode.ERROR, "stash: Login credentials are invalid"), None
 
         repo = self.db_session.query(Repository).where(
             Repository.name == repo_name.removesuffix(".stash"), Repository.user_id == db_user.id).one_or_none()
 
         if repo is None:
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: No related repository "
-                                                                                       "was found")))
-            self.conn.close()
-            sys.exit(1)
+            return create_pkt_line(ResponseCode.ERROR, "stash: No related repository was found"), None
 
-        if is_directory_traversal(os.path.join(self.repos_abs_path, repo.id), os.path.join(self.repos_abs_path, repo.id, "refs", "head", branch)):
-            self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.ERROR, "stash: Invalid branch.")))
-            self.conn.close()
-            sys.exit(1)
+        if is_directory_traversal(os.path.join(self.repos_abs_path, repo.id),
+                                  os.path.join(self.repos_abs_path, repo.id, "refs", "head", branch)):
+            return create_pkt_line(ResponseCode.ERROR, "stash: Invalid branch."), None
 
         if not os.path.exists(os.path.join(self.repos_abs_path, repo.id, "refs", "head", branch)):
             with open(os.path.join(self.repos_abs_path, repo.id, "refs", "head", branch), "w") as f:
                 f.write("")
 
-        self.conn.send(self.enc.encrypt_packet(create_pkt_line(ResponseCode.AUTHORIZED, "stash: login successful")))
+        # The ticket resumes this session later. a resumed session keeps the expiry of its original login
+        ticket, expiry = self.sessions.issue_ticket(self.enc.key, db_user.id, username,
+                                                    session.expiry if session is not None else None)
+        response = create_pkt_line(ResponseCode.AUTHORIZED, f"stash: login successful\n{ticket} {expiry}")
 
         own_this_repo = repo.user.id == db_user.id
 
-        return repo.id, AuthenticatedUser(is_owner=own_this_repo, id=db_user.id, branch=branch)
+        return response, (repo.id, AuthenticatedUser(is_owner=own_this_repo, id=db_user.id, branch=branch))
@@ -1,39 +1,137 @@
+import os
+import struct
 import sys
 
 from pyDH import pyDH
 from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
+
+# Frames are prefixed with their length, as a big-endian u32, and followed by the AES-GCM tag:
+#   length | ciphertext | tag
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+TAG_SIZE = 16
+
+# Nonces are the sending direction followed by a frame counter, so a nonce is never reused with the same key,
+# and dropped, replayed or reordered frames fail to authenticate
+NONCE = struct.Struct(">IQ")
+CLIENT_DIRECTION = 1
+SERVER_DIRECTION = 2
 
 
 class EncryptionProvider:
-    def __init__(self, socket):
+    def __init__(self, socket, sessions):
         self.socket = socket
+        self.sessions = sessions
         self.df = None
-        self.aes = None
+        self.key = None
+        self.send_counter = 0
+        self.receive_counter = 0
+        self.buffer = bytearray(64 * 1024)
 
     def exchange_keys(self):
-        """Exchange keys between parties, and create a shared key"""
+        """
+        Exchange keys between parties, and create a shared key.
+        The client may first try to resume a session with a ticket, which skips the key exchange.
+        Returns the SessionTicket of a resumed session, or None.
+        """
+        while True:
+            hello = self.socket.recv(1024)
+            if hello == b'':
+                self.socket.close()
+                print("Client closed.")
+                sys.exit(1)
+            reply, is_done, session = self.handshake_step(hello.decode())
+            self.socket.send(reply)
+            if is_done:
+                return session
+
+    def handshake_step(self, hello: str) -> (bytes, bool, object):
+        """
+        Handles a handshake message of the client, without any I/O.
+        Returns the reply, whether the handshake is done, and the SessionTicket of a resumed session or None.
+        """
+        if hello.startswith("resume "):
+            # resume <ticket> <client nonce>
+            _, ticket, client_nonce = hello.split(" ")
+            session = self.sessions.open_ticket(ticket)
+            if session is None:
+                # The ticket was rejected, the client continues with a full key exchange
+                return "fail".encode(), False, None
+
+            server_nonce = os.urandom(16)
+            self.generate_aes(
+                self.sessions.derive_resumed_key(session.key, bytes.fromhex(client_nonce), server_nonce).hex())
+            return f"ok {server_nonce.hex()}".encode(), True, session
+
         self.df = pyDH.DiffieHellman()
-        client_pub = int(self.socket.recv(1024).decode())
-        self.socket.send(str(self.df.gen_public_key()).encode())
+        client_pub = int(hello)
+        public_key = str(self.df.gen_public_key()).encode()
         shared = self.df.gen_shared_key(client_pub)
         self.generate_aes(shared)
+        return public_key, True, None
 
     def generate_aes(self, shared: str):
         """Creates aes symmetric key"""
-        self.aes = AES.new(bytes.fromhex(shared), AES.MODE_ECB)
+        self.key = bytes.fromhex(shared)
+        self.send_counter = 0
+        self.receive_counter = 0
+
+    def _next_cipher(self, sending: bool):
+        """Creates the AES-GCM cipher of the next frame in a direction"""
+        if sending:
+            nonce = NONCE.pack(SERVER_DIRECTION, self.send_counter)
+            self.send_counter += 1
+        else:
+            nonce = NONCE.pack(CLIENT_DIRECTION, self.receive_counter)
+            self.receive_counter += 1
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
 
-    def decrypt_incoming_packet(self) -> bytes:
+    def recv_exact(self, size: int) -> memoryview:
+        """Receives exactly size bytes into the reusable receive buffer, and returns a view of them"""
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view = memoryview(self.buffer)[:size]
+        received = 0
+        while received < size:
+            count = self.socket.recv_into(view[received:], size - received)
+            if count == 0:
+                self.socket.close()
+                print("Client closed.")
+                sys.exit(1)
+            received += count
+        return view
+
+    def decrypt_incoming_packet(self) -> bytearray:
         """Decrypts incoming packets, uses recv"""
-        encrypted_data_length = self.socket.recv(4)
-        if encrypted_data_length == b'':
+        encrypted_data_length = FRAME_HEADER.unpack(self.recv_exact(FRAME_HEADER.size))[0]
+        if encrypted_data_length > MAX_FRAME_SIZE:
+            raise ValueError("stash: Incoming packet has an invalid size.")
+
+        try:
+            return self.decrypt_frame(self.recv_exact(encrypted_data_length))
+        except ValueError:
             self.socket.close()
-            print("Client closed.")
+            print("Client sent a corrupted packet.")
             sys.exit(1)
-        encrypted_data = self.socket.recv(int(encrypted_data_length))
-        return unpad(self.aes.decrypt(encrypted_data), 32)
 
-    def encrypt_packet(self, data: bytes) -> bytes:
-        """Encrypts the packet, and prefixes with the length"""
-        encrypted_data = self.aes.encrypt(pad(data, 32))
-        return f"{str(len(encrypted_data)).zfill(4)}".encode() + encrypted_data
+    def decrypt_frame(self, frame) -> bytearray:
+        """Decrypts and verifies the body of a frame (ciphertext | tag). raises ValueError if it was tampered with"""
+        if len(frame) < TAG_SIZE:
+            raise ValueError("stash: Incoming packet has an invalid size.")
+
+        cipher = self._next_cipher(sending=False)
+        data = bytearray(len(frame) - TAG_SIZE)
+        cipher.decrypt(frame[:len(data)], output=data)
+        cipher.verify(frame[len(data):])
+        return data
+
+    def encrypt_packet(self, data: bytes) -> bytearray:
+        """Encrypts the packet in place of the returned frame, and prefixes it with the length"""
+        frame = bytearray(FRAME_HEADER.size + len(data) + TAG_SIZE)
+        FRAME_HEADER.pack_into(frame, 0, len(data) + TAG_SIZE)
+
+        cipher = self._next_cipher(sending=True)
+        view = memoryview(frame)
+        cipher.encrypt(data, output=view[FRAME_HEADER.size:FRAME_HEADER.size + len(data)])
+        view[FRAME_HEADER.size + len(data):] = cipher.digest()
+        return frame
@@ -1,9 +1,18 @@
+import hashlib
+import lzma
 import os
+import re
+import tempfile
+import threading
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 from filelock import FileLock
 
+from backend.packs import read_stored_object, is_stored_object, get_loose_object_path, \
+    decompress_object, freshen_stored_object, LZMA_MAGIC
 from models.tree import Tree
+from ObjectCache import ObjectCache, object_cache
 
 
 def write_file(path, data, binary_=True):
@@ -24,10 +33,23 @@ def read_file(path, binary_=True) -> bytes | str:
         return f.read()
 
 
+def write_file_atomic(path, data, temp_folder, binary_=True):
+    """
+    Writes a file aside in temp_folder and moves it into place, so readers see either the previous or the new content.
+    temp_folder must be on the same volume as path.
+    """
+    temp_path = os.path.join(temp_folder, f"tmp_{os.getpid()}_{threading.get_ident()}")
+    write_file(temp_path, data, binary_)
+    os.replace(temp_path, path)
+
+
 def resolve_object(main_folder, repo_id, sha1) -> bytes:
-    """Returns the bytes of an object"""
+    """Returns the bytes of an object, loose or packed"""
     path = resolve_object_location(main_folder, repo_id, sha1)
-    return bytes(read_file(path, binary_=True))
+    data = read_stored_object(os.path.join(main_folder, repo_id, "objects"), sha1)
+    if data is None:
+        raise FileNotFoundError(path)
+    return bytes(data)
 
 
 def resolve_object_location(full_repo, repo_id, obj_hash):
@@ -35,126 +57,213 @@ def resolve_object_location(full_repo, repo_id, obj_hash):
     allowed_path = os.path.join(full_repo, repo_id)
     pth = os.path.join(full_repo, repo_id, "objects", obj_hash[:2], obj_hash[2:])
     if is_directory_traversal(allowed_path, pth):
-        print("Directory traversal was executed.")
-        quit(1)
+        raise ValueError("stash: Invalid object hash.")
 
     return pth
 
 
+SHA1_PATTERN = re.compile("[0-9a-f]{40}")
+
+# Digits of the length of every packfile entry, enough for objects of any practical size
+PACK_ENTRY_LENGTH_DIGITS = 16
+
+
+def is_valid_sha(sha1: str) -> bool:
+    """Returns True or False whether a hash is a full, lowercase hex sha1"""
+    return SHA1_PATTERN.fullmatch(sha1) is not None
+
+
+def validate_shas(shas):
+    """Raises ValueError unless every hash is a full, lowercase hex sha1"""
+    if not all(is_valid_sha(sha) for sha in shas):
+        raise ValueError("stash: Invalid object hash.")
+
+
 def is_directory_traversal(safe_dir: str, value: str):
     """Check if the user tried a directory traversal"""
     return os.path.commonprefix((os.path.realpath(value), safe_dir)) != safe_dir
 
 
 class FileSystemProvider:
-    def __init__(self, storage_path: str, repo_id: str):
+    def __init__(self, storage_path: str, repo_id: str, cache: ObjectCache | None = object_cache):
+        """cache is shared by the providers of all the clients, None reads every object from the disk"""
         self.main_folder = storage_path
+        self.cache = cache
         self.repo_id = repo_id
+        self.objects_path = os.path.join(self.main_folder, repo_id, "objects")
         self.lock = FileLock(os.path.join(self.main_folder, repo_id, "lock"), timeout=5)
 
-    def generate_prep_file(self, tree_hash: str):
+    def generate_prep_file(self, tree_hash: str, seen: set = None, base_tree_hash: str = None):
         """
         Returns a preparefile for the given commit.
         prepfile contains all directories, subdirectories and files that the commit contains.
+        Objects in seen are skipped, including whole subtrees, and the listed objects are added to it.
+        If base_tree_hash is given, entries that are the same at the same path of the base tree are skipped too.
         """
-        tree_data_encoded = resolve_object(self.main_folder, self.repo_id, tree_hash)
-        tree = Tree.parse_tree(tree_data_encoded.decode())
-        file = f"{tree_hash} tree\n"
-        for key, obj in tree.items():
-            if obj.get_type() == "tree":
-                file += self.generate_prep_file(obj.get_hash())
-            else:
-                file += f"{obj.get_hash()} {obj.get_type()}\n"
-        return file
+        seen = seen if seen is not None else set()
+        rows = []
+        stack = [(tree_hash, base_tree_hash)]
+        while len(stack) > 0:
+            current, base = stack.pop()
+            if current in seen or current == base:
+                continue
+            seen.add(current)
+            rows.append(f"{current} tree\n")
+
+            tree = Tree.parse_tree(self.read_object(current).decode())
+            base_tree = Tree.parse_tree(self.read_object(base).decode()) if base is not None else {}
+            for key, obj in tree.items():
+                base_obj = base_tree.get(key)
+                base_hash = base_obj.node_hash if base_obj is not None and base_obj.type_ == obj.type_ else None
+                if obj.type_ == "tree":
+                    stack.append((obj.node_hash, base_hash))
+                elif obj.node_hash != base_hash and obj.node_hash not in seen:
+                    seen.add(obj.node_hash)
+                    rows.append(f"{obj.node_hash} {obj.type_}\n")
+        return "".join(rows)
+
+    def generate_history_prep_file(self, head_commit: str, haves: set = frozenset()):
+        """
+        Returns a preparefile of the objects reachable from a commit, that are missing for a client.
+        haves are commits the client has. The history is walked back until one of them, and only the objects
+        that differ from its tree are listed. Without a common commit, the whole history is listed.
+        Raises ValueError if any of the haves is not a valid hash.
+        """
+        validate_shas(haves)
+        history = []
+        pointer = head_commit
+        while pointer != "" and pointer not in haves:
+            message, tree_hash, parent_hash = self.extract_commit_data(pointer)
+            history.append((pointer, tree_hash))
+            pointer = parent_hash
+
+        base_tree_hash = self.extract_commit_data(pointer)[1] if pointer != "" else None
+        seen = set()
+        rows = []
+        for commit_hash, tree_hash in history:
+            rows.append(f"{commit_hash} commit\n")
+            rows.append(self.generate_prep_file(tree_hash, seen, base_tree_hash))
+        return "".join(rows)
+
+    def filter_missing_objects(self, shas: list[str]) -> list[str]:
+        """
+        Returns the hashes of the objects that are not stored in the repository.
+        Raises ValueError if any of the hashes is not valid, so client strings never reach the disk.
+        """
+        validate_shas(shas)
+        return [sha for sha in shas if not is_stored_object(self.objects_path, sha)]
 
     def generate_pack_file(self, prep_file: str):
-        """Generates a packfile from a prep file
+        """Yields the compressed packfile of a prep file in chunks, as its objects are read
         prep files usually look like:
 
         sha1 type
         """
-        pack_file = b""
         prep_file = prep_file.split("\n")
         del prep_file[-1]
 
-        MAX_DIGIT_SIZE = 8  # 12mb
+        # The objects are already compressed, the pack itself only needs the fastest level
+        compressor = zlib.compressobj(zlib.Z_BEST_SPEED)
         for row in prep_file:
             sha, obj_type = row.split(" ")
-            loc = resolve_object_location(self.main_folder, self.repo_id, sha)
-            data = bytes(read_file(loc, binary_=True))
-            pack_file += f"{sha} {str(len(data)).zfill(MAX_DIGIT_SIZE)}".encode() + data + "\n".encode()
+            data = self.get_server_object(sha[:2], sha[2:])
+            if data is None:
+                raise FileNotFoundError(resolve_object_location(self.main_folder, self.repo_id, sha))
+            compressed = compressor.compress(f"{sha} {str(len(data)).zfill(PACK_ENTRY_LENGTH_DIGITS)}".encode()
+                                             + data + b"\n")
+            if compressed:
+                yield compressed
+
+        yield compressor.flush()
 
-        return zlib.compress(pack_file)
+    def open_packfile(self) -> "PackfileParser":
+        """Returns a parser that verifies and creates the objects of a compressed packfile, as its chunks arrive"""
+        return PackfileParser(PackIngester(self.objects_path))
 
-    def execute_packfile(self, pack_file: bytes) -> (str, bytes):
+    def execute_packfile(self, pack_file: bytes):
         """
         Decompiles the packfile, to usable form
 
         {sha (40 bytes)} {data_length}{data}
 
         """
-        index = 0
-        MAX_DIGIT_SIZE = 8  # 12mb
+        parser = PackfileParser(PackIngester(self.objects_path), compressed=False)
+        parser.feed(pack_file)
+        parser.close()
 
-        self.lock.acquire()
+    def has_commit(self, sha1: str) -> bool:
+        """Returns True or False whether a commit and its tree are stored"""
         try:
-            while index < len(pack_file):
-                sha1 = pack_file[index:index + 40].decode()  # Extract SHA1 hash
-                index += 41
-                data_length = int(pack_file[index:index + MAX_DIGIT_SIZE].decode())
-                index += MAX_DIGIT_SIZE
-                data_content = pack_file[index:index + data_length]  # Extract data
-                index += data_length + 1  # Move index to the next line
-                self.create_object(sha1, data_content)
-        finally:
-            self.lock.release()
-
-    def create_object(self, sha: str, compressed_data: bytes):
-        """Creates an object in the objects database"""
-        pth = resolve_object_location(self.main_folder, self.repo_id, sha)
-        if not os.path.exists(pth):
-            folder_path = os.path.join(self.main_folder, self.repo_id, "objects", sha[:2])
-            if not os.path.exists(folder_path):
-                os.mkdir(folder_path)
-            write_file(pth, compressed_data, binary_=True)
+            message, tree_hash, parent_hash = self.extract_commit_data(sha1)
+        except (FileNotFoundError, AssertionError, ValueError, IndexError, zlib.error, lzma.LZMAError):
+            return False
+        return is_stored_object(self.objects_path, tree_hash)
+
+    def is_ancestor(self, ancestor: str, sha1: str) -> bool:
+        """Returns True or False whether a commit is reachable from another by following parents. "" is always one"""
+        pointer = sha1
+        while pointer != "":
+            if pointer == ancestor:
+                return True
+            try:
+                message, tree_hash, pointer = self.extract_commit_data(pointer)
+            except (FileNotFoundError, AssertionError, ValueError, IndexError, zlib.error, lzma.LZMAError):
+                return False
+        return ancestor == ""
 
     def get_server_object(self, s: str, c: str):
         """Fetch a web_server object from a remote repository"""
         assert len(s) == 2
         assert len(c) == 38
 
-        if not os.path.exists(os.path.join(self.main_folder, self.repo_id, "objects", s, c)):
+        if self.cache is None:
+            return self.__load_object(f"{s}{c}")
+        return self.cache.get_or_load(self.repo_id, f"{s}{c}", lambda: self.__load_object(f"{s}{c}"))
+
+    def __load_object(self, sha1: str) -> bytes | None:
+        """Reads the stored data of an object from the disk, or returns None if it is missing"""
+        try:
+            return resolve_object(self.main_folder, self.repo_id, sha1)
+        except FileNotFoundError:
             return None
 
-        obj = resolve_object(self.main_folder, self.repo_id, f"{s}{c}")
-        return obj
+    def read_object(self, sha1: str) -> bytes:
+        """Returns the original content of an object"""
+        data = self.get_server_object(sha1[:2], sha1[2:])
+        if data is None:
+            raise FileNotFoundError(resolve_object_location(self.main_folder, self.repo_id, sha1))
+        return decompress_object(data)
 
     def get_repo_branches(self) -> list[str]:
         """Gets the branches available in a repository"""
         return os.listdir(os.path.join(self.main_folder, self.repo_id, "refs", "head"))
 
     def get_head_commit(self, branch: str):
-        """Gets the current head commit"""
+        """Gets the current head commit. refs are replaced atomically, so reading them takes no lock"""
         head_commit_path = os.path.join(self.main_folder, self.repo_id, "refs/head", branch)
-        if not os.path.exists(head_commit_path):
+        try:
+            return read_file(head_commit_path, binary_=False)
+        except FileNotFoundError:
             return None
 
-        with self.lock:
-            if not os.path.exists(head_commit_path):
-                return None
-            cmt = read_file(head_commit_path, binary_=False)
-            return cmt
-
-    def update_head_commit(self, branch: str, new_head: str):
-        """Updates the current head commit"""
+    def update_head_commit(self, branch: str, new_head: str, old_head: str = None) -> bool:
+        """
+        Updates the current head commit.
+        If old_head is given, the head is only updated if it still points to old_head, and False is returned otherwise.
+        The lock only serializes the compare and the swap, readers never wait for it.
+        """
         head_path = os.path.join(self.main_folder, self.repo_id, "refs", "head", branch)
 
         with self.lock:
-            write_file(head_path, new_head, binary_=False)
+            if old_head is not None and (self.get_head_commit(branch) or "") != old_head:
+                return False
+            # The temporary file is kept out of refs/head, so it is never listed as a branch
+            write_file_atomic(head_path, new_head, os.path.join(self.main_folder, self.repo_id), binary_=False)
+        return True
 
     def extract_commit_data(self, sha1) -> tuple:
         """Extracts the commit data, given its hash value"""
-        cmt = resolve_object(self.main_folder, self.repo_id, sha1).decode()
+        cmt = self.read_object(sha1).decode()
         lines = cmt.split("\n")
         del lines[2]
 
@@ -177,7 +286,7 @@ class FileSystemProvider:
         message, tree_hash, parent = self.extract_commit_data(last_commit)
 
         # Traverse tree hash
-        tree_view = self.get_server_object(tree_hash[:2], tree_hash[2:]).decode().split("\n")
+        tree_view = self.read_object(tree_hash).decode().split("\n")
         tree_view.pop()  # Remove blank line
 
         files_commit = []
@@ -185,3 +294,282 @@ class FileSystemProvider:
             tp, hsh, filename = row.split(" ")
             files_commit.append((tp, hsh, filename))
         return message, files_commit
+
+
+# Pack entries do not carry their type, so an object is verified against the header of each type, most common first
+OBJECT_TYPES = ("blob", "tree", "commit")
+
+INGESTION_WORKERS = os.cpu_count() or 4
+INGESTION_BATCH_SIZE = 256
+# Received objects waiting for verification are bounded, the parser waits for the workers above this size
+MAX_PENDING_INGESTION = 64 * 1024 * 1024
+# Objects bigger than this are received into a temporary file instead of memory, and verified in chunks
+LARGE_OBJECT_SIZE = 16 * 1024 * 1024
+LARGE_OBJECT_PREFIX = "tmp_large_"
+# Largest amount of data decompressed from the packfile at once, so a small chunk never expands all at once
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# Created on first use, so forked server workers each get their own threads
+_ingestion_pool = None
+_ingestion_pool_lock = threading.Lock()
+
+
+def get_ingestion_pool() -> ThreadPoolExecutor:
+    """Returns the worker pool shared by the ingestions of the process"""
+    global _ingestion_pool
+    with _ingestion_pool_lock:
+        if _ingestion_pool is None:
+            _ingestion_pool = ThreadPoolExecutor(max_workers=INGESTION_WORKERS)
+        return _ingestion_pool
+
+
+def verify_object(sha1: str, compressed_data: bytes) -> bool:
+    """Returns True or False whether the compressed data hashes to sha1"""
+    try:
+        data = decompress_object(compressed_data)
+    except (zlib.error, lzma.LZMAError):
+        return False
+
+    for type_ in OBJECT_TYPES:
+        hasher = hashlib.sha1(f"{type_}{len(data)}".encode() + b"\x00")
+        hasher.update(data)
+        if hasher.hexdigest() == sha1:
+            return True
+    return False
+
+
+def decompress_file_chunks(path: str):
+    """Yields the original content of an object stored in a file, in chunks of at most DECOMPRESS_CHUNK_SIZE"""
+    with open(path, "rb") as f:
+        data = f.read(DECOMPRESS_CHUNK_SIZE)
+        is_lzma = data[:len(LZMA_MAGIC)] == LZMA_MAGIC
+        decompressor = lzma.LZMADecompressor() if is_lzma else zlib.decompressobj()
+        while not decompressor.eof:
+            chunk = decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+            if len(chunk) == 0 and len(data) == 0:
+                raise ValueError("stash: Object data was truncated.")
+            yield chunk
+            if is_lzma:
+                data = f.read(DECOMPRESS_CHUNK_SIZE) if decompressor.needs_input else b""
+            else:
+                data = decompressor.unconsumed_tail or f.read(DECOMPRESS_CHUNK_SIZE)
+
+
+def verify_object_file(sha1: str, path: str) -> bool:
+    """
+    Returns True or False whether the compressed data in a file hashes to sha1.
+    The header of the hash holds the original length, so the file is decompressed once to measure it, and once more
+    to hash it, and is never held in memory.
+    """
+    try:
+        length = sum(len(chunk) for chunk in decompress_file_chunks(path))
+        hashers = [hashlib.sha1(f"{type_}{length}".encode() + b"\x00") for type_ in OBJECT_TYPES]
+        for chunk in decompress_file_chunks(path):
+            for hasher in hashers:
+                hasher.update(chunk)
+    except (zlib.error, lzma.LZMAError, ValueError):
+        return False
+    return any(hasher.hexdigest() == sha1 for hasher in hashers)
+
+
+def prepare_objects_folder(objects_path: str):
+    """Creates all the fan-out folders of the objects database, so writing an object never probes for its folder"""
+    if os.path.isdir(os.path.join(objects_path, "ff")):
+        return
+    for prefix in range(256):
+        os.makedirs(os.path.join(objects_path, f"{prefix:02x}"), exist_ok=True)
+
+
+class PackIngester:
+    """
+    Verifies and writes the objects of a packfile.
+    Objects are collected in batches, the ones that are already stored, or found in the stores the repository borrows
+    from, are skipped, and the rest are decompressed, hashed and written by the ingestion workers.
+    Skipped objects are freshened, so the maintenance job does not prune them before the push moves its branch. An
+    object the maintenance job removed before it could be freshened is written again.
+    An object is only written once its hash was verified, and close raises ValueError if any object did not match.
+    Large objects are received into temporary files, and verified and moved into place by the workers.
+    """
+
+    def __init__(self, objects_path: str):
+        self.objects_path = objects_path
+        self.batch = []
+        self.pending = []
+        self.pending_size = 0
+        # Objects handed to the workers by this ingestion, objects repeated in the pack are written once
+        self.queued = set()
+        prepare_objects_folder(objects_path)
+
+    def add(self, sha1: str, compressed_data: bytes):
+        """Queues an object of the packfile"""
+        if not is_valid_sha(sha1):
+            raise ValueError("stash: Packfile contains an invalid object hash.")
+        self.batch.append((sha1, compressed_data))
+        if len(self.batch) >= INGESTION_BATCH_SIZE:
+            self.flush()
+
+    def open_large_object(self):
+        """Returns a temporary file to receive an object too large to be held in memory, and its path"""
+        fd, path = tempfile.mkstemp(prefix=LARGE_OBJECT_PREFIX, dir=self.objects_path)
+        return os.fdopen(fd, "wb"), path
+
+    def add_large_object(self, sha1: str, temp_path: str):
+        """Queues an object of the packfile that was received into a temporary file, the file is moved or removed"""
+        if not is_valid_sha(sha1):
+            os.remove(temp_path)
+            raise ValueError("stash: Packfile contains an invalid object hash.")
+        if self.__is_stored(sha1):
+            os.remove(temp_path)
+            return
+        self.queued.add(sha1)
+        self.pending.append(get_ingestion_pool().submit(self.__verify_and_move, sha1, temp_path))
+
+    def __is_stored(self, sha1: str) -> bool:
+        return sha1 in self.queued or freshen_stored_object(self.objects_path, sha1)
+
+    def __verify_and_write(self, sha1: str, compressed_data: bytes):
+        if not verify_object(sha1, compressed_data):
+            raise ValueError(f"stash: Object {sha1} does not match its hash.")
+        # Objects are written aside and moved into place, so readers never see a partially written object
+        write_file_atomic(get_loose_object_path(self.objects_path, sha1), compressed_data, self.objects_path)
+
+    def __verify_and_move(self, sha1: str, temp_path: str):
+        if not verify_object_file(sha1, temp_path):
+            os.remove(temp_path)
+            raise ValueError(f"stash: Object {sha1} does not match its hash.")
+        os.replace(temp_path, get_loose_object_path(self.objects_path, sha1))
+
+    def flush(self):
+        """Hands the missing objects of the current batch to the workers"""
+        pool = get_ingestion_pool()
+        for sha1, compressed_data in self.batch:
+            if self.__is_stored(sha1):
+                continue
+            self.queued.add(sha1)
+            self.pending.append(pool.submit(self.__verify_and_write, sha1, compressed_data))
+            self.pending_size += len(compressed_data)
+        self.batch.clear()
+
+        if self.pending_size > MAX_PENDING_INGESTION:
+            self.wait()
+
+    def wait(self):
+        """Waits for the queued objects to be written, and raises the first error of the workers"""
+        pending = self.pending
+        self.pending, self.pending_size = [], 0
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Writes the rest of the objects, and makes sure all of them were verified"""
+        self.flush()
+        self.wait()
+
+
+class PackfileParser:
+    """
+    Incrementally parses a packfile, and hands every object to the ingester as soon as all of its data was received.
+    Only the entry currently being received is kept in memory, besides the objects waiting for the ingester.
+    Entries bigger than LARGE_OBJECT_SIZE are written to a temporary file as they arrive instead.
+
+    {sha (40 bytes)} {data_length}{data}\n
+    """
+    ENTRY_HEADER_SIZE = 41 + PACK_ENTRY_LENGTH_DIGITS
+
+    def __init__(self, ingester: PackIngester, compressed=True):
+        self.ingester = ingester
+        self.decompressor = zlib.decompressobj() if compressed else None
+        self.pending = bytearray()
+        # (sha1, temporary file, its path, bytes left) of the large entry being received
+        self.large_object = None
+
+    def feed(self, data: bytes):
+        """Parses the next chunk of the packfile"""
+        try:
+            if self.decompressor is None:
+                self._receive(data)
+                return
+
+            while True:
+                decompressed = self.decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE)
+                self._receive(decompressed)
+                data = self.decompressor.unconsumed_tail
+                if len(data) == 0 and len(decompressed) < DECOMPRESS_CHUNK_SIZE:
+                    break
+        except BaseException:
+            self.abort()
+            raise
+
+    def close(self):
+        """Parses the rest of the packfile, and makes sure it was complete"""
+        try:
+            if self.decompressor is not None:
+                self._receive(self.decompressor.flush())
+                if not self.decompressor.eof:
+                    raise ValueError("stash: Packfile stream was truncated.")
+            if self.large_object is not None or len(self.pending) > 0:
+                raise ValueError("stash: Packfile ends with a partial object.")
+        except BaseException:
+            self.abort()
+            raise
+        self.ingester.close()
+
+    def abort(self):
+        """Removes the temporary file of a partially received large entry"""
+        if self.large_object is None:
+            return
+        sha1, f, path, left = self.large_object
+        self.large_object = None
+        f.close()
+        os.remove(path)
+
+    def _receive(self, data: bytes):
+        """Hands the received data to the large entry being received, and parses the entries that follow it"""
+        self.pending += data
+        while True:
+            if self.large_object is not None and not self._write_large_object():
+                return
+            if not self._parse_entries():
+                return
+
+    def _write_large_object(self) -> bool:
+        """Writes the received data of the large entry, returns True once all of it, and its newline, was received"""
+        sha1, f, path, left = self.large_object
+        written = min(left, len(self.pending))
+        f.write(self.pending[:written])
+        del self.pending[:written]
+        left -= written
+        if left > 0 or len(self.pending) == 0:
+            self.large_object = sha1, f, path, left
+            return False
+
+        if self.pending[0] != ord("\n"):
+            raise ValueError("stash: Packfile entry is malformed.")
+        del self.pending[:1]
+        f.close()
+        self.large_object = None
+        self.ingester.add_large_object(sha1, path)
+        return True
+
+    def _parse_entries(self) -> bool:
+        """Creates the objects that were fully received, and keeps the remainder. returns True if a large entry began"""
+        index = 0
+        began_large_object = False
+        while len(self.pending) - index >= self.ENTRY_HEADER_SIZE:
+            data_start = index + self.ENTRY_HEADER_SIZE
+            data_length = int(self.pending[index + 41:data_start].decode())
+            sha1 = self.pending[index:index + 40].decode()
+            if data_length > LARGE_OBJECT_SIZE:
+                f, path = self.ingester.open_large_object()
+                self.large_object = sha1, f, path, data_length
+                index = data_start
+                began_large_object = True
+                break
+
+            entry_end = data_start + data_length + 1  # Including the trailing newline
+            if len(self.pending) < entry_end:
+                break
+            self.ingester.add(sha1, bytes(self.pending[data_start:entry_end - 1]))
+            index = entry_end
+        del self.pending[:index]
+        return began_large_object
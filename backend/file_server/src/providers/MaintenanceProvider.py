@@ -0,0 +1,207 @@
+import dataclasses
+import os
+import threading
+import time
+
+from filelock import FileLock, Timeout
+
+from backend.packs import load_packs, write_pack, remove_pack, read_stored_object, is_stored_object, \
+    read_alternates, get_pack_directory
+from providers.FileSystemProvider import FileSystemProvider
+from models.tree import Tree
+
+# Unreachable objects younger than this are kept, they may belong to a push that did not update its branch yet
+PRUNE_GRACE_PERIOD = 2 * 60 * 60
+
+
+@dataclasses.dataclass
+class RepackResult:
+    packed: int
+    pruned: int
+    removed_packs: int
+
+
+class MaintenanceProvider:
+    """
+    Consolidates the loose objects of the repositories into a single indexed pack, and prunes unreachable objects.
+
+    The repository lock is only held to snapshot the branches, and to swap the packs, so readers are not blocked
+    while objects are copied. Readers that miss a loose object retry with a fresh pack list, and objects are always
+    packed before their loose files are removed.
+    """
+
+    def __init__(self, storage_path: str, prune_grace_period: int = PRUNE_GRACE_PERIOD):
+        self.main_folder = storage_path
+        self.prune_grace_period = prune_grace_period
+
+    def find_dependent_repositories(self, repo_id: str) -> list[str]:
+        """
+        Returns the repositories that borrow objects from a repository.
+        Alternates are flat, so forks of forks list the repository directly, the same single hop readers follow.
+        """
+        objects_path = os.path.normpath(os.path.join(self.main_folder, repo_id, "objects"))
+        return [other_id for other_id in sorted(os.listdir(self.main_folder))
+                if other_id != repo_id
+                and objects_path in read_alternates(os.path.join(self.main_folder, other_id, "objects"))]
+
+    def snapshot_refs(self, file_systems: list[FileSystemProvider]) -> dict[tuple[str, str], str]:
+        """Returns the head commit of every branch of the repositories, keyed by (repo id, branch)"""
+        refs = {}
+        for file_system in file_systems:
+            for branch in file_system.get_repo_branches():
+                head_commit = file_system.get_head_commit(branch)
+                if head_commit is not None:
+                    refs[(file_system.repo_id, branch)] = head_commit
+        return refs
+
+    def find_reachable_objects(self, file_system: FileSystemProvider, heads) -> set[str]:
+        """Returns the hashes of every commit, tree and blob reachable from the given commits"""
+        reachable = set()
+        stack = []
+        for pointer in heads:
+            while pointer != "" and pointer not in reachable:
+                reachable.add(pointer)
+                message, tree_hash, pointer = file_system.extract_commit_data(pointer)
+                stack.append(tree_hash)
+
+        while len(stack) > 0:
+            tree_hash = stack.pop()
+            if tree_hash in reachable:
+                continue
+            reachable.add(tree_hash)
+            for node in Tree.parse_tree(file_system.read_object(tree_hash).decode()).values():
+                if node.type_ == "tree":
+                    stack.append(node.node_hash)
+                else:
+                    reachable.add(node.node_hash)
+        return reachable
+
+    def list_loose_objects(self, objects_path: str):
+        """Yields (sha1, path, modification time) of every loose object"""
+        for folder in os.scandir(objects_path):
+            if len(folder.name) != 2 or not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if len(entry.name) == 38:
+                    yield folder.name + entry.name, entry.path, entry.stat().st_mtime
+
+    def is_pack_in_grace_period(self, objects_path: str, pack, reachable: set[str], started: float) -> bool:
+        """Returns True or False whether a pack is younger than the grace period and holds unreachable objects"""
+        try:
+            mtime = os.stat(os.path.join(get_pack_directory(objects_path), f"{pack.name}.pack")).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime <= started - self.prune_grace_period:
+            return False
+        return any(sha not in reachable for sha in pack.shas())
+
+    def remove_stale_temporary_files(self, objects_path: str, started: float):
+        """Removes the temporary files of writes and pushes that were interrupted longer than the grace period ago"""
+        for entry in os.scandir(objects_path):
+            try:
+                if entry.name.startswith("tmp_") and entry.stat().st_mtime <= started - self.prune_grace_period:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+    def repack(self, repo_id: str) -> RepackResult | None:
+        """
+        Packs every reachable object of a repository into a new pack, removes the previous packs and the loose
+        copies, and prunes unreachable loose objects older than the grace period.
+        The grace period applies to packed objects too: a previous pack younger than the grace period that holds
+        unreachable objects is kept, and removed by a later repack once it is old enough.
+        Objects are reachable from the branches of the repository, and from the branches of the forks borrowing
+        objects from it. Only objects the repository stores itself are packed, borrowed objects stay where they are.
+        Returns None if the repository is already being repacked, or its branches moved while repacking.
+        """
+        # Repacking reads every object once, it bypasses the object cache so the hot objects are not evicted
+        file_system = FileSystemProvider(self.main_folder, repo_id, cache=None)
+        file_systems = [file_system] + [FileSystemProvider(self.main_folder, dependent_id, cache=None)
+                                        for dependent_id in self.find_dependent_repositories(repo_id)]
+        objects_path = file_system.objects_path
+        try:
+            # Only a single maintenance job runs on a repository, across all the server processes
+            gc_lock = FileLock(os.path.join(self.main_folder, repo_id, "gc.lock"), timeout=0)
+            gc_lock.acquire()
+        except Timeout:
+            return None
+
+        try:
+            with file_system.lock:
+                refs = self.snapshot_refs(file_systems)
+            reachable = set()
+            for current in file_systems:
+                heads = [head_commit for (current_id, branch), head_commit in refs.items()
+                         if current_id == current.repo_id]
+                reachable |= self.find_reachable_objects(current, heads)
+            previous_packs = load_packs(objects_path, refresh=True)
+            loose_objects = list(self.list_loose_objects(objects_path))
+            started = time.time()
+
+            packed = [sha for sha in sorted(reachable) if is_stored_object(objects_path, sha, alternates=False)]
+            name = write_pack(objects_path,
+                              ((sha, read_stored_object(objects_path, sha, alternates=False)) for sha in packed))
+
+            with file_system.lock:
+                if self.snapshot_refs(file_systems) != refs:
+                    # A branch moved to objects the snapshot did not see, the new pack is kept and nothing is removed
+                    return None
+                removed_packs = 0
+                for pack in previous_packs:
+                    if pack.name == name:
+                        continue
+                    if self.is_pack_in_grace_period(objects_path, pack, reachable, started):
+                        continue
+                    try:
+                        remove_pack(objects_path, pack.name)
+                        removed_packs += 1
+                    except OSError:
+                        # The pack is still mapped by a reader on a platform that refuses to remove it
+                        continue
+
+            pruned = 0
+            for sha, path, mtime in loose_objects:
+                is_pruned = sha not in reachable
+                if is_pruned and mtime > started - self.prune_grace_period:
+                    continue
+                try:
+                    # A push may have freshened the object since it was listed
+                    if is_pruned and os.stat(path).st_mtime > started - self.prune_grace_period:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+                pruned += is_pruned
+            self.remove_stale_temporary_files(objects_path, started)
+            return RepackResult(packed=len(packed), pruned=pruned, removed_packs=removed_packs)
+        finally:
+            gc_lock.release()
+
+    def repack_all(self) -> dict[str, RepackResult | None]:
+        """Repacks every repository in the storage"""
+        results = {}
+        for repo_id in sorted(os.listdir(self.main_folder)):
+            if os.path.isdir(os.path.join(self.main_folder, repo_id, "objects")):
+                try:
+                    results[repo_id] = self.repack(repo_id)
+                except Exception as e:
+                    print(f"stash: Repacking '{repo_id}' failed: {e}")
+                    results[repo_id] = None
+        return results
+
+
+class MaintenanceScheduler(threading.Thread):
+    """Background thread of the file server, that repacks all repositories every interval seconds"""
+
+    def __init__(self, maintenance: MaintenanceProvider, interval: int):
+        super().__init__(daemon=True)
+        self.maintenance = maintenance
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.maintenance.repack_all()
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,56 @@
+import dataclasses
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+from Crypto.Cipher import AES
+
+# Tickets are sealed with a key only the server knows, so no session state is kept on the server.
+# Every server process of a deployment must share STASH_TICKET_KEY (hex) for tickets to be accepted by all of them.
+TICKET_KEY = bytes.fromhex(os.environ["STASH_TICKET_KEY"]) if "STASH_TICKET_KEY" in os.environ else os.urandom(32)
+TICKET_TTL = 60 * 60
+
+#   nonce | AES-GCM(session key (32 bytes) | expiry (u64) | user id \n username) | tag
+TICKET_HEADER = struct.Struct(">32sQ")
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+@dataclasses.dataclass
+class SessionTicket:
+    key: bytes
+    expiry: int
+    user_id: str
+    username: str
+
+
+class SessionProvider:
+    def issue_ticket(self, key: bytes, user_id: str, username: str, expiry: int = None) -> (str, int):
+        """Returns a ticket that resumes a session with the given key, and its expiry time"""
+        expiry = expiry if expiry is not None else int(time.time()) + TICKET_TTL
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = AES.new(TICKET_KEY, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+        sealed, tag = cipher.encrypt_and_digest(TICKET_HEADER.pack(key, expiry) + f"{user_id}\n{username}".encode())
+        return (nonce + sealed + tag).hex(), expiry
+
+    def open_ticket(self, ticket: str) -> SessionTicket | None:
+        """Returns the session of a ticket, or None if the ticket is forged or expired"""
+        try:
+            raw = bytes.fromhex(ticket)
+            cipher = AES.new(TICKET_KEY, AES.MODE_GCM, nonce=raw[:NONCE_SIZE], mac_len=TAG_SIZE)
+            data = cipher.decrypt_and_verify(raw[NONCE_SIZE:-TAG_SIZE], raw[-TAG_SIZE:])
+        except ValueError:
+            return None
+
+        key, expiry = TICKET_HEADER.unpack_from(data)
+        if expiry < time.time():
+            return None
+        user_id, username = data[TICKET_HEADER.size:].decode().split("\n", 1)
+        return SessionTicket(key=key, expiry=expiry, user_id=user_id, username=username)
+
+    @staticmethod
+    def derive_resumed_key(key: bytes, client_nonce: bytes, server_nonce: bytes) -> bytes:
+        """Derives a fresh key for a resumed session, so frame nonces are never reused with the ticket's key"""
+        return hmac.new(key, client_nonce + server_nonce, hashlib.sha256).digest()
@@ -1,3 +1,5 @@
 from .EncryptionProvider import EncryptionProvider
 from .FileSystemProvider import FileSystemProvider
 from .AuthenticationProvider import AuthenticationProvider
+from .SessionProvider import SessionProvider
+from .MaintenanceProvider import MaintenanceProvider, MaintenanceScheduler
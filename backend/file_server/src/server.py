@@ -1,31 +1,194 @@
+import argparse
+import os
+import signal
 import socket
 import threading
+import time
+import traceback
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 
 from backend.file_server.src.ClientThread import ClientThread
+from backend.file_server.src.AsyncServer import AsyncServer, SHUTDOWN_GRACE_PERIOD
+from providers.MaintenanceProvider import MaintenanceProvider, MaintenanceScheduler
 
 # Packet line
 # Hexadecimal length is added before sending
 
+HOST = '127.0.0.1'
 PORT = 8838
 REPOSITORY_SAVING_ABS_PTH = r"D:\code\stash\backend\__temp__"
+DATABASE_URL = r"sqlite:///../../db.sqlite"
+
+# A worker that exits sooner than this after starting failed to start. Such workers are restarted after an exponential
+# backoff, and the supervisor gives up after MAX_FAILED_STARTS of them in a row
+MIN_WORKER_UPTIME = 10
+MAX_RESTART_DELAY = 60
+MAX_FAILED_STARTS = 5
+
+
+def create_listening_socket(reuse_port=False):
+    """Creates the listening socket of the server. with reuse_port, several processes can listen on the same port"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((HOST, PORT))
+    s.listen()
+    return s
 
 
 class Server:
-    def __init__(self):
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.bind(('127.0.0.1', PORT))
-        self.engine = create_engine(r"sqlite:///../../db.sqlite")
+    def __init__(self, sock=None, engine=None):
+        self.s = sock if sock is not None else create_listening_socket()
+        self.engine = engine if engine is not None else create_engine(DATABASE_URL)
+        self.threads = []
 
     def listen(self):
-        self.s.listen()
         with Session(self.engine) as session:
             while 1:
-                conn, addr = self.s.accept()
+                try:
+                    conn, addr = self.s.accept()
+                except OSError:
+                    # The listening socket was closed by shutdown
+                    break
                 thrd = ClientThread(conn, session, REPOSITORY_SAVING_ABS_PTH)
-                threading.Thread(daemon=False, target=thrd.run).start()
+                self.threads = [t for t in self.threads if t.is_alive()]
+                self.threads.append(threading.Thread(daemon=False, target=thrd.run))
+                self.threads[-1].start()
+
+            # Connections that were already accepted are served until they end
+            for t in self.threads:
+                t.join(SHUTDOWN_GRACE_PERIOD)
+
+    def shutdown(self, *_):
+        """Stops accepting new connections"""
+        self.s.close()
+
+
+def start_maintenance(interval: int):
+    """Starts repacking the repositories in the background every interval seconds, if interval is set"""
+    if interval > 0:
+        MaintenanceScheduler(MaintenanceProvider(REPOSITORY_SAVING_ABS_PTH), interval).start()
+
+
+def run_worker(mode: str, executor_workers: int, maintenance_interval: int = 0):
+    """Runs a worker process of the supervisor, until it is asked to shut down"""
+    # Every worker listens on its own socket bound to the same port, and the kernel spreads the connections
+    sock = create_listening_socket(reuse_port=True)
+    # Database connections must not cross a fork, so every worker creates its own engine.
+    # Repositories are shared between the workers, and guarded by their FileLock as between threads
+    engine = create_engine(DATABASE_URL)
+    # Every worker schedules the maintenance, a repository is only repacked by one of them at a time
+    start_maintenance(maintenance_interval)
+
+    if mode == "async":
+        AsyncServer(HOST, PORT, engine, REPOSITORY_SAVING_ABS_PTH, executor_workers).listen(sock)
+        return
+
+    server = Server(sock, engine)
+    signal.signal(signal.SIGTERM, server.shutdown)
+    signal.signal(signal.SIGINT, server.shutdown)
+    server.listen()
+
+
+class Supervisor:
+    """Forks worker processes that serve the same port, restarts workers that die, and stops them gracefully"""
+
+    def __init__(self, workers: int, mode: str, executor_workers: int, maintenance_interval: int = 0):
+        self.workers = workers
+        self.mode = mode
+        self.executor_workers = executor_workers
+        self.maintenance_interval = maintenance_interval
+        # pid -> the time the worker was started
+        self.children = {}
+        self.stopped = threading.Event()
+        self.failed_starts = 0
+
+    def spawn_worker(self):
+        # Signals are blocked until the worker resets its handlers, so it never runs the handlers of the supervisor
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+                run_worker(self.mode, self.executor_workers, self.maintenance_interval)
+            except BaseException:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.children[pid] = time.monotonic()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM, signal.SIGINT})
+
+    def stop(self, *_):
+        """Asks every worker to finish its connections and exit"""
+        self.stopped.set()
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # The worker already exited, and was reaped before its pid was forgotten
+                continue
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for _ in range(self.workers):
+            self.spawn_worker()
+
+        while len(self.children) > 0:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopped.is_set():
+                continue
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if time.monotonic() - started >= MIN_WORKER_UPTIME:
+                self.failed_starts = 0
+                print(f"Worker {pid} exited unexpectedly with status {exit_code}, restarting it.")
+                self.spawn_worker()
+                continue
+
+            self.failed_starts += 1
+            if self.failed_starts > MAX_FAILED_STARTS:
+                print(f"Worker {pid} failed to start with status {exit_code}, {self.failed_starts} times in a row."
+                      f" stopping the server.")
+                self.stop()
+                continue
+            delay = min(2 ** self.failed_starts, MAX_RESTART_DELAY)
+            print(f"Worker {pid} failed to start with status {exit_code}, restarting it in {delay} seconds.")
+            # stop interrupts the wait, so a shutdown is never delayed by the backoff
+            if not self.stopped.wait(delay):
+                self.spawn_worker()
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stash file server")
+    parser.add_argument("--mode", choices=["threaded", "async"], default="threaded",
+                        help="a thread per connection, or a coroutine per connection")
+    parser.add_argument("--executor-workers", type=int, default=32,
+                        help="threads running the disk and crypto work of the async mode")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port. more than 1 requires fork and SO_REUSEPORT")
+    parser.add_argument("--maintenance-interval", type=int, default=0,
+                        help="seconds between repacking the repositories in the background, 0 disables it")
+    args = parser.parse_args()
 
-Server().listen()
+    if args.workers > 1:
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            parser.error("--workers requires a platform with fork and SO_REUSEPORT")
+        Supervisor(args.workers, args.mode, args.executor_workers, args.maintenance_interval).run()
+    elif args.mode == "async":
+        start_maintenance(args.maintenance_interval)
+        AsyncServer(HOST, PORT, create_engine(DATABASE_URL), REPOSITORY_SAVING_ABS_PTH, args.executor_workers).listen()
+    else:
+        start_maintenance(args.maintenance_interval)
+        Server().listen()
@@ -0,0 +1,316 @@
+"""
+Module that exports the pack storage of the server repositories, shared by the file server and the web server.
+
+Loose objects are consolidated by the maintenance job into packs, in the same format the client uses:
+
+    objects/pack/pack-<name>.pack
+        header:  b"SPCK" version (u32) count (u32)
+        data:    compressed object data, one entry after the other
+
+    objects/pack/pack-<name>.idx
+        header:  b"SIDX" version (u32) count (u32)
+        fanout:  256 x u32, the number of objects whose first sha byte is <= i
+        shas:    count x 20 bytes, sorted
+        offsets: count x u64, offset of each object in the pack
+        lengths: count x u64, length of each object in the pack
+
+A fork stores only its own objects, and borrows the rest from the object stores listed in objects/info/alternates.
+Alternates are flattened: a fork of a fork lists the original store as well, so every store it borrows from is a
+single hop away, and the alternates of an alternate are never followed.
+"""
+import hashlib
+import lzma
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+PACK_SIGNATURE = b"SPCK"
+INDEX_SIGNATURE = b"SIDX"
+PACK_VERSION = 1
+
+HEADER = struct.Struct(">4sII")
+FANOUT = struct.Struct(">256I")
+ENTRY_FIELD = struct.Struct(">Q")
+SHA_SIZE = 20
+
+# xz streams start with this signature, any other object data is a zlib stream
+LZMA_MAGIC = b"\xfd7zXZ\x00"
+
+# pack directory -> (directory mtime, loaded packs)
+_loaded_packs = {}
+
+
+def decompress_object(data: bytes) -> bytes:
+    """Decompresses object data, with the codec recorded in its header"""
+    if data[:len(LZMA_MAGIC)] == LZMA_MAGIC:
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def get_pack_directory(objects_path: str):
+    """Returns the directory where the packs of a repository are stored"""
+    return os.path.join(objects_path, "pack")
+
+
+def get_loose_object_path(objects_path: str, sha1: str):
+    """Returns the path of a loose object"""
+    return os.path.join(objects_path, sha1[:2], sha1[2:])
+
+
+class PackIndex:
+    """
+    Class representing an opened pack and its index.
+
+    Attributes:
+        name (str): The name of the pack, without extension.
+        count (int): The number of objects in the pack.
+    """
+
+    def __init__(self, pack_directory: str, name: str):
+        self.name = name
+        with open(os.path.join(pack_directory, f"{name}.idx"), "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(os.path.join(pack_directory, f"{name}.pack"), "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count = HEADER.unpack_from(self.index, 0)
+        if signature != INDEX_SIGNATURE or version != PACK_VERSION:
+            raise ValueError(f"stash: '{name}.idx' is not a valid pack index.")
+
+        self.fanout = FANOUT.unpack_from(self.index, HEADER.size)
+        self.shas_start = HEADER.size + FANOUT.size
+        self.offsets_start = self.shas_start + self.count * SHA_SIZE
+        self.lengths_start = self.offsets_start + self.count * ENTRY_FIELD.size
+
+    def _position(self, raw_sha: bytes):
+        """Binary searches the index for a sha, returns its position or -1"""
+        first_byte = raw_sha[0]
+        low = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self.fanout[first_byte]
+        while low < high:
+            mid = (low + high) // 2
+            start = self.shas_start + mid * SHA_SIZE
+            current = self.index[start:start + SHA_SIZE]
+            if current == raw_sha:
+                return mid
+            if current < raw_sha:
+                low = mid + 1
+            else:
+                high = mid
+        return -1
+
+    def __contains__(self, sha1: str):
+        return self._position(bytes.fromhex(sha1)) != -1
+
+    def __len__(self):
+        return self.count
+
+    def read(self, sha1: str) -> bytes | None:
+        """Returns the compressed data of an object, or None if it is not in the pack"""
+        position = self._position(bytes.fromhex(sha1))
+        if position == -1:
+            return None
+        offset = ENTRY_FIELD.unpack_from(self.index, self.offsets_start + position * ENTRY_FIELD.size)[0]
+        length = ENTRY_FIELD.unpack_from(self.index, self.lengths_start + position * ENTRY_FIELD.size)[0]
+        return self.pack[offset:offset + length]
+
+    def shas(self):
+        """Yields all the object hashes in the pack, sorted"""
+        for position in range(self.count):
+            start = self.shas_start + position * SHA_SIZE
+            yield self.index[start:start + SHA_SIZE].hex()
+
+
+def load_packs(objects_path: str, refresh=False) -> list[PackIndex]:
+    """
+    Returns the packs of a repository, reloading them only when the pack directory changes, or refresh is set.
+    Replaced packs are not closed, readers that still hold them keep a valid mapping until they drop it.
+    """
+    pack_directory = get_pack_directory(objects_path)
+    try:
+        mtime = os.stat(pack_directory).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    cached = _loaded_packs.get(pack_directory)
+    if not refresh and cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    # Packs are immutable, so the ones that are still listed are reused and only new packs are mapped
+    opened = {pack.name: pack for pack in cached[1]} if cached is not None else {}
+    packs = []
+    for entry in sorted(os.listdir(pack_directory)):
+        name, extension = os.path.splitext(entry)
+        # The index is written last, so a pack is usable only once its index exists
+        if extension != ".idx" or not os.path.exists(os.path.join(pack_directory, f"{name}.pack")):
+            continue
+        if name in opened:
+            packs.append(opened[name])
+            continue
+        try:
+            packs.append(PackIndex(pack_directory, name))
+        except FileNotFoundError:
+            # The pack was removed by the maintenance job while listing
+            continue
+
+    _loaded_packs[pack_directory] = mtime, packs
+    return packs
+
+
+def get_alternates_path(objects_path: str):
+    """Returns the path of the file listing the object stores a repository borrows objects from"""
+    return os.path.join(objects_path, "info", "alternates")
+
+
+def read_alternates(objects_path: str) -> list[str]:
+    """Returns the object stores a repository borrows objects from, one path per line relative to objects_path"""
+    try:
+        with open(get_alternates_path(objects_path), "r") as f:
+            lines = f.read().split("\n")
+    except FileNotFoundError:
+        return []
+    return [os.path.normpath(os.path.join(objects_path, line)) for line in lines if line != ""]
+
+
+def add_alternate(objects_path: str, alternate_path: str):
+    """
+    Makes a repository borrow the objects it does not store from another object store, and from every store that one
+    borrows from, so the alternates stay flat
+    """
+    existing = set(read_alternates(objects_path))
+    added = []
+    for path in [os.path.normpath(alternate_path), *read_alternates(alternate_path)]:
+        if path not in existing and path not in added and path != os.path.normpath(objects_path):
+            added.append(path)
+
+    os.makedirs(os.path.dirname(get_alternates_path(objects_path)), exist_ok=True)
+    with open(get_alternates_path(objects_path), "a") as f:
+        f.write("".join(os.path.relpath(path, objects_path) + "\n" for path in added))
+
+
+def read_stored_object(objects_path: str, sha1: str, alternates=True) -> bytes | None:
+    """
+    Returns the compressed data of an object, loose or packed, or None if it is not stored.
+    A miss is retried once with a fresh pack list, since the maintenance job packs loose objects before removing them.
+    With alternates, objects the repository does not store are looked up in the stores it borrows from.
+    """
+    for refresh in (False, True):
+        try:
+            with open(get_loose_object_path(objects_path, sha1), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        for pack in load_packs(objects_path, refresh):
+            data = pack.read(sha1)
+            if data is not None:
+                return data
+
+    if alternates:
+        for alternate_path in read_alternates(objects_path):
+            data = read_stored_object(alternate_path, sha1, alternates=False)
+            if data is not None:
+                return data
+    return None
+
+
+def is_stored_object(objects_path: str, sha1: str, alternates=True, refresh=True) -> bool:
+    """
+    Returns True or False whether an object is stored, loose or packed, or in a store the repository borrows from.
+    Without refresh, a miss is not retried with a fresh pack list.
+    """
+    for refresh_packs in ((False, True) if refresh else (False,)):
+        if os.path.exists(get_loose_object_path(objects_path, sha1)):
+            return True
+        if any(sha1 in pack for pack in load_packs(objects_path, refresh_packs)):
+            return True
+
+    if alternates:
+        return any(is_stored_object(alternate_path, sha1, alternates=False, refresh=refresh)
+                   for alternate_path in read_alternates(objects_path))
+    return False
+
+
+def freshen(path: str) -> bool:
+    """Sets the modification time of a file to now, returns False if it does not exist"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def freshen_stored_object(objects_path: str, sha1: str, alternates=True) -> bool:
+    """
+    Sets the modification time of a stored object, or of the pack holding it, to now, so the grace period of pruning
+    restarts from it. Returns True or False whether the object is still stored.
+    The loose object is checked before the packs, since the maintenance job packs objects before removing them.
+    """
+    if freshen(get_loose_object_path(objects_path, sha1)):
+        return True
+    for pack in load_packs(objects_path):
+        if sha1 in pack and freshen(os.path.join(get_pack_directory(objects_path), f"{pack.name}.pack")):
+            return True
+
+    if alternates:
+        return any(freshen_stored_object(alternate_path, sha1, alternates=False)
+                   for alternate_path in read_alternates(objects_path))
+    return False
+
+
+def write_pack(objects_path: str, entries) -> str | None:
+    """
+    Writes a pack and its index from (sha1, compressed data) entries.
+    Returns the name of the new pack, or None if there were no entries.
+    """
+    pack_directory = get_pack_directory(objects_path)
+    os.makedirs(pack_directory, exist_ok=True)
+    temp_pack_path = os.path.join(pack_directory, f"tmp_pack_{os.getpid()}_{threading.get_ident()}")
+
+    located = {}
+    with open(temp_pack_path, "wb") as f:
+        f.write(HEADER.pack(PACK_SIGNATURE, PACK_VERSION, 0))
+        offset = HEADER.size
+        for sha1, data in entries:
+            if sha1 in located:
+                continue
+            f.write(data)
+            located[sha1] = offset, len(data)
+            offset += len(data)
+
+        f.seek(0)
+        f.write(HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(located)))
+
+    if len(located) == 0:
+        os.remove(temp_pack_path)
+        return None
+
+    sorted_shas = sorted(located)
+    name = "pack-" + hashlib.sha1("".join(sorted_shas).encode()).hexdigest()
+
+    fanout = [0] * 256
+    for sha1 in sorted_shas:
+        fanout[int(sha1[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    temp_index_path = os.path.join(pack_directory, f"tmp_idx_{os.getpid()}_{threading.get_ident()}")
+    with open(temp_index_path, "wb") as f:
+        f.write(HEADER.pack(INDEX_SIGNATURE, PACK_VERSION, len(sorted_shas)))
+        f.write(FANOUT.pack(*fanout))
+        f.write(b"".join(bytes.fromhex(sha1) for sha1 in sorted_shas))
+        f.write(b"".join(ENTRY_FIELD.pack(located[sha1][0]) for sha1 in sorted_shas))
+        f.write(b"".join(ENTRY_FIELD.pack(located[sha1][1]) for sha1 in sorted_shas))
+
+    os.replace(temp_pack_path, os.path.join(pack_directory, f"{name}.pack"))
+    os.replace(temp_index_path, os.path.join(pack_directory, f"{name}.idx"))
+    return name
+
+
+def remove_pack(objects_path: str, name: str):
+    """Removes a pack, its index first so it is never listed without its data"""
+    pack_directory = get_pack_directory(objects_path)
+    os.remove(os.path.join(pack_directory, f"{name}.idx"))
+    os.remove(os.path.join(pack_directory, f"{name}.pack"))
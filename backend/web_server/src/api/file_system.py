@@ -1,8 +1,10 @@
 import os
-import zlib
+import threading
 
 from filelock import FileLock
 
+from backend.packs import read_stored_object, is_stored_object, add_alternate, decompress_object
+
 
 def write_file(path, data, binary_=True):
     """
@@ -22,10 +24,27 @@ def read_file(path, binary_=True) -> bytes or str:
         return f.read()
 
 
+def write_file_atomic(path, data, temp_folder, binary_=True):
+    """
+    Writes a file aside in temp_folder and moves it into place, so readers see either the previous or the new content.
+    temp_folder must be on the same volume as path.
+    """
+    temp_path = os.path.join(temp_folder, f"tmp_{os.getpid()}_{threading.get_ident()}")
+    write_file(temp_path, data, binary_)
+    os.replace(temp_path, path)
+
+
+def resolve_raw_object(main_folder, repo_id, sha1) -> bytes:
+    """Returns the stored data of an object, loose or packed"""
+    data = read_stored_object(os.path.join(main_folder, repo_id, "objects"), sha1)
+    if data is None:
+        raise FileNotFoundError(resolve_object_location(main_folder, repo_id, sha1))
+    return bytes(data)
+
+
 def resolve_object(main_folder, repo_id, sha1) -> bytes:
     """Returns the original content of an object"""
-    path = resolve_object_location(main_folder, repo_id, sha1)
-    return zlib.decompress(bytes(read_file(path, binary_=True)))
+    return decompress_object(resolve_raw_object(main_folder, repo_id, sha1))
 
 
 def resolve_object_location(full_repo, repo_id, obj_hash):
@@ -52,7 +71,7 @@ class FileSystem:
         """Fetch a web_server object from a remote repository"""
         assert len(s) == 2
         assert len(c) == 38
-        if not os.path.exists(os.path.join(self.main_folder, repo_id, "objects", s, c)):
+        if not is_stored_object(os.path.join(self.main_folder, repo_id, "objects"), f"{s}{c}"):
             return None
 
         if is_directory_traversal(os.path.join(self.main_folder, repo_id),
@@ -67,27 +86,24 @@ class FileSystem:
         return os.listdir(os.path.join(self.main_folder, repo_id, "refs", "head"))
 
     def get_head_commit(self, repo_id: str, branch: str):
-        """Gets the current head commit"""
+        """Gets the current head commit. refs are replaced atomically, so reading them takes no lock"""
         head_commit_path = os.path.join(self.main_folder, repo_id, "refs/head", branch)
-        if not os.path.exists(head_commit_path):
+        try:
+            return read_file(head_commit_path, binary_=False)
+        except FileNotFoundError:
             return None
 
-        repo_lock = self.craft_lock(repo_id)
-
-        with repo_lock:
-            cmt = read_file(head_commit_path, binary_=False)
-            return cmt
-
     def set_head_commit(self, repo_id: str, branch: str, hash: str):
-        """Gets the current head commit"""
+        """Sets the current head commit"""
         head_commit_path = os.path.join(self.main_folder, repo_id, "refs/head", branch)
         if not os.path.exists(head_commit_path):
             return None
 
         repo_lock = self.craft_lock(repo_id)
 
+        # The lock serializes writers with the file server compare and swap, readers never wait for it
         with repo_lock:
-            write_file(head_commit_path, hash, binary_=False)
+            write_file_atomic(head_commit_path, hash, os.path.join(self.main_folder, repo_id), binary_=False)
 
     def extract_commit_data(self, repo_id: str, sha1) -> tuple:
         """Extracts the commit data, given its hash value"""
@@ -163,50 +179,18 @@ class FileSystem:
             files_commit.append((tp, hsh, filename))
         return message, files_commit
 
-    def copy_latest_commit(self, from_id: str, to_id: str, branch_name="main"):
-        """Copies the latest commit to another repository"""
-        latest_cmt_hash = self.get_head_commit(from_id, branch_name)
-        tree_hash = self.extract_commit_data(from_id, latest_cmt_hash)[1]
-
-        object_location_to = os.path.join(self.main_folder, to_id, "objects")
-        object_location_from = os.path.join(self.main_folder, from_id, "objects")
-
-        # Add the commit data
-        commit_data = read_file(os.path.join(object_location_from, latest_cmt_hash[:2], latest_cmt_hash[2:]))
-        cmt_path = os.path.join(object_location_to, latest_cmt_hash[:2])
-        if not os.path.exists(cmt_path):
-            os.mkdir(cmt_path)
-        write_file(os.path.join(object_location_to, latest_cmt_hash[:2], latest_cmt_hash[2:]), commit_data)
-
-        # Add the first tree
-        tree_data = read_file(os.path.join(object_location_from, tree_hash[:2], tree_hash[2:]))
-        cmt_path = os.path.join(object_location_to, tree_hash[:2])
-        if not os.path.exists(cmt_path):
-            os.mkdir(cmt_path)
-        write_file(os.path.join(object_location_to, tree_hash[:2], tree_hash[2:]), tree_data)
-
-        def craft_objects(repo_id=from_id, current_hash=tree_hash):
-            if current_hash == "":
-                return
-
-            current_tree_data = resolve_object(self.main_folder, repo_id, current_hash).decode()
-            items = current_tree_data.split("\n")
-            del items[-1]
-            for i in items:
-                tp, hsh, pth = i.split(" ")
-                data = read_file(os.path.join(object_location_from, hsh[:2], hsh[2:]))
-                if not os.path.exists(os.path.join(object_location_to, hsh[:2])):
-                    os.mkdir(os.path.join(object_location_to, hsh[:2]))
-                write_file(os.path.join(object_location_to, hsh[:2], hsh[2:]), data=data, binary_=True)
-
-                if tp == "blob":
-                    continue
-                if tp == "tree":
-                    print('continued')
-                    craft_objects(repo_id, hsh)
+    def link_fork(self, from_id: str, to_id: str, branch_name="main"):
+        """
+        Makes a repository a fork of another one, at its latest commit.
+        The fork borrows the objects of the original repository through its alternates instead of copying them,
+        and only stores the objects pushed to it later. A fork of a fork also borrows from every store the original
+        borrows from, so it never depends on a chain of alternates.
+        """
+        add_alternate(os.path.join(self.main_folder, to_id, "objects"),
+                      os.path.join(self.main_folder, from_id, "objects"))
 
-        craft_objects()
-        self.set_head_commit(to_id, branch=branch_name, hash=latest_cmt_hash)
+        latest_cmt_hash = self.get_head_commit(from_id, branch_name)
+        self.set_head_commit(to_id, branch=branch_name, hash=latest_cmt_hash or "")
 
     def allocate_repository(self, repo_id: str):
         """Allocates a new repository in the filesystem"""
@@ -77,7 +77,7 @@ def fork(username: str, repo_name: str):
 
     db.session.commit()
     file_system.allocate_repository(new_id)
-    file_system.copy_latest_commit(current_repo.id, new_id)
+    file_system.link_fork(current_repo.id, new_id)
     return redirect(url_for(".view_repo", username=current_user.username,
                             repo_name=repo_name))
 
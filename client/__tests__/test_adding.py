@@ -7,6 +7,7 @@ import tempfile
 import unittest
 import shutil
 
+import objects
 import utils
 from client.src.stash import Stash
 from handlers.logger_handler import Logger, TestPrinter
@@ -124,6 +125,39 @@ class BranchingTest(unittest.TestCase):
             self.assertNotIn(filename_1, data)
             self.assertNotIn(".stashignore", data)
 
+    def test_commit_stat_cache(self):
+        """Should record the stat data and blob hash of committed files, and re-hash only changed files"""
+        filename = os.path.join(self.stash.folder_path, utils.generate_random_filename())
+        write_pseudo_data(filename)
+
+        self.stash.add(filename)
+        self.stash.commit("c1")
+
+        with open(os.path.join(self.stash.repo_path, "index", "d"), "rb") as f:
+            size, mtime_ns, inode, first_sha = pickle.load(f)[filename]
+        self.assertEqual(size, os.stat(filename).st_size)
+
+        write_pseudo_data(filename)
+        self.stash.add(filename)
+        self.stash.commit("c2")
+
+        with open(os.path.join(self.stash.repo_path, "index", "d"), "rb") as f:
+            second_sha = pickle.load(f)[filename][3]
+        self.assertNotEqual(first_sha, second_sha)
+
+    def test_commit_skips_existing_objects(self):
+        """Should not write objects that are already stored again"""
+        filename = os.path.join(self.stash.folder_path, utils.generate_random_filename())
+        write_pseudo_data(filename)
+        self.stash.add(filename)
+        self.stash.commit("c1")
+
+        # Touching the file forces it to be hashed again, but its blob already exists
+        os.utime(filename, ns=(os.stat(filename).st_atime_ns, os.stat(filename).st_mtime_ns + 1))
+        self.stash.commit("c2")
+        self.assertEqual(objects.write_statistics.written, 1)  # Only the new commit object
+        self.assertGreaterEqual(objects.write_statistics.skipped, 2)
+
 
 if __name__ == "__main__":
     unittest.main()
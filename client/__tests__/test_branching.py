@@ -98,6 +98,35 @@ class BranchingTest(unittest.TestCase):
         files = [os.path.basename(f) for f in glob.glob(self.test_dir_path + '/**/*.txt', recursive=True)]
         self.assertListEqual(files, ["nested_all.txt", "nested_t.txt", "nested_nested_t.txt"])
 
+    def test_incremental_loading(self):
+        """Should only rewrite the files that differ between the branches"""
+        os.mkdir(os.path.join(self.test_dir_path, "unchanged"))
+        with open(os.path.join(self.test_dir_path, "unchanged", "nested.txt"), "w") as f:
+            f.write("Same in both branches")
+
+        with open(os.path.join(self.test_dir_path, "changed.txt"), "w") as f:
+            f.write("main version")
+
+        self.stash.add(".")
+        self.stash.commit("c1")
+        self.stash.checkout("t", upsert=True)
+
+        with open(os.path.join(self.test_dir_path, "changed.txt"), "w") as f:
+            f.write("t version")
+
+        self.stash.add(".")
+        self.stash.commit("c2")
+
+        with open(os.path.join(self.test_dir_path, "unchanged", "nested.txt"), "w") as f:
+            f.write("Local change in a skipped folder")
+
+        self.stash.checkout("main")
+
+        with open(os.path.join(self.test_dir_path, "changed.txt"), "r") as f:
+            self.assertEqual(f.read(), "main version")
+        with open(os.path.join(self.test_dir_path, "unchanged", "nested.txt"), "r") as f:
+            self.assertEqual(f.read(), "Local change in a skipped folder")
+
     def test_fast_forward(self):
         """Should fast-forward"""
 
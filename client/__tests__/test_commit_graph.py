@@ -0,0 +1,58 @@
+"""
+Module for testing the commit graph
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from client.src.stash import Stash
+from commit_graph import CommitGraph
+from handlers.logger_handler import Logger, TestPrinter
+from utils import write_pseudo_data
+
+
+class CommitGraphTest(unittest.TestCase):
+    """Test ancestry queries of the commit graph."""
+
+    def setUp(self) -> None:
+        self.test_dir_path = tempfile.mkdtemp()
+        self.stash = Stash(self.test_dir_path)
+        self.stash.init()
+        Logger.set_printer(TestPrinter())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir_path)
+
+    def commit_new_file(self, name: str):
+        """Writes a new file, and commits it"""
+        write_pseudo_data(os.path.join(self.test_dir_path, name))
+        self.stash.add(".")
+        return self.stash.commit(name)
+
+    def test_generations_and_ancestry(self):
+        """Should answer ancestry queries of a diverged history, from the commit graph file"""
+        c1 = self.commit_new_file("c1.txt")
+        c2 = self.commit_new_file("c2.txt")
+        self.stash.checkout("hotfix", upsert=True)
+        a1 = self.commit_new_file("a1.txt")
+        self.stash.checkout("main")
+        b1 = self.commit_new_file("b1.txt")
+
+        graph = CommitGraph(self.stash.repo_path)
+        self.assertEqual(len(graph), 4)
+        self.assertEqual(graph.get_generation(c1), 1)
+        self.assertEqual(graph.get_generation(b1), 3)
+        self.assertEqual(graph.get_parent(a1), c2)
+
+        self.assertTrue(graph.is_ancestor(c1, b1))
+        self.assertTrue(graph.is_ancestor(c2, a1))
+        self.assertFalse(graph.is_ancestor(a1, b1))
+        self.assertFalse(graph.is_ancestor(b1, c1))
+
+        self.assertEqual(graph.merge_base(a1, b1), c2)
+        self.assertEqual(graph.merge_base(c1, b1), c1)
+
+
+if __name__ == "__main__":
+    unittest.main()
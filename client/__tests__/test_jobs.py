@@ -0,0 +1,81 @@
+"""
+Module for testing the '--jobs' flag of the commands that hash files
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from client.src.stash import Stash
+from handlers import commit_handler
+from handlers.cli_parser import CLIParser
+from handlers.logger_handler import Logger, TestPrinter
+from utils import write_pseudo_data
+
+
+class RecordingExecutor(commit_handler.ThreadPoolExecutor):
+    """Thread pool that records the amount of workers it was created with"""
+    created = []
+
+    def __init__(self, max_workers=None, *args, **kwargs):
+        RecordingExecutor.created.append(max_workers)
+        super().__init__(max_workers, *args, **kwargs)
+
+
+class JobsTest(unittest.TestCase):
+    """Test parsing '--jobs', and hashing with the requested amount of threads."""
+
+    def setUp(self) -> None:
+        self.test_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        Logger.set_printer(TestPrinter())
+        RecordingExecutor.created = []
+
+    def tearDown(self) -> None:
+        for test_dir in self.test_dirs:
+            shutil.rmtree(test_dir)
+
+    def commit_files(self, test_dir: str, jobs) -> str:
+        """Commits the same files in a new repository, returns the tree hash of the commit"""
+        stash = Stash(test_dir)
+        stash.init()
+        os.mkdir(os.path.join(test_dir, "folder"))
+        for i in range(8):
+            with open(os.path.join(test_dir, "folder" if i % 2 else "", f"file_{i}.txt"), "w") as f:
+                f.write(f"file number {i}")
+        stash.add(".")
+        stash.commit("c1", jobs)
+        head = stash.commit_handler.get_head_commit(stash.branch_name)
+        return stash.commit_handler.extract_commit_data(head).get_tree_hash()
+
+    def test_parse_jobs_flag(self):
+        """Should read the jobs value given after the flag, or after '='"""
+        with mock.patch.object(sys, "argv", ["stash", "commit", "--jobs", "1", "message"]):
+            self.assertEqual(CLIParser().parse_args(), ("commit", ["message"], {"jobs": "1"}))
+        with mock.patch.object(sys, "argv", ["stash", "commit", "--jobs=4", "message"]):
+            self.assertEqual(CLIParser().parse_args(), ("commit", ["message"], {"jobs": "4"}))
+        with mock.patch.object(sys, "argv", ["stash", "checkout", "-b", "name"]):
+            self.assertEqual(CLIParser().parse_args(), ("checkout", ["name"], {"b": True}))
+
+    def test_serial_commit(self):
+        """Should hash with a single thread for '--jobs 1', and produce the same tree as the default"""
+        with mock.patch.object(commit_handler, "ThreadPoolExecutor", RecordingExecutor):
+            serial_tree = self.commit_files(self.test_dirs[0], "1")
+            parallel_tree = self.commit_files(self.test_dirs[1], None)
+
+        self.assertListEqual(RecordingExecutor.created, [1, os.cpu_count()])
+        self.assertEqual(serial_tree, parallel_tree)
+
+    def test_invalid_jobs(self):
+        """Should refuse to commit with a jobs value that is not a positive number"""
+        write_pseudo_data(os.path.join(self.test_dirs[0], "file.txt"))
+        stash = Stash(self.test_dirs[0])
+        stash.init()
+        stash.add(".")
+        self.assertEqual(stash.commit("c1", "0"), "")
+        self.assertIsNone(stash.commit_handler.get_head_commit(stash.branch_name) or None)
+
+
+if __name__ == "__main__":
+    unittest.main()
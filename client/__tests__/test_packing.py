@@ -0,0 +1,122 @@
+"""
+Module for testing the pack storage of the objects database
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import objects
+import packs
+from client.src.stash import Stash
+from handlers.logger_handler import Logger, TestPrinter
+
+
+class PackingTest(unittest.TestCase):
+    """Test packing loose objects, and reading objects from packs."""
+
+    def setUp(self) -> None:
+        self.test_dir_path = tempfile.mkdtemp()
+        self.stash = Stash(self.test_dir_path)
+        self.stash.init()
+        Logger.set_printer(TestPrinter())
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir_path)
+
+    def test_repack_removes_loose_objects(self):
+        """Should move every loose object into a single pack"""
+        with open(os.path.join(self.test_dir_path, "test_file.txt"), "w") as f:
+            f.write("This is my best test case!")
+
+        self.stash.add(".")
+        self.stash.commit("Initial Commit")
+
+        packed = objects.pack_loose_objects(self.stash.repo_path)
+        # blob, tree and commit
+        self.assertEqual(packed, 3)
+        self.assertListEqual(os.listdir(os.path.join(self.stash.repo_path, "objects")), ["pack"])
+
+        loaded = packs.load_packs(self.stash.repo_path)
+        self.assertEqual(len(loaded), 1)
+        self.assertEqual(len(loaded[0]), 3)
+
+    def test_resolve_packed_object(self):
+        """Should resolve packed objects the same way as loose objects"""
+        sha1 = objects.hash_object(self.test_dir_path, b"packed data")
+        objects.pack_loose_objects(self.stash.repo_path)
+
+        self.assertTrue(objects.object_exists(self.stash.repo_path, sha1))
+        self.assertEqual(objects.resolve_object(self.stash.repo_path, sha1), b"packed data")
+        self.assertFalse(objects.object_exists(self.stash.repo_path, "0" * 40))
+        self.assertIsNone(packs.find_packed_object(self.stash.repo_path, "f" * 40))
+
+    def test_reload_keeps_loaded_packs(self):
+        """Should keep the packs loaded before a reload readable, and reuse them"""
+        sha1 = objects.hash_object(self.test_dir_path, b"first pack")
+        objects.pack_loose_objects(self.stash.repo_path)
+        first = packs.load_packs(self.stash.repo_path)
+
+        objects.hash_object(self.test_dir_path, b"second pack")
+        objects.pack_loose_objects(self.stash.repo_path)
+        reloaded = packs.load_packs(self.stash.repo_path)
+
+        self.assertEqual(len(reloaded), 2)
+        self.assertIn(first[0], reloaded)
+        self.assertIsNotNone(first[0].read(sha1))
+
+    def test_stream_large_object(self):
+        """Should hash files in chunks the same way as in memory, and stream objects back from packs"""
+        data = os.urandom(3 * objects.CHUNK_SIZE + 17)
+        path = os.path.join(self.test_dir_path, "large.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+
+        sha1 = objects.hash_file_object(self.test_dir_path, path)
+        self.assertEqual(sha1, objects.hash_object(self.test_dir_path, data))
+
+        objects.pack_loose_objects(self.stash.repo_path)
+        chunks = list(objects.stream_object(self.stash.repo_path, sha1, chunk_size=4096))
+        self.assertTrue(all(len(chunk) <= 4096 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), data)
+
+    def test_lzma_objects(self):
+        """Should compress new objects with the configured codec, and read them back loose or packed"""
+        with open(os.path.join(self.stash.repo_path, "config"), "w") as f:
+            f.write("[core]\ncompression = lzma\ncompressionlevel = 9\n")
+
+        data = b"lzma compressed " * 1024
+        sha1 = objects.hash_object(self.test_dir_path, data)
+        raw = objects.read_raw_object(self.stash.repo_path, sha1)
+        self.assertTrue(raw.startswith(objects.LZMA_MAGIC))
+        self.assertEqual(objects.resolve_object(self.stash.repo_path, sha1), data)
+
+        objects.pack_loose_objects(self.stash.repo_path)
+        self.assertEqual(b"".join(objects.stream_object(self.stash.repo_path, sha1, chunk_size=512)), data)
+
+    def test_checkout_from_packs(self):
+        """Should be able to switch branches when all objects are packed"""
+        with open(os.path.join(self.test_dir_path, "all.txt"), "w") as f:
+            f.write("This is my best test case!")
+
+        self.stash.add(".")
+        self.stash.commit("c1")
+        self.stash.checkout("t", upsert=True)
+
+        with open(os.path.join(self.test_dir_path, "only_t.txt"), "w") as f:
+            f.write("ONLY T")
+
+        self.stash.add(".")
+        self.stash.commit("c2")
+        self.stash.repack()
+
+        self.stash.checkout("main")
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir_path, "only_t.txt")))
+
+        self.stash.checkout("t")
+        with open(os.path.join(self.test_dir_path, "only_t.txt"), "r") as f:
+            self.assertEqual(f.read(), "ONLY T")
+
+
+if __name__ == "__main__":
+    unittest.main()
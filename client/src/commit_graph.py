@@ -0,0 +1,150 @@
+"""
+Module that exports the commit graph, which answers ancestry queries without reading commit objects.
+
+    .stash/commit-graph
+        header:  b"SCGR" version (u32)
+        records: sha (20 bytes) tree (20 bytes) parent position (u32) generation (u32)
+
+Records are only appended, and a parent is always stored before its children.
+The generation of a root commit is 1, and the generation of any other commit is its parent's generation + 1,
+so an ancestor always has a lower generation than its descendants.
+"""
+import os
+import struct
+from array import array
+
+GRAPH_SIGNATURE = b"SCGR"
+GRAPH_VERSION = 1
+
+HEADER = struct.Struct(">4sI")
+RECORD = struct.Struct(">20s20sII")
+NO_PARENT = 0xFFFFFFFF
+
+
+class CommitGraph:
+    """
+    Class representing the commit graph of a repository.
+
+    Attributes:
+        path (str): The path of the commit graph file.
+    """
+
+    def __init__(self, full_repo: str):
+        self.path = os.path.join(full_repo, "commit-graph")
+        self.shas = bytearray()
+        self.trees = bytearray()
+        self.parents = array("I")
+        self.generations = array("I")
+        self.positions = {}
+
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        """Loads the records of the commit graph file"""
+        with open(self.path, "rb") as f:
+            data = f.read()
+
+        signature, version = HEADER.unpack_from(data, 0)
+        if signature != GRAPH_SIGNATURE or version != GRAPH_VERSION:
+            raise ValueError("stash: commit-graph is not a valid commit graph file.")
+
+        records_end = len(data) - (len(data) - HEADER.size) % RECORD.size
+        for sha, tree, parent, generation in RECORD.iter_unpack(data[HEADER.size:records_end]):
+            self._append(sha, tree, parent, generation)
+
+        # A partially written record is dropped, the commit is added again when it is needed
+        if records_end != len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(records_end)
+
+    def _append(self, sha: bytes, tree: bytes, parent: int, generation: int):
+        """Appends a record to the in-memory graph"""
+        self.positions[sha.hex()] = len(self.parents)
+        self.shas += sha
+        self.trees += tree
+        self.parents.append(parent)
+        self.generations.append(generation)
+
+    def __contains__(self, sha1: str):
+        return sha1 in self.positions
+
+    def __len__(self):
+        return len(self.parents)
+
+    def _sha(self, position: int):
+        """Returns the hash of the commit at a position"""
+        return self.shas[position * 20:position * 20 + 20].hex()
+
+    def add(self, sha1: str, parent_sha1: str, tree_sha1: str):
+        """Adds a commit to the graph. its parent, if any, must already be in the graph"""
+        if sha1 in self.positions:
+            return
+
+        parent = self.positions[parent_sha1] if parent_sha1 != "" else NO_PARENT
+        generation = self.generations[parent] + 1 if parent != NO_PARENT else 1
+        record = RECORD.pack(bytes.fromhex(sha1), bytes.fromhex(tree_sha1), parent, generation)
+
+        is_new_file = not os.path.exists(self.path)
+        with open(self.path, "ab") as f:
+            if is_new_file:
+                f.write(HEADER.pack(GRAPH_SIGNATURE, GRAPH_VERSION))
+            f.write(record)
+        self._append(bytes.fromhex(sha1), bytes.fromhex(tree_sha1), parent, generation)
+
+    def ensure(self, sha1: str, load_commit):
+        """
+        Makes sure a commit and all its ancestors are in the graph.
+        load_commit is called with the hash of every missing commit, and should return its Commit.
+        """
+        missing = []
+        pointer = sha1
+        while pointer != "" and pointer not in self.positions:
+            commit = load_commit(pointer)
+            missing.append((pointer, commit))
+            pointer = commit.get_parent_hash()
+
+        for missing_sha1, commit in reversed(missing):
+            self.add(missing_sha1, commit.get_parent_hash(), commit.get_tree_hash())
+
+    def get_generation(self, sha1: str):
+        """Returns the generation number of a commit"""
+        return self.generations[self.positions[sha1]]
+
+    def get_parent(self, sha1: str):
+        """Returns the parent hash of a commit, or an empty string for a root commit"""
+        parent = self.parents[self.positions[sha1]]
+        return self._sha(parent) if parent != NO_PARENT else ""
+
+    def get_tree(self, sha1: str):
+        """Returns the tree hash of a commit"""
+        position = self.positions[sha1]
+        return self.trees[position * 20:position * 20 + 20].hex()
+
+    def is_ancestor(self, ancestor_sha1: str, sha1: str):
+        """Returns True or False whether ancestor_sha1 is sha1 or one of its ancestors"""
+        target = self.positions[ancestor_sha1]
+        pointer = self.positions[sha1]
+        target_generation = self.generations[target]
+
+        # Commits with a lower or equal generation cannot have the target as a strict ancestor
+        while pointer != NO_PARENT and self.generations[pointer] > target_generation:
+            pointer = self.parents[pointer]
+        return pointer == target
+
+    def merge_base(self, sha1: str, other_sha1: str):
+        """Returns the nearest common ancestor of two commits, or an empty string if they have none"""
+        if sha1 == "" or other_sha1 == "":
+            return ""
+        first = self.positions[sha1]
+        second = self.positions[other_sha1]
+
+        # Always walk back the commit with the higher generation, until both pointers meet
+        while first != second:
+            if first == NO_PARENT or second == NO_PARENT:
+                return ""
+            if self.generations[first] >= self.generations[second]:
+                first = self.parents[first]
+            else:
+                second = self.parents[second]
+        return self._sha(first) if first != NO_PARENT else ""
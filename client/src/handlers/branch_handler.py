@@ -27,6 +27,12 @@ class BranchHandler:
         if branch_exists:
             os.remove(branch_head_path)
 
+    def _load_commit(self, sha1: str):
+        """Loads a commit for the commit graph, downloading it if it isn't stored locally"""
+        if not objects.object_exists(self.stash_path, sha1):
+            self.remote_handler.download_remote_object(sha1)
+        return self.commit_handler.extract_commit_data(sha1)
+
     def can_fast_forward(self, from_branch_name: str, to_branch_name: str):
         """Check if commit2 is an ancestor of target."""
         #             from
@@ -34,29 +40,25 @@ class BranchHandler:
         #                   to
 
         target = self.commit_handler.get_head_commit(from_branch_name)
-
         commit2 = self.commit_handler.get_head_commit(to_branch_name)
-        tree_hash = self.commit_handler.extract_commit_data(commit2)
-        pointer = tree_hash.get_parent_hash()
-
-        while pointer != "":
-            if pointer == target:
-                return True
-            if not os.path.exists(os.path.join(self.stash_path, "object", pointer[:2], pointer[2:])):
-                self.remote_handler.download_remote_object(pointer)
-            pointer = self.commit_handler.extract_commit_data(pointer).get_parent_hash()
+        if target == "" or target == commit2:
+            return False
 
-        return False
+        commit_graph = self.commit_handler.get_commit_graph()
+        commit_graph.ensure(target, self._load_commit)
+        commit_graph.ensure(commit2, self._load_commit)
+        return commit_graph.is_ancestor(target, commit2)
 
     def local_fast_forward_merge(self, local_branch_name: str, local_branch_name2: str):
         """Fast-Forward merge between 2 local branches. local_branch_name -> local_branch_name2. Assumes they can be
         fast-forwarded merge """
 
+        from_commit = self.commit_handler.get_head_commit(local_branch_name)
         to_commit = self.commit_handler.get_head_commit(local_branch_name2)
         write_file(os.path.join(self.stash_path, "refs", "head", local_branch_name), to_commit, binary_=False)
-        self.load_branch(local_branch_name)
+        self.load_branch(local_branch_name, from_commit)
 
-    def local_three_way_merge(self, current_branch_name: str, to_branch_name: str):
+    def local_three_way_merge(self, current_branch_name: str, to_branch_name: str, jobs=None):
         """
         Three-way-merge between 2 local branches, which are diverge from an original commit.
         Assumes the branches have different commit.
@@ -76,24 +78,10 @@ class BranchHandler:
             exit(1)
 
         # Find the intersection point of the two branches
-        pnt1 = current_latest_head
-        pnt2 = head_2
-
-        mutual_commit_hash = None
-
-        while pnt1 != pnt2:
-            if pnt1 == "":
-                pnt1 = head_2
-
-            if pnt2 == "":
-                pnt2 = current_latest_head
-
-            pnt1 = self.commit_handler.extract_commit_data(pnt1).get_parent_hash()
-            pnt2 = self.commit_handler.extract_commit_data(pnt2).get_parent_hash()
-
-            if pnt1 == pnt2:
-                mutual_commit_hash = pnt2
-                break
+        commit_graph = self.commit_handler.get_commit_graph()
+        commit_graph.ensure(current_latest_head, self._load_commit)
+        commit_graph.ensure(head_2, self._load_commit)
+        mutual_commit_hash = commit_graph.merge_base(current_latest_head, head_2)
 
         if mutual_commit_hash == "":
             Logger.error("stash: couldn't merge branches. No mutual commit was found.")
@@ -103,37 +91,30 @@ class BranchHandler:
         # If there are changes at the same file, throw an error saying there's a conflict.
         # We will deal with conflicts later.
 
-        latest_current_changes = self.commit_handler.find_diff(mutual_commit_hash, current_latest_head)
-        other_changes = self.commit_handler.find_diff(mutual_commit_hash, head_2).split("\n")
-        del other_changes[-1]
-
-        apply_changes = latest_current_changes.split("\n")
-        del apply_changes[-1]
-        apply_changes_set = set(apply_changes)
-
-        changes = []
+        latest_current_changes = {obj.get_path(): obj.get_hash()
+                                  for obj in self.commit_handler.find_diff(mutual_commit_hash, current_latest_head)}
 
         # Check for changes, if there are changes for the same file. throw an error of conflict.
-        for x in other_changes:
-            tp, hsh, pth = x.split(" ")
-            changes.append((tp, hsh, pth))
-            if pth in apply_changes_set and tp == "blob":
-                raise NotImplementedError(f"Conflicts are not handled yet. conflict in {pth}.")
+        changes = []
+        for obj in self.commit_handler.find_diff(mutual_commit_hash, head_2):
+            changes.append(obj)
+            current_hash = latest_current_changes.get(obj.get_path())
+            if obj.get_type() == "blob" and current_hash is not None and current_hash != obj.get_hash():
+                raise NotImplementedError(f"Conflicts are not handled yet. conflict in {obj.get_path()}.")
 
         # Upload other_changes files
         # Commit all files
         # Reload branch
 
         for change in changes:
-            file_type, file_hash, file_path = change
-            abs_path = os.path.join(self.folder_path, file_path)
-            if file_type == "tree" and not os.path.exists(abs_path):
+            abs_path = os.path.join(self.folder_path, change.get_path())
+            if change.get_type() == "tree" and not os.path.exists(abs_path):
                 os.mkdir(abs_path)
-            if file_type == "blob":
-                write_file(abs_path, objects.resolve_object(self.stash_path, file_hash), binary_=True)
+            if change.get_type() == "blob":
+                objects.write_object_to_file(self.stash_path, change.get_hash(), abs_path)
 
-        self.commit_handler.commit(f"Merge {to_branch_name} -> {current_branch_name}", current_branch_name)
-        self.load_branch(current_branch_name)
+        self.commit_handler.commit(f"Merge {to_branch_name} -> {current_branch_name}", current_branch_name, jobs=jobs)
+        self.load_branch(current_branch_name, current_latest_head)
 
     def create_branch(self, name: str, last_commit_sha: str):
         """Creates a branch"""
@@ -153,15 +134,26 @@ class BranchHandler:
         branches_dir = os.listdir(os.path.join(self.stash_path, "refs", "head"))
         return branches_dir
 
-    def load_branch(self, branch_name: str):
-        """Loads up a branch. Assuming branch_name is a valid branch."""
+    def load_branch(self, branch_name: str, from_commit: str = None):
+        """
+        Loads up a branch. Assuming branch_name is a valid branch.
+        If from_commit is given, the working tree is assumed to match it, so subtrees that are the same in both
+        commits are skipped, and only the differing paths are written or deleted.
+        """
         current_cmt = self.commit_handler.get_head_commit(branch_name)
         commit_data = self.commit_handler.extract_commit_data(current_cmt)
+        from_tree_hash = None
+        if from_commit:
+            from_tree_hash = self.commit_handler.extract_commit_data(from_commit).get_tree_hash()
+
+        def apply_commit_tree(tree_hash: str, from_hash: str | None, pth=self.folder_path,
+                              folder_path_length=len(self.folder_path) + 1):
+            """Applies a commit tree to the cwd, given the tree the cwd currently matches"""
+            if tree_hash == from_hash:
+                return
 
-        def apply_commit_tree(tree_hash: str, pth=self.folder_path, folder_path_length=len(self.folder_path) + 1):
-            """Applies a commit tree to the cwd"""
-            tree_object = objects.resolve_object(self.stash_path, tree_hash).decode()
-            parsed_tree = Tree.parse_tree(tree_object)
+            parsed_tree = Tree.load(self.stash_path, tree_hash)
+            parsed_from_tree = Tree.load(self.stash_path, from_hash) if from_hash is not None else {}
 
             to_be_deleted = []
             for i in os.listdir(pth):
@@ -183,12 +175,17 @@ class BranchHandler:
             for key, obj in parsed_tree.items():
                 # Note that key is a path, something like folder/file. then we need only the file
                 file_location = os.path.join(self.folder_path, key)
+                previous = parsed_from_tree.get(key)
+                previous_hash = None
+                if previous is not None and previous.get_type() == obj.get_type():
+                    previous_hash = previous.get_hash()
+
                 if obj.get_type() == "tree":
                     if not os.path.exists(file_location):
                         os.mkdir(file_location)
-                    apply_commit_tree(obj.get_hash(), pth=file_location)
-                else:
-                    data = objects.resolve_object(self.stash_path, obj.get_hash())
-                    write_file(file_location, data=data, binary_=True)
+                        previous_hash = None
+                    apply_commit_tree(obj.get_hash(), previous_hash, pth=file_location)
+                elif obj.get_hash() != previous_hash or not os.path.exists(file_location):
+                    objects.write_object_to_file(self.stash_path, obj.get_hash(), file_location)
 
-        apply_commit_tree(commit_data.get_tree_hash())
+        apply_commit_tree(commit_data.get_tree_hash(), from_tree_hash)
@@ -42,7 +42,7 @@ class CLIHandler:
             self.__stash.init()
 
         if cmd == "commit":
-            self.__stash.commit(params[0])
+            self.__stash.commit(params[0], flags.get("jobs"))
 
         if cmd == "checkout":
             self.__stash.checkout(params[0], flags.get("b", False))
@@ -57,7 +57,7 @@ class CLIHandler:
             self.__stash.branch(params, flags)
 
         if cmd == "merge":
-            self.__stash.merge(params[0])
+            self.__stash.merge(params[0], flags.get("jobs"))
 
         if cmd == "clone":
             self.__stash.clone(params[0])
@@ -67,3 +67,6 @@ class CLIHandler:
 
         if cmd == "remote":
             self.__stash.remote(params)
+
+        if cmd == "repack":
+            self.__stash.repack()
@@ -20,6 +20,10 @@ def register_command(num_of_params):
     return decorator
 
 
+# Flags that take a value, given either as '--name=value' or as '--name value'
+VALUE_FLAGS = ("jobs",)
+
+
 class CLIParser:
     """Class handles cli parser"""
 
@@ -61,10 +65,14 @@ class CLIParser:
         flags = {}
         params = []
 
-        # parse the flags
-        for _, val in enumerate(sys.argv[1::]):
+        # parse the flags, '--name=value' flags keep their value
+        args = iter(sys.argv[1::])
+        for val in args:
             if val.startswith("-"):
-                flags[val.lstrip("-")] = True
+                name, _, value = val.lstrip("-").partition("=")
+                if not value and name in VALUE_FLAGS:
+                    value = next(args, "")
+                flags[name] = value if value else True
             else:
                 params.append(val)
         return cmd, params, flags
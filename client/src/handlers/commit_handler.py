@@ -1,11 +1,15 @@
 """
 Module that exposes the CommitHandler class, which handles all things related to commits
 """
+import itertools
 import os
 import pickle
 import sys
+from concurrent.futures import ThreadPoolExecutor, Future
 
+import object_cache
 import objects
+from commit_graph import CommitGraph
 from handlers.logger_handler import Logger
 from handlers.remote_connection_handler import RemoteConnectionHandler
 from models.commit import Commit
@@ -21,24 +25,44 @@ class CommitHandler:
         self.full_repo = full_repo
         self.repo = repo
         self.remote_handler = remote_handler
+        self.commit_graph = None
+
+    def get_commit_graph(self) -> CommitGraph:
+        """Returns the commit graph of the repository, loading it on first use"""
+        if self.commit_graph is None:
+            self.commit_graph = CommitGraph(self.full_repo)
+        return self.commit_graph
 
     def generate_prep_file(self, tree_hash: str):
         """
-        Returns a preparefile for the given commit.
+        Yields the preparefile entries of the given tree.
         prepfile contains all directories, subdirectories and files that the commit contains.
         """
-        tree_data_encoded = objects.resolve_object(self.full_repo, tree_hash)
-        tree = Tree.parse_tree(tree_data_encoded.decode())
-        file = f"{tree_hash} tree\n"
-        for key, obj in tree.items():
-            if obj.get_type() == "tree":
-                file += self.generate_prep_file(obj.get_hash())
-            else:
-                file += f"{obj.get_hash()} {obj.get_type()}\n"
-        return file
+        yield TreeNode("", tree_hash, type_="tree")
+        yield from Tree.traverse_tree(self.full_repo, tree_hash)
+
+    def roll_back_commits(self, commit_hash: str, stop_hash: str):
+        """Yields the commits from commit_hash back to stop_hash (excluded), or to the first commit"""
+        while commit_hash != stop_hash and commit_hash != "":
+            yield TreeNode("", commit_hash, type_="commit")
+            commit_hash = self.extract_commit_data(commit_hash).get_parent_hash()
+
+    def get_recent_commits(self, commit_hash: str, limit: int) -> list[str]:
+        """Returns up to limit commits, from commit_hash back through its ancestors"""
+        commit_graph = self.get_commit_graph()
+        commit_graph.ensure(commit_hash, self.extract_commit_data)
+
+        commits = []
+        while commit_hash != "" and len(commits) < limit:
+            commits.append(commit_hash)
+            commit_hash = commit_graph.get_parent(commit_hash)
+        return commits
 
     def find_diff(self, commit1_sha: str, commit2_sha: str, remote_=False, remote_branch="main", local_branch="main"):
-        """Finds the diff between two commits. given their hashes"""
+        """
+        Finds the diff between two commits. given their hashes
+        Returns an iterator of TreeNode entries, which is consumed lazily.
+        """
         if not remote_:
             cmt1_data = self.extract_commit_data(commit1_sha)
             cmt2_data = self.extract_commit_data(commit2_sha)
@@ -50,128 +74,84 @@ class CommitHandler:
         if remote_head_commit == "":
             Logger.println("stash: Remote repository is empty. Fetching resources...")
             current_commit = self.extract_commit_data(self.get_head_commit(local_branch))
-            d = self.generate_prep_file(current_commit.get_tree_hash()) + f"{commit1_sha} commit\n"
-            return d
+            return itertools.chain(self.generate_prep_file(current_commit.get_tree_hash()),
+                                   self.roll_back_commits(commit1_sha, ""))
+
+        remote_tree_hash = None
+        if objects.object_exists(self.full_repo, remote_head_commit):
+            remote_tree_hash = self.extract_commit_data(remote_head_commit).get_tree_hash()
 
-        remote_data = self.remote_handler.resolve_remote_commit_data(remote_head_commit)
+        if remote_tree_hash is None or not objects.object_exists(self.full_repo, remote_tree_hash):
+            # The remote history is unknown locally, so the server tells which of the local objects it is missing
+            Logger.println("stash: Remote head is unknown locally. Negotiating missing objects...")
+            return self.remote_handler.filter_missing_objects(
+                itertools.chain(self.generate_prep_file(local_data.get_tree_hash()),
+                                self.roll_back_commits(commit1_sha, "")))
 
-        if remote_data.get_tree_hash() == local_data.get_tree_hash():
+        if remote_tree_hash == local_data.get_tree_hash():
             Logger.println("stash: No changes were found.")
             exit(1)
 
-        def roll_back_commits(commit_hash: str):
-            """Returns a list of all commits that aren't available on the server"""
-            if commit_hash == remote_head_commit or commit_hash == "":
-                return []
-            cmt_data = self.extract_commit_data(commit_hash)
-            return [f"{commit_hash} commit\n"] + roll_back_commits(cmt_data.get_parent_hash())
-
-        return self._remote_find_tree_diffs(remote_data.get_tree_hash(), local_data.get_tree_hash())\
-               + "".join(roll_back_commits(commit1_sha))
-
-    def compare_remote_with_local(self, local_hash: str, remote_hash: str):
-        """compares the remote data to the local repo, and returns the changes to download locally"""
-        if local_hash == remote_hash:
-            return ""
-
-        lines = f"{remote_hash} tree\n"
-        parsed_local_data = objects.resolve_object(self.full_repo, local_hash).decode()
-        parsed_remote_data = self.remote_handler.resolve_remote_object(remote_hash)
-
-        parsed_remote = Tree.parse_tree(parsed_remote_data)
-        parsed_local = Tree.parse_tree(parsed_local_data)
-
-        for key, obj in parsed_remote.items():
-            if key not in parsed_local:
-                lines += f"{obj.get_hash()} {obj.get_type()}\n"
-                continue
-
-            if obj.get_hash() != parsed_local.get(key).get_hash():
-                if obj.get_type() == "blob":
-                    lines += f"{obj.get_hash()} {obj.get_type()}\n"
-                elif obj.get_type() == "tree":
-                    lines += f"{obj.get_hash()} tree\n" + \
-                             self.compare_remote_with_local(parsed_local.get(key).get_hash(), obj.get_hash())
-                continue
-        return lines
+        return itertools.chain(self._remote_find_tree_diffs(remote_tree_hash, local_data.get_tree_hash()),
+                               self.roll_back_commits(commit1_sha, remote_head_commit))
 
     def _remote_find_tree_diffs(self, remote_hash: str, local_hash: str):
         """
-        Creates a prepfile based on remote-local diffs.
-        h1: local tree hash
-        h2: remote tree hash
+        Yields prepfile entries based on remote-local diffs, computed from the local copy of the remote tree.
+        Remote subtrees that aren't stored locally are treated as missing, and sent in full.
         """
-        if local_hash == remote_hash:
-            return ""
-        lines = f"{local_hash} tree\n"
-
-        # Check if object exists local, to decrease traffic
-        if os.path.exists(objects.resolve_object_location(self.full_repo, remote_hash)):
-            remote_data = objects.resolve_object(self.full_repo, remote_hash).decode()
-        else:
-            remote_data = self.remote_handler.resolve_remote_object(remote_hash)
-        local_data = objects.resolve_object(self.full_repo, local_hash).decode()
-
-        parsed_remote = Tree.parse_tree(remote_data)
-        parsed_local = Tree.parse_tree(local_data)
-
-        for key, obj in parsed_local.items():
-            if key not in parsed_remote:
-                Logger.println(f"+ {key}\n")
-                lines += f"{obj.get_hash()} {obj.get_type()}\n"
-                continue
-
-            if obj.get_hash() != parsed_remote.get(key).get_hash():
-                if obj.get_type() == "blob":
-                    Logger.println(f"~ {key}\n")
-                    lines += f"{obj.get_hash()} {obj.get_type()}\n"
-                elif obj.get_type() == "tree":
-                    lines += f"{obj.get_hash()} tree\n" + \
-                             self._remote_find_tree_diffs(parsed_remote.get(key).get_hash(), obj.get_hash())
+        stack = [(remote_hash, local_hash)]
+        while len(stack) > 0:
+            remote_hash, local_hash = stack.pop()
+            if local_hash == remote_hash:
                 continue
+            yield TreeNode("", local_hash, type_="tree")
+
+            parsed_remote = {}
+            if objects.object_exists(self.full_repo, remote_hash):
+                parsed_remote = Tree.load(self.full_repo, remote_hash)
+            parsed_local = Tree.load(self.full_repo, local_hash)
+
+            for key, obj in parsed_local.items():
+                if key not in parsed_remote:
+                    Logger.println(f"+ {key}\n")
+                    yield obj
+                    if obj.get_type() == "tree":
+                        yield from Tree.traverse_tree(self.full_repo, obj.get_hash())
+                    continue
 
-        for key, obj in parsed_remote.items():
-            if key not in parsed_local:
-                Logger.println(f"- {key}\n")
+                if obj.get_hash() != parsed_remote.get(key).get_hash():
+                    if obj.get_type() == "blob":
+                        Logger.println(f"~ {key}\n")
+                        yield obj
+                    elif obj.get_type() == "tree":
+                        stack.append((parsed_remote.get(key).get_hash(), obj.get_hash()))
 
-        return lines
+            for key, obj in parsed_remote.items():
+                if key not in parsed_local:
+                    Logger.println(f"- {key}\n")
 
     def _local_find_tree_diffs(self, h1: str, h2: str):
-        """Returns the diff between trees"""
-        if h1 == h2:  # Same object
-            return ""
-        lines = ""
-        h1_data = objects.resolve_object(self.full_repo, h1).decode()
-        h2_data = objects.resolve_object(self.full_repo, h2).decode()
-
-        parsed_h1 = Tree.parse_tree(h1_data)
-        parsed_h2 = Tree.parse_tree(h2_data)
-
-        for key, obj in parsed_h2.items():
-            if key not in parsed_h1:
-                if obj.get_type() == "blob":
-                    lines += f"{obj.get_type()} {obj.get_hash()} {obj.get_path()}\n"
-                if obj.get_type() == "tree":
-                    lines += f"{obj.get_type()} {obj.get_hash()} {obj.get_path()}\n" + \
-                             Tree.traverse_tree(self.full_repo, obj.get_hash())
-                continue
-
-            if obj.get_hash() != parsed_h1.get(key).get_hash():
-                if obj.get_type() == "blob":
-                    lines += f"{obj.get_type()} {obj.get_hash()} {obj.get_path()}\n"
-                elif obj.get_type() == "tree":
-                    lines += f"{obj.get_type()} {obj.get_hash()} {obj.get_path()}\n" + \
-                             self._local_find_tree_diffs(parsed_h1.get(key).get_hash(), obj.get_hash())
+        """Yields the entries of h2 that differ from h1, trees before their entries"""
+        stack = [(h1, h2)]
+        while len(stack) > 0:
+            h1, h2 = stack.pop()
+            if h1 == h2:  # Same object
                 continue
+            parsed_h1 = Tree.load(self.full_repo, h1)
+            parsed_h2 = Tree.load(self.full_repo, h2)
+
+            for key, obj in parsed_h2.items():
+                if key not in parsed_h1:
+                    yield obj
+                    if obj.get_type() == "tree":
+                        yield from Tree.traverse_tree(self.full_repo, obj.get_hash())
+                    continue
 
-        # for key, obj in parsed_h1.items():
-        # if key not in parsed_h2:
-        # if obj.get_type() == "blob":
-        # lines += f"-{key}\n"
-        # if obj.get_type() == "tree":
-        # lines += f"-{key}\n"
-
-        return lines
+                if obj.get_hash() != parsed_h1.get(key).get_hash():
+                    yield obj
+                    if obj.get_type() == "tree":
+                        stack.append((parsed_h1.get(key).get_hash(), obj.get_hash()))
 
     def get_head_commit(self, branch_name):
         """Returns the head commit hash by branch name"""
@@ -180,9 +160,37 @@ class CommitHandler:
             raise FileNotFoundError("Branch cannot be found")
         return read_file(pth, binary_=False)
 
-    def create_tree(self, files: dict, path_length, current_):
-        """Creates a new commit tree"""
-        entries = []
+    def get_cached_blob_hash(self, files: dict, full_path: str, stat: os.stat_result, index_mtime: int):
+        """
+        Returns the blob hash stored in the index for a file, or None if the file needs to be hashed again.
+        The stored hash is used only if the stat data of the file didn't change since it was hashed.
+        """
+        cached = files.get(full_path)
+        if not isinstance(cached, tuple):
+            return None
+
+        # A file modified at the same time the index was written may change again without a visible mtime change
+        if cached[:3] != (stat.st_size, stat.st_mtime_ns, stat.st_ino) or stat.st_mtime_ns >= index_mtime:
+            return None
+        return cached[3]
+
+    def hash_file(self, full_path: str):
+        """Reads, hashes and stores a working tree file as a blob"""
+        return objects.hash_file_object(self.repo, full_path)
+
+    def create_tree(self, files: dict, path_length, current_, index_mtime=0, jobs=None):
+        """
+        Creates a new commit tree.
+        Changed files are read, hashed and compressed by a pool of 'jobs' threads, the number of processors by default,
+        while the trees themselves are assembled in the working tree order.
+        """
+        with ThreadPoolExecutor(max_workers=jobs if jobs is not None else os.cpu_count()) as executor:
+            pending = self._scan_tree(files, path_length, current_, index_mtime, executor)
+            return self._write_tree(files, path_length, pending)
+
+    def _scan_tree(self, files: dict, path_length, current_, index_mtime, executor: ThreadPoolExecutor):
+        """Scans a working tree folder, and submits the files that need to be hashed to the executor"""
+        pending = []
         for it in os.scandir(current_):
             if it.name == ".stash":
                 continue
@@ -190,52 +198,60 @@ class CommitHandler:
             if full_path not in files:
                 continue
             if it.is_file():
-                sha1 = objects.hash_object(self.repo, read_file(full_path))
-                leaf = TreeNode(full_path[path_length + 1::], sha1)
-                entries.append(leaf)
+                stat = it.stat()
+                sha1 = self.get_cached_blob_hash(files, full_path, stat, index_mtime)
+                if sha1 is None:
+                    sha1 = executor.submit(self.hash_file, full_path)
+                pending.append((full_path, stat, sha1))
             else:
                 if len(os.listdir(full_path)) == 0:
                     continue
-                new_sha1, new_entries = self.create_tree(files, path_length, full_path)
+                pending.append((full_path, None, self._scan_tree(files, path_length, full_path, index_mtime, executor)))
+        return pending
+
+    def _write_tree(self, files: dict, path_length, pending: list):
+        """Waits for the hashed files of a scanned folder, and writes its tree object"""
+        entries = []
+        for full_path, stat, content in pending:
+            if stat is None:
+                new_sha1, new_entries = self._write_tree(files, path_length, content)
                 entries.append(Tree(full_path[path_length + 1::], new_sha1, new_entries))
+                continue
 
-        final_str = ""
-        for i in entries:
-            final_str += f"{i.get_type()} {i.get_hash()} {i.get_path()}\n"
+            if isinstance(content, Future):
+                content = content.result()
+                files[full_path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, content)
+            entries.append(TreeNode(full_path[path_length + 1::], content))
 
+        final_str = "".join([f"{i.get_type()} {i.get_hash()} {i.get_path()}\n" for i in entries])
         sha1 = objects.hash_object(self.repo, final_str.encode(), type_="tree")
 
         return sha1, entries
 
-    def extract_commit_data(self, sha1) -> Commit:
+    def extract_commit_data(self, sha1, full_repo: str = None) -> Commit:
         """
         Extracts the commit data, given its hash value
         :param sha1: commit hash value
+        :param full_repo: the repository to read from, defaults to the current one
         :return: the commit data as Commit
         """
-        cmt = objects.resolve_object(self.full_repo, sha1).decode()
-        lines = cmt.split("\n")
-        del lines[2]
-
-        assert lines[0][0:6] == "parent"
-        parent_hash = lines[0][7::]
+        full_repo = full_repo if full_repo is not None else self.full_repo
+        return object_cache.commits.get_or_load(
+            sha1, lambda: Commit.parse_commit(objects.resolve_object(full_repo, sha1).decode()))
 
-        assert lines[1][0:4] == "tree"
-        tree_hash = lines[1][5::]
-
-        message = lines[2]
-
-        return Commit(message, tree_hash=tree_hash, parent=parent_hash)
-
-    def commit(self, message: str, branch_name: str):
-        """commits the changes and saves them"""
+    def commit(self, message: str, branch_name: str, jobs=None):
+        """commits the changes and saves them, hashing changed files with 'jobs' threads"""
 
         # create the path to the indexes file, and read it
         index_path = os.path.join(self.full_repo, "index", "d")
         indices = pickle.loads(read_file(index_path))
+        index_mtime = os.stat(index_path).st_mtime_ns
+        objects.write_statistics.reset()
 
-        # create the tree
-        tree_sha, _tree = self.create_tree(indices, len(self.repo), current_=self.repo)
+        # create the tree, and save the refreshed stat data of the hashed files
+        tree_sha, _tree = self.create_tree(indices, len(self.repo), current_=self.repo,
+                                            index_mtime=index_mtime, jobs=jobs)
+        write_file(index_path, pickle.dumps(indices))
 
         # read the parent file
         parent = self.get_head_commit(branch_name)
@@ -243,6 +259,11 @@ class CommitHandler:
         cmt = Commit(message, tree_sha, parent)
         sha1 = objects.hash_object(self.repo, str(cmt).encode(), type_="commit")
 
+        # keep the commit graph up to date, the parent may be missing if it was pulled
+        commit_graph = self.get_commit_graph()
+        commit_graph.ensure(parent, self.extract_commit_data)
+        commit_graph.add(sha1, parent, tree_sha)
+
         # save the new tree to the current commit
         write_file(os.path.join(self.full_repo, "refs/head",
                                 branch_name), sha1, binary_=False)
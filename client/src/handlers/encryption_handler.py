@@ -1,35 +1,108 @@
+import hashlib
+import hmac
+import os
+import struct
 import zlib
 
 from pyDH import pyDH
 from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
+
+# Frames are prefixed with their length, as a big-endian u32, and followed by the AES-GCM tag:
+#   length | ciphertext | tag
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+TAG_SIZE = 16
+
+# Nonces are the sending direction followed by a frame counter, so a nonce is never reused with the same key,
+# and dropped, replayed or reordered frames fail to authenticate
+NONCE = struct.Struct(">IQ")
+CLIENT_DIRECTION = 1
+SERVER_DIRECTION = 2
 
 
 class EncryptionHandler:
     def __init__(self, socket):
         self.socket = socket
         self.df = None
-        self.aes = None
+        self.key = None
+        self.send_counter = 0
+        self.receive_counter = 0
+        self.buffer = bytearray(64 * 1024)
+
+    def exchange_keys(self, session: tuple[str, str] = None) -> bool:
+        """
+        Exchange keys between parties, and create a shared key.
+        If a (ticket, key) session is given, it is resumed first, which skips the key exchange.
+        Returns True or False whether the session was resumed.
+        """
+        if session is not None:
+            ticket, key = session
+            client_nonce = os.urandom(16)
+            self.socket.send(f"resume {ticket} {client_nonce.hex()}".encode())
+            response = self.socket.recv(1024).decode()
+            if response.startswith("ok "):
+                server_nonce = bytes.fromhex(response[3:])
+                self.generate_aes(hmac.new(bytes.fromhex(key), client_nonce + server_nonce, hashlib.sha256).hexdigest())
+                return True
 
-    def exchange_keys(self):
-        """Exchange keys between parties, and create a shared key"""
         self.df = pyDH.DiffieHellman()
         self.socket.send(str(self.df.gen_public_key()).encode())
         server_pub = int(self.socket.recv(1024).decode())
         shared = self.df.gen_shared_key(server_pub)
         self.generate_aes(shared)
+        return False
 
     def generate_aes(self, shared: str):
         """Creates aes symmetric key"""
-        self.aes = AES.new(bytes.fromhex(shared), AES.MODE_ECB)
+        self.key = bytes.fromhex(shared)
+        self.send_counter = 0
+        self.receive_counter = 0
+
+    def _next_cipher(self, sending: bool):
+        """Creates the AES-GCM cipher of the next frame in a direction"""
+        if sending:
+            nonce = NONCE.pack(CLIENT_DIRECTION, self.send_counter)
+            self.send_counter += 1
+        else:
+            nonce = NONCE.pack(SERVER_DIRECTION, self.receive_counter)
+            self.receive_counter += 1
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
 
-    def decrypt_incoming_packet(self) -> bytes:
+    def recv_exact(self, size: int) -> memoryview:
+        """Receives exactly size bytes into the reusable receive buffer, and returns a view of them"""
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view = memoryview(self.buffer)[:size]
+        received = 0
+        while received < size:
+            count = self.socket.recv_into(view[received:], size - received)
+            if count == 0:
+                raise ConnectionError("stash: Connection was closed by the remote.")
+            received += count
+        return view
+
+    def decrypt_incoming_packet(self) -> bytearray:
         """Decrypts incoming packets, uses recv"""
-        encrypted_data_length = self.socket.recv(4)
-        encrypted_data = self.socket.recv(int(encrypted_data_length))
-        return unpad(self.aes.decrypt(encrypted_data), 32)
-
-    def encrypt_packet(self, data: bytes) -> bytes:
-        """Encrypts the packet, and prefixes with the length"""
-        encrypted_data = self.aes.encrypt(pad(data, 32))
-        return f"{str(len(encrypted_data)).zfill(4)}".encode() + encrypted_data
+        encrypted_data_length = FRAME_HEADER.unpack(self.recv_exact(FRAME_HEADER.size))[0]
+        if encrypted_data_length > MAX_FRAME_SIZE or encrypted_data_length < TAG_SIZE:
+            raise ValueError("stash: Incoming packet has an invalid size.")
+
+        cipher = self._next_cipher(sending=False)
+        data = bytearray(encrypted_data_length - TAG_SIZE)
+        cipher.decrypt(self.recv_exact(len(data)), output=data)
+        try:
+            cipher.verify(self.recv_exact(TAG_SIZE))
+        except ValueError:
+            raise ConnectionError("stash: Received a corrupted packet.")
+        return data
+
+    def encrypt_packet(self, data: bytes) -> bytearray:
+        """Encrypts the packet in place of the returned frame, and prefixes it with the length"""
+        frame = bytearray(FRAME_HEADER.size + len(data) + TAG_SIZE)
+        FRAME_HEADER.pack_into(frame, 0, len(data) + TAG_SIZE)
+
+        cipher = self._next_cipher(sending=True)
+        view = memoryview(frame)
+        cipher.encrypt(data, output=view[FRAME_HEADER.size:FRAME_HEADER.size + len(data)])
+        view[FRAME_HEADER.size + len(data):] = cipher.digest()
+        return frame
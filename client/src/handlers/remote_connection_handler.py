@@ -3,11 +3,14 @@ import socket
 import zlib
 import getpass
 import configparser
+import itertools
+import pickle
+import time
 
 import objects
+import packs
 from handlers.encryption_handler import EncryptionHandler
 from handlers.logger_handler import Logger
-from models.commit import Commit
 
 
 def parse_pkt(data: bytes, bypass_decompress=False) -> (str, str):
@@ -25,6 +28,36 @@ def parse_pkt(data: bytes, bypass_decompress=False) -> (str, str):
     return header, zlib.decompress(data[6 + header_length::]).decode()
 
 
+def parse_compressed_pack_entries(chunks):
+    """
+    Yields the (sha, data) entries of a compressed packfile received in chunks.
+    Entries are yielded as soon as all of their data was decompressed, so only the current entry is held in memory.
+    """
+    ENTRY_HEADER_SIZE = 41 + PACK_ENTRY_LENGTH_DIGITS
+    decompressor = zlib.decompressobj()
+    pending = bytearray()
+
+    def take_entries():
+        index = 0
+        while len(pending) - index >= ENTRY_HEADER_SIZE:
+            start = index + ENTRY_HEADER_SIZE
+            length = int(pending[index + 41:start].decode())
+            if len(pending) < start + length + 1:  # Including the trailing newline
+                break
+            yield pending[index:index + 40].decode(), bytes(pending[start:start + length])
+            index = start + length + 1
+        del pending[:index]
+
+    for chunk in chunks:
+        pending += decompressor.decompress(chunk)
+        yield from take_entries()
+    pending += decompressor.flush()
+    yield from take_entries()
+
+    if not decompressor.eof or len(pending) > 0:
+        raise ConnectionError("stash: Packfile stream was truncated.")
+
+
 def create_pkt_line(command_name: str, data: str | bytes):
     """Encodes the data to pkt line format"""
     command_name_length = str(len(command_name)).zfill(4)
@@ -36,6 +69,19 @@ def create_pkt_line(command_name: str, data: str | bytes):
     return d
 
 
+# Maximum amount of object hashes checked in a single stash-filter-objects command
+FILTER_OBJECTS_PER_REQUEST = 4096
+
+# Maximum amount of requests sent before their responses are read
+PIPELINE_WINDOW = 16
+
+# Largest data sent in a single packet, bigger payloads are split to stream packets
+MAX_PACKET_DATA_SIZE = 4 * 1024 * 1024
+
+# Digits of the length of every packfile entry, enough for objects of any practical size
+PACK_ENTRY_LENGTH_DIGITS = 16
+
+
 class RemoteConnectionHandler:
     """Handles remote repository connections, and provides useful functions."""
 
@@ -64,7 +110,8 @@ class RemoteConnectionHandler:
             self.reload_local_remotes()
         remotes = []
         for key in self.config.sections():
-            remotes.append(key[8:len(key) - 1])
+            if key.startswith('remote "'):
+                remotes.append(key[8:len(key) - 1])
         return remotes
 
     def add_remote(self, remote_name: str, url: str, path: str = None):
@@ -104,68 +151,174 @@ class RemoteConnectionHandler:
             quit(1)
         return self.config[f'remote "{remote_name}"']
 
-    def generate_pack_file(self, prep_file: str):
-        """Generates a packfile from a prep file
-        prep files usually look like:
-
-        sha1 type
+    def generate_pack_file(self, prep_file):
         """
-        pack_file = b""
-        prep_file = prep_file.split("\n")
-        del prep_file[-1]
-
-        MAX_DIGIT_SIZE = 8  # 12mb
-        for row in prep_file:
-            sha, obj_type = row.split(" ")
-            loc = objects.resolve_object_location(self.full_repo, sha)
-            data = objects.read_file(loc, binary_=True)
-            pack_file += f"{sha} {str(len(data)).zfill(MAX_DIGIT_SIZE)}".encode() + data + "\n".encode()
-
-        return zlib.compress(pack_file)
+        Yields the compressed packfile of the TreeNode entries of a prep file, in chunks of about
+        MAX_PACKET_DATA_SIZE bytes. Objects are streamed from the database, so memory stays constant.
+        """
+        # The objects are already compressed, the pack itself only needs the fastest level
+        compressor = zlib.compressobj(zlib.Z_BEST_SPEED)
+        pending = []
+        pending_size = 0
+        sent = set()
+
+        for obj in prep_file:
+            sha = obj.get_hash()
+            if sha in sent:
+                continue
+            sent.add(sha)
+
+            size, chunks = objects.stream_raw_object(self.full_repo, sha)
+            header = f"{sha} {str(size).zfill(PACK_ENTRY_LENGTH_DIGITS)}".encode()
+            entry = itertools.chain([header], chunks, ["\n".encode()])
+            for part in entry:
+                compressed = compressor.compress(part)
+                if compressed:
+                    pending.append(compressed)
+                    pending_size += len(compressed)
+                if pending_size >= MAX_PACKET_DATA_SIZE:
+                    yield b"".join(pending)
+                    pending, pending_size = [], 0
+
+        pending.append(compressor.flush())
+        yield b"".join(pending)
+
+    def push_stream(self, code: str, chunks):
+        """Sends chunks to the server as stream packets as they are produced, followed by the code"""
+        for chunk in chunks:
+            self.socket.sendall(self.handler.encrypt_packet(create_pkt_line("stash-send-stream", chunk)))
+        self.socket.sendall(self.handler.encrypt_packet(create_pkt_line(code, "end")))
+        return self.read_response()
 
     def push_pkt(self, code: str, obj: bytes | str):
         """Sends a pkt file to the server"""
-        if len(obj) > 8000:  # Check if data is bigger than max buffer size
-            index = 0
-            while index < len(obj):
-                self.socket.send(
-                    self.handler.encrypt_packet(create_pkt_line("stash-send-stream", obj[index:index + 1010])))
-                index += 1010
-            self.socket.send(self.handler.encrypt_packet(create_pkt_line(code, "end")))
-            return
+        if len(obj) > MAX_PACKET_DATA_SIZE:  # Check if data is bigger than max packet size
+            return self.push_stream(code, (obj[index:index + MAX_PACKET_DATA_SIZE]
+                                           for index in range(0, len(obj), MAX_PACKET_DATA_SIZE)))
 
-        else:
-            pkt = create_pkt_line(code, obj)
-            self.socket.send(self.handler.encrypt_packet(pkt))
+        pkt = create_pkt_line(code, obj)
+        self.socket.sendall(self.handler.encrypt_packet(pkt))
+        return self.read_response()
 
+    def read_response(self):
+        """Reads the server response of a command, and exits if it failed"""
         response_code, data = parse_pkt(self.handler.decrypt_incoming_packet())
         if response_code != "stash-ok":
             print(data)
             exit(1)
         return data
 
-    def download_remote_object(self, sha: str):
-        """Download remote data"""
+    def download_remote_object(self, sha: str, path: str = None):
+        """Download remote data, to the given repository or the current one"""
         data = self.resolve_remote_object(sha, bypass_decompress=True)
-        fd_path = os.path.join(self.full_repo, "objects", sha[:2])
-        if not os.path.exists(fd_path):
-            os.mkdir(fd_path)
+        objects.write_raw_object(path if path is not None else self.full_repo, sha, data)
+
+    def download_remote_pack(self, branch: str, path: str = None, haves: list[str] = ()):
+        """
+        Download a pack of the objects reachable from a remote branch head, to the given repository or the current
+        one. The entries are decompressed and written to a local pack as the stream packets arrive, then indexed.
+        haves are local commits, the server only sends the objects that are missing since the newest of them.
+        """
+        request = "\n".join([branch, *haves])
+        self.socket.sendall(self.handler.encrypt_packet(create_pkt_line("stash-receive-packfile", request)))
+        entries = parse_compressed_pack_entries(self.receive_stream_chunks("stash-send-packfile"))
+        return packs.write_pack(path if path is not None else self.full_repo, entries)
+
+    def filter_missing_objects(self, prep_file) -> list:
+        """Returns the TreeNode entries of a prep file whose objects are missing on the server"""
+        entries = list(prep_file)
+        batches = [entries[index:index + FILTER_OBJECTS_PER_REQUEST]
+                   for index in range(0, len(entries), FILTER_OBJECTS_PER_REQUEST)]
+
+        requests = (("stash-filter-objects", "\n".join(entry.get_hash() for entry in batch)) for batch in batches)
+        missing = []
+        for batch, (command_name, data) in zip(batches, self.pipeline(requests)):
+            self.expect_response(command_name, data, "stash-send-object")
+            missing_hashes = set(data.decode().split("\n"))
+            missing.extend(entry for entry in batch if entry.get_hash() in missing_hashes)
+        return missing
+
+    def pipeline(self, requests, window: int = PIPELINE_WINDOW):
+        """
+        Sends (command name, data) requests without waiting for their responses, keeping up to window of them
+        outstanding. Yields the (command name, data) responses, in the order of the requests.
+        """
+        requests = iter(requests)
+        outstanding = 0
+        while True:
+            frames = [self.handler.encrypt_packet(create_pkt_line(command_name, data))
+                      for command_name, data in itertools.islice(requests, window - outstanding)]
+            if len(frames) > 0:
+                # The new requests go out together, in as few syscalls as possible
+                self.socket.sendall(b"".join(frames))
+                outstanding += len(frames)
+            if outstanding == 0:
+                return
+
+            yield self.receive_response()
+            outstanding -= 1
+
+    def receive_response(self) -> (str, bytes):
+        """Receives a response that may be split to stream packets, and returns its command name and joined data"""
+        chunks = []
+        while True:
+            command_name, data = parse_pkt(self.handler.decrypt_incoming_packet(), bypass_decompress=True)
+            chunks.append(data)
+            if command_name != "stash-send-stream":
+                return command_name, b"".join(chunks)
+
+    def expect_response(self, command_name: str, data: bytes, expected_code: str):
+        """Exits with the server message if a response isn't the expected one"""
+        if command_name != expected_code:
+            Logger.println(data.decode())
+            self.close()
+
+    def receive_stream_chunks(self, expected_code: str):
+        """Yields the data of a response that may be split to stream packets, packet by packet"""
+        while True:
+            command_name, data = parse_pkt(self.handler.decrypt_incoming_packet(), bypass_decompress=True)
+            if command_name == "stash-send-stream":
+                yield data
+                continue
+            self.expect_response(command_name, data, expected_code)
+            yield data
+            return
+
+    def load_sessions(self) -> dict:
+        """Returns the cached session tickets, by username, dropping the expired ones"""
+        sessions_path = os.path.join(self.full_repo, "sessions")
+        if not os.path.exists(sessions_path):
+            return {}
+        sessions = pickle.loads(objects.read_file(sessions_path))
+        return {username: session for username, session in sessions.items() if session[2] > time.time()}
+
+    def save_session(self, username: str, ticket: str, expiry: int):
+        """Caches the session ticket of a user, so the next connections can resume it"""
+        if not os.path.isdir(self.full_repo):
+            return
+        sessions = self.load_sessions()
+        sessions[username] = (ticket, self.handler.key.hex(), expiry)
 
-        objects.write_file(os.path.join(fd_path, sha[2:]), data, binary_=True)
+        # The cache holds session keys, so it is readable only by its owner
+        sessions_path = os.path.join(self.full_repo, "sessions")
+        fd = os.open(sessions_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(pickle.dumps(sessions))
 
     def connect(self, repo_fingerprint: str | None, branch: str = None):
         """Connect to remote web_server"""
         self.socket.connect(('127.0.0.1', 8838))
 
-        self.handler.exchange_keys()
-
         username = repo_fingerprint if repo_fingerprint else input("stash: Please provide your stash fingerprint (ex: "
                                                                    "username@repository.stash): ")
         remote_branch = branch if branch else input("stash: Input your remote branch name (ex 'main'): ")
 
-        password = getpass.getpass(f"{username}'s password: ")
+        # A cached session ticket skips both the key exchange and the password
+        session = self.load_sessions().get(username)
+        resumed = self.handler.exchange_keys(session[:2] if session is not None else None)
+        password = "" if resumed else getpass.getpass(f"{username}'s password: ")
 
-        self.socket.send(
+        self.socket.sendall(
             self.handler.encrypt_packet(create_pkt_line("stash-login", f"{username}@{remote_branch}@{password}")))
 
         pkt_command, pkt_data = parse_pkt(self.handler.decrypt_incoming_packet())
@@ -173,6 +326,12 @@ class RemoteConnectionHandler:
             print(pkt_data)
             self.close()
 
+        # stash: login successful\n<ticket> <expiry>
+        lines = pkt_data.split("\n")
+        if len(lines) > 1:
+            ticket, expiry = lines[1].split(" ")
+            self.save_session(username, ticket, int(expiry))
+
     def close(self):
         """Closes the connection to the web_server"""
         self.socket.close()
@@ -181,7 +340,7 @@ class RemoteConnectionHandler:
     def get_remote_head_commit(self, branch: str):
         """Get remote head commit"""
 
-        self.socket.send(self.handler.encrypt_packet(create_pkt_line("stash-receive-head-commit", branch)))
+        self.socket.sendall(self.handler.encrypt_packet(create_pkt_line("stash-receive-head-commit", branch)))
 
         command_name, data = parse_pkt(self.handler.decrypt_incoming_packet())
         if command_name != "stash-send-object":
@@ -191,7 +350,7 @@ class RemoteConnectionHandler:
 
     def resolve_remote_object(self, sha1: str, bypass_decompress=False):
         """Resolve a remote object"""
-        self.socket.send(self.handler.encrypt_packet(create_pkt_line("stash-receive-object", sha1)))
+        self.socket.sendall(self.handler.encrypt_packet(create_pkt_line("stash-receive-object", sha1)))
 
         temp = self.handler.decrypt_incoming_packet()
         command_name, data = parse_pkt(temp, bypass_decompress=bypass_decompress)
@@ -200,17 +359,3 @@ class RemoteConnectionHandler:
             self.close()
         return data
 
-    def resolve_remote_commit_data(self, sha1):
-        cmt = self.resolve_remote_object(sha1)
-        lines = cmt.split("\n")
-        del lines[2]
-
-        assert lines[0][0:6] == "parent"
-        parent_hash = lines[0][7::]
-
-        assert lines[1][0:4] == "tree"
-        tree_hash = lines[1][5::]
-
-        message = lines[2]
-
-        return Commit(message, tree_hash=tree_hash, parent=parent_hash)
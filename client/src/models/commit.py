@@ -18,6 +18,22 @@ class Commit:
         self.hash = tree_hash
         self.message = message
 
+    @classmethod
+    def parse_commit(cls, commit_data: str) -> "Commit":
+        """Parse a commit"""
+        lines = commit_data.split("\n")
+        del lines[2]
+
+        assert lines[0][0:6] == "parent"
+        parent_hash = lines[0][7::]
+
+        assert lines[1][0:4] == "tree"
+        tree_hash = lines[1][5::]
+
+        message = lines[2]
+
+        return Commit(message, tree_hash=tree_hash, parent=parent_hash)
+
     def get_message(self):
         """get commit's message"""
         return self.message
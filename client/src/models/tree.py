@@ -1,6 +1,7 @@
 """
 Module that exports the tree class
 """
+import object_cache
 import objects
 from .tree_node import TreeNode
 
@@ -31,16 +32,24 @@ class Tree(TreeNode):
         return parsing
 
     @classmethod
-    def traverse_tree(cls, full_repo, tree_hash: str):
-        """Traverses a tree and returns all of it's contents"""
+    def load(cls, full_repo, tree_hash: str) -> dict[str, TreeNode]:
+        """Returns a parsed tree object, through the shared trees cache. the result must not be modified"""
+        return object_cache.trees.get_or_load(
+            tree_hash, lambda: cls.parse_tree(objects.resolve_object(full_repo, tree_hash).decode()))
 
-        tree_data_encoded = objects.resolve_object(full_repo, tree_hash)
-        tree = Tree.parse_tree(tree_data_encoded.decode())
-        lines = ""
-        for key, obj in tree.items():
+    @classmethod
+    def traverse_tree(cls, full_repo, tree_hash: str):
+        """
+        Traverses a tree and yields all of it's contents, trees before their entries.
+        The walk uses an explicit stack, so its memory is bounded by the tree depth and width.
+        """
+        stack = [iter(cls.load(full_repo, tree_hash).values())]
+        while len(stack) > 0:
+            obj = next(stack[-1], None)
+            if obj is None:
+                stack.pop()
+                continue
+
+            yield obj
             if obj.get_type() == "tree":
-                lines += cls.traverse_tree(full_repo, obj.get_hash())
-            else:
-                lines += f"{obj.get_type()} {obj.get_hash()} {obj.get_path()}\n"
-
-        return lines
+                stack.append(iter(cls.load(full_repo, obj.get_hash()).values()))
@@ -0,0 +1,59 @@
+"""
+Module that exports the process-wide caches of parsed objects.
+Objects are immutable and addressed by their hash, so cached entries never need to be invalidated.
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Class representing a thread-safe, size-bounded least recently used cache.
+
+    Attributes:
+        max_size (int): The maximum amount of entries kept in the cache.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value of a key, or default if it is not cached"""
+        with self.lock:
+            if key not in self.entries:
+                return default
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        """Caches a value, evicting the least recently used entry if the cache is full"""
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value of a key, loading and caching it if it is missing"""
+        value = self.get(key)
+        if value is None:
+            # Loading happens outside the lock, two threads may load the same object but the result is identical
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """Removes all the cached entries"""
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Parsed trees (dict of path to TreeNode) and commits (Commit), keyed by their hash.
+# Cached values are shared, and must be treated as read-only.
+trees = LRUCache(max_size=8192)
+commits = LRUCache(max_size=8192)
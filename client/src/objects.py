@@ -1,10 +1,25 @@
 """
 Module that exports multi object related functions
 """
+import configparser
 import hashlib
+import lzma
 import os
+import threading
 import zlib
 
+import packs
+
+CHUNK_SIZE = 1024 * 1024
+
+# Objects carry their codec in their own stream header, xz streams start with LZMA_MAGIC and anything else is zlib
+CODECS = ("zlib", "lzma")
+LZMA_MAGIC = b"\xfd7zXZ\x00"
+DEFAULT_LEVELS = {"zlib": zlib.Z_DEFAULT_COMPRESSION, "lzma": 6}
+
+# config path -> (config mtime, (codec, level))
+_compression_settings = {}
+
 
 def write_file(path, data, binary_=True):
     """
@@ -24,26 +39,279 @@ def read_file(path, binary_=True) -> bytes or str:
         return f.read()
 
 
+class WriteStatistics:
+    """
+    Class counting the objects written to the database.
+
+    Attributes:
+        written (int): The amount of objects that were compressed and written.
+        skipped (int): The amount of writes that were skipped, since the object was already stored.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+
+    def record(self, written: bool):
+        """Records an object write, or a skipped one"""
+        with self.lock:
+            if written:
+                self.written += 1
+            else:
+                self.skipped += 1
+
+    def reset(self):
+        """Resets the counters"""
+        with self.lock:
+            self.written = 0
+            self.skipped = 0
+
+
+write_statistics = WriteStatistics()
+
+
+def get_compression(full_repo) -> (str, int):
+    """
+    Returns the codec and level used to compress new objects, from the 'core' section of the config:
+
+    [core]
+    compression = zlib | lzma
+    compressionlevel = 0-9
+    """
+    config_path = os.path.join(full_repo, "config")
+    try:
+        mtime = os.stat(config_path).st_mtime_ns
+    except FileNotFoundError:
+        return "zlib", DEFAULT_LEVELS["zlib"]
+
+    cached = _compression_settings.get(config_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    codec = config.get("core", "compression", fallback="zlib")
+    if codec not in CODECS:
+        raise ValueError(f"stash: unknown compression '{codec}', expected one of {', '.join(CODECS)}.")
+    level = config.getint("core", "compressionlevel", fallback=DEFAULT_LEVELS[codec])
+    if level not in range(0, 10) and level != DEFAULT_LEVELS[codec]:
+        raise ValueError(f"stash: compression level must be between 0 and 9, got {level}.")
+
+    _compression_settings[config_path] = mtime, (codec, level)
+    return codec, level
+
+
+def compress(data, codec="zlib", level=zlib.Z_DEFAULT_COMPRESSION) -> bytes:
+    """Compresses object data with the given codec"""
+    if codec == "lzma":
+        return lzma.compress(data, preset=level)
+    return zlib.compress(data, level)
+
+
+def get_compressor(codec="zlib", level=zlib.Z_DEFAULT_COMPRESSION):
+    """Returns a streaming compressor of the given codec, with compress and flush methods"""
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=level)
+    return zlib.compressobj(level)
+
+
+def decompress(data) -> bytes:
+    """Decompresses object data, with the codec recorded in its header"""
+    if bytes(data[:len(LZMA_MAGIC)]) == LZMA_MAGIC:
+        return lzma.decompress(data)
+    return zlib.decompress(data)
+
+
+def get_decompressor(first_chunk):
+    """Returns a streaming decompressor for an object, given its first compressed chunk"""
+    if bytes(first_chunk[:len(LZMA_MAGIC)]) == LZMA_MAGIC:
+        return lzma.LZMADecompressor()
+    return zlib.decompressobj()
+
+
 def hash_object(repo, data, type_="blob"):
     """
-    Hashes an object and writes the data to the database
+    Hashes an object and writes the data to the database.
+    Objects that are already stored, loose or packed, are not compressed or written again.
     """
     header = f"{type_}{len(data)}".encode()
     full_data = header + b'\x00' + data
     sha1 = hashlib.sha1(full_data).hexdigest()
+    if object_exists(os.path.join(repo, ".stash"), sha1):
+        write_statistics.record(written=False)
+        return sha1
+
+    temp_path = get_temp_object_path(repo)
+    write_file(temp_path, compress(data, *get_compression(os.path.join(repo, ".stash"))))
+    store_temp_object(repo, temp_path, sha1)
+    write_statistics.record(written=True)
+    return sha1
+
+
+def hash_file_object(repo, path, type_="blob"):
+    """
+    Hashes a file and writes its data to the database.
+    Large files are hashed first, and compressed in a second pass only if the object isn't stored yet.
+    Both passes work in fixed size chunks, so large files are never fully loaded to the memory.
+    """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= CHUNK_SIZE:
+            return hash_object(repo, f.read(), type_=type_)
+
+        header = f"{type_}{size}".encode() + b'\x00'
+        hasher = hashlib.sha1(header)
+        read_size = 0
+        while chunk := f.read(CHUNK_SIZE):
+            read_size += len(chunk)
+            hasher.update(chunk)
+        sha1 = hasher.hexdigest()
+
+        if read_size != size:
+            # The file was changed while it was read, hash its current content instead
+            return hash_object(repo, read_file(path), type_=type_)
+
+        if object_exists(os.path.join(repo, ".stash"), sha1):
+            write_statistics.record(written=False)
+            return sha1
+
+        temp_path = get_temp_object_path(repo)
+        f.seek(0)
+        hasher = hashlib.sha1(header)
+        compressor = get_compressor(*get_compression(os.path.join(repo, ".stash")))
+        with open(temp_path, "wb") as temp:
+            while chunk := f.read(CHUNK_SIZE):
+                hasher.update(chunk)
+                temp.write(compressor.compress(chunk))
+            temp.write(compressor.flush())
+
+    if hasher.hexdigest() != sha1:
+        # The file was changed between the two passes, hash its current content instead
+        os.remove(temp_path)
+        return hash_object(repo, read_file(path), type_=type_)
+
+    store_temp_object(repo, temp_path, sha1)
+    write_statistics.record(written=True)
+    return sha1
+
+
+def get_temp_object_path(repo):
+    """Returns a temporary path to write an object to, before its hash is known"""
+    return os.path.join(repo, ".stash", "objects", f"tmp_{os.getpid()}_{threading.get_ident()}")
+
+
+def store_temp_object(repo, temp_path, sha1):
+    """Moves a written temporary object to its location in the database"""
     path = os.path.join(repo, ".stash", "objects", sha1[:2], sha1[2:])
     if not os.path.exists(path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
-    write_file(path, zlib.compress(data))
-    return sha1
+    # The same object may be written by several hashing threads at once, so it is replaced atomically
+    os.replace(temp_path, path)
+
+
+def write_raw_object(full_repo, sha1, data):
+    """Stores the already compressed data of an object, unless the object is already stored"""
+    if object_exists(full_repo, sha1):
+        return
+    path = os.path.join(full_repo, "objects", sha1[:2], sha1[2:])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = os.path.join(full_repo, "objects", f"tmp_{os.getpid()}_{threading.get_ident()}")
+    write_file(temp_path, data)
+    os.replace(temp_path, path)
 
 
 def resolve_object(full_repo, sha1) -> bytes:
     """Returns the original content of an object"""
-    path = resolve_object_location(full_repo, sha1)
-    return zlib.decompress(bytes(read_file(path, binary_=True)))
+    return decompress(read_raw_object(full_repo, sha1))
+
+
+def stream_raw_object(full_repo, sha1, chunk_size=CHUNK_SIZE):
+    """Returns the length of the compressed content of an object, and a generator of its compressed chunks"""
+    size = packs.packed_object_size(full_repo, sha1)
+    if size is not None:
+        return size, packs.stream_packed_object(full_repo, sha1, chunk_size)
+    return os.path.getsize(resolve_object_location(full_repo, sha1)), _stream_loose_object(full_repo, sha1, chunk_size)
+
+
+def stream_object(full_repo, sha1, chunk_size=CHUNK_SIZE):
+    """Yields the original content of an object, in chunks of at most chunk_size bytes"""
+    compressed_chunks = packs.stream_packed_object(full_repo, sha1, chunk_size)
+    if compressed_chunks is None:
+        compressed_chunks = _stream_loose_object(full_repo, sha1, chunk_size)
+
+    decompressor = None
+    for compressed in compressed_chunks:
+        if decompressor is None:
+            decompressor = get_decompressor(compressed)
+
+        if isinstance(decompressor, lzma.LZMADecompressor):
+            data = decompressor.decompress(compressed, chunk_size)
+            while data:
+                yield data
+                if decompressor.needs_input or decompressor.eof:
+                    break
+                data = decompressor.decompress(b"", chunk_size)
+            continue
+
+        data = decompressor.decompress(compressed, chunk_size)
+        while data:
+            yield data
+            data = decompressor.decompress(decompressor.unconsumed_tail, chunk_size)
+
+    if decompressor is not None and not isinstance(decompressor, lzma.LZMADecompressor):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def _stream_loose_object(full_repo, sha1, chunk_size):
+    """Yields the compressed content of a loose object"""
+    with open(resolve_object_location(full_repo, sha1), "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def write_object_to_file(full_repo, sha1, path):
+    """Writes the original content of an object to a file, without loading all of it to the memory"""
+    with open(path, "wb") as f:
+        for chunk in stream_object(full_repo, sha1):
+            f.write(chunk)
+
+
+def read_raw_object(full_repo, sha1) -> bytes:
+    """Returns the compressed content of an object, looking in the packs before the loose objects"""
+    data = packs.find_packed_object(full_repo, sha1)
+    if data is not None:
+        return data
+    return bytes(read_file(resolve_object_location(full_repo, sha1), binary_=True))
+
+
+def object_exists(full_repo, sha1) -> bool:
+    """Returns True or False whether the object is stored, packed or loose"""
+    return packs.is_packed_object(full_repo, sha1) or os.path.exists(resolve_object_location(full_repo, sha1))
 
 
 def resolve_object_location(full_repo, obj_hash):
     """resolves an object hash to its path on the disk"""
     return os.path.join(full_repo, "objects", obj_hash[:2], obj_hash[2:])
+
+
+def pack_loose_objects(full_repo) -> int:
+    """Consolidates all loose objects into a single pack, returns the amount of packed objects"""
+    objects_path = os.path.join(full_repo, "objects")
+    loose = []
+    for fanout in os.scandir(objects_path):
+        if len(fanout.name) != 2 or not fanout.is_dir():
+            continue
+        for entry in os.scandir(fanout.path):
+            loose.append((fanout.name + entry.name, entry.path))
+
+    packs.write_pack(full_repo, ((sha1, read_file(path)) for sha1, path in loose))
+
+    for _, path in loose:
+        os.remove(path)
+    for fanout in {os.path.dirname(path) for _, path in loose}:
+        if len(os.listdir(fanout)) == 0:
+            os.rmdir(fanout)
+    return len(loose)
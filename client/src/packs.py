@@ -0,0 +1,233 @@
+"""
+Module that exports the pack storage of the objects database.
+
+A pack consolidates the compressed data of many objects into a single file,
+next to a sorted index that is read through mmap:
+
+    pack-<name>.pack
+        header:  b"SPCK" version (u32) count (u32)
+        data:    compressed object data, one entry after the other
+
+    pack-<name>.idx
+        header:  b"SIDX" version (u32) count (u32)
+        fanout:  256 x u32, the number of objects whose first sha byte is <= i
+        shas:    count x 20 bytes, sorted
+        offsets: count x u64, offset of each object in the pack
+        lengths: count x u64, length of each object in the pack
+"""
+import hashlib
+import mmap
+import os
+import struct
+import threading
+
+PACK_SIGNATURE = b"SPCK"
+INDEX_SIGNATURE = b"SIDX"
+PACK_VERSION = 1
+
+HEADER = struct.Struct(">4sII")
+FANOUT = struct.Struct(">256I")
+ENTRY_FIELD = struct.Struct(">Q")
+SHA_SIZE = 20
+
+# pack directory -> (directory mtime, loaded packs)
+_loaded_packs = {}
+
+
+def get_pack_directory(full_repo: str):
+    """Returns the directory where the packs of a repository are stored"""
+    return os.path.join(full_repo, "objects", "pack")
+
+
+class PackIndex:
+    """
+    Class representing an opened pack and its index.
+
+    Attributes:
+        name (str): The name of the pack, without extension.
+        count (int): The number of objects in the pack.
+    """
+
+    def __init__(self, pack_directory: str, name: str):
+        self.name = name
+        with open(os.path.join(pack_directory, f"{name}.idx"), "rb") as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(os.path.join(pack_directory, f"{name}.pack"), "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        signature, version, self.count = HEADER.unpack_from(self.index, 0)
+        if signature != INDEX_SIGNATURE or version != PACK_VERSION:
+            raise ValueError(f"stash: '{name}.idx' is not a valid pack index.")
+
+        self.fanout = FANOUT.unpack_from(self.index, HEADER.size)
+        self.shas_start = HEADER.size + FANOUT.size
+        self.offsets_start = self.shas_start + self.count * SHA_SIZE
+        self.lengths_start = self.offsets_start + self.count * ENTRY_FIELD.size
+
+    def _position(self, raw_sha: bytes):
+        """Binary searches the index for a sha, returns its position or -1"""
+        first_byte = raw_sha[0]
+        low = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self.fanout[first_byte]
+        while low < high:
+            mid = (low + high) // 2
+            start = self.shas_start + mid * SHA_SIZE
+            current = self.index[start:start + SHA_SIZE]
+            if current == raw_sha:
+                return mid
+            if current < raw_sha:
+                low = mid + 1
+            else:
+                high = mid
+        return -1
+
+    def _entry(self, position: int):
+        """Returns the offset and length of the entry at a position"""
+        offset = ENTRY_FIELD.unpack_from(self.index, self.offsets_start + position * ENTRY_FIELD.size)[0]
+        length = ENTRY_FIELD.unpack_from(self.index, self.lengths_start + position * ENTRY_FIELD.size)[0]
+        return offset, length
+
+    def __contains__(self, sha1: str):
+        return self._position(bytes.fromhex(sha1)) != -1
+
+    def __len__(self):
+        return self.count
+
+    def read(self, sha1: str) -> bytes | None:
+        """Returns the compressed data of an object, or None if it is not in the pack"""
+        position = self._position(bytes.fromhex(sha1))
+        if position == -1:
+            return None
+        offset, length = self._entry(position)
+        return self.pack[offset:offset + length]
+
+    def stream(self, sha1: str, chunk_size: int):
+        """Yields the compressed data of an object in chunks, or returns None if it is not in the pack"""
+        position = self._position(bytes.fromhex(sha1))
+        if position == -1:
+            return None
+        offset, length = self._entry(position)
+        return (self.pack[start:min(start + chunk_size, offset + length)]
+                for start in range(offset, offset + length, chunk_size))
+
+    def size(self, sha1: str) -> int | None:
+        """Returns the length of the compressed data of an object, or None if it is not in the pack"""
+        position = self._position(bytes.fromhex(sha1))
+        if position == -1:
+            return None
+        return self._entry(position)[1]
+
+    def shas(self):
+        """Yields all the object hashes in the pack, sorted"""
+        for position in range(self.count):
+            start = self.shas_start + position * SHA_SIZE
+            yield self.index[start:start + SHA_SIZE].hex()
+
+
+def load_packs(full_repo: str) -> list[PackIndex]:
+    """
+    Returns the packs of a repository, reloading them only when the pack directory changes.
+    Replaced packs are not closed, threads that still read them keep a valid mapping until they drop it.
+    """
+    pack_directory = get_pack_directory(full_repo)
+    try:
+        mtime = os.stat(pack_directory).st_mtime_ns
+    except FileNotFoundError:
+        return []
+
+    cached = _loaded_packs.get(pack_directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    # Packs are immutable, so the ones that are still listed are reused and only new packs are mapped
+    opened = {pack.name: pack for pack in cached[1]} if cached is not None else {}
+    packs = []
+    for entry in sorted(os.listdir(pack_directory)):
+        name, extension = os.path.splitext(entry)
+        # The index is written last, so a pack is usable only once its index exists
+        if extension == ".idx" and os.path.exists(os.path.join(pack_directory, f"{name}.pack")):
+            packs.append(opened[name] if name in opened else PackIndex(pack_directory, name))
+
+    _loaded_packs[pack_directory] = mtime, packs
+    return packs
+
+
+def find_packed_object(full_repo: str, sha1: str) -> bytes | None:
+    """Returns the compressed data of a packed object, or None if no pack contains it"""
+    for pack in load_packs(full_repo):
+        data = pack.read(sha1)
+        if data is not None:
+            return data
+    return None
+
+
+def stream_packed_object(full_repo: str, sha1: str, chunk_size: int):
+    """Returns a generator of the compressed chunks of a packed object, or None if no pack contains it"""
+    for pack in load_packs(full_repo):
+        chunks = pack.stream(sha1, chunk_size)
+        if chunks is not None:
+            return chunks
+    return None
+
+
+def packed_object_size(full_repo: str, sha1: str) -> int | None:
+    """Returns the length of the compressed data of a packed object, or None if no pack contains it"""
+    for pack in load_packs(full_repo):
+        size = pack.size(sha1)
+        if size is not None:
+            return size
+    return None
+
+
+def is_packed_object(full_repo: str, sha1: str) -> bool:
+    """Returns True or False whether any pack contains the object"""
+    return any(sha1 in pack for pack in load_packs(full_repo))
+
+
+def write_pack(full_repo: str, entries) -> str | None:
+    """
+    Writes a pack and its index from (sha1, compressed data) entries.
+    Returns the name of the new pack, or None if there were no entries.
+    """
+    pack_directory = get_pack_directory(full_repo)
+    os.makedirs(pack_directory, exist_ok=True)
+    temp_pack_path = os.path.join(pack_directory, f"tmp_pack_{os.getpid()}_{threading.get_ident()}")
+
+    located = {}
+    with open(temp_pack_path, "wb") as f:
+        f.write(HEADER.pack(PACK_SIGNATURE, PACK_VERSION, 0))
+        offset = HEADER.size
+        for sha1, data in entries:
+            if sha1 in located:
+                continue
+            f.write(data)
+            located[sha1] = offset, len(data)
+            offset += len(data)
+
+        f.seek(0)
+        f.write(HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(located)))
+
+    if len(located) == 0:
+        os.remove(temp_pack_path)
+        return None
+
+    sorted_shas = sorted(located)
+    name = "pack-" + hashlib.sha1("".join(sorted_shas).encode()).hexdigest()
+
+    fanout = [0] * 256
+    for sha1 in sorted_shas:
+        fanout[int(sha1[:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    temp_index_path = os.path.join(pack_directory, f"tmp_idx_{os.getpid()}_{threading.get_ident()}")
+    with open(temp_index_path, "wb") as f:
+        f.write(HEADER.pack(INDEX_SIGNATURE, PACK_VERSION, len(sorted_shas)))
+        f.write(FANOUT.pack(*fanout))
+        f.write(b"".join(bytes.fromhex(sha1) for sha1 in sorted_shas))
+        f.write(b"".join(ENTRY_FIELD.pack(located[sha1][0]) for sha1 in sorted_shas))
+        f.write(b"".join(ENTRY_FIELD.pack(located[sha1][1]) for sha1 in sorted_shas))
+
+    os.replace(temp_pack_path, os.path.join(pack_directory, f"{name}.pack"))
+    os.replace(temp_index_path, os.path.join(pack_directory, f"{name}.idx"))
+    return name
@@ -17,6 +17,10 @@ from models.tree import Tree
 from objects import read_file, write_file
 
 
+# Maximum amount of local commits advertised to the server when pulling
+MAX_HAVES = 256
+
+
 def load_ignore_file(path: str):
     """Loads an ignore file, to a dictionary"""
     if not os.path.isdir(path):
@@ -31,6 +35,21 @@ def load_ignore_file(path: str):
     return d
 
 
+def is_valid_jobs(jobs) -> bool:
+    """Returns True or False whether a '--jobs' value is missing, or a positive number"""
+    return jobs is None or (str(jobs).isdigit() and int(jobs) > 0)
+
+
+def write_working_tree(full_repo: str, tree_hash: str, folder_path: str):
+    """Writes all the files of a tree into a folder, creating its sub folders"""
+    for obj in Tree.traverse_tree(full_repo, tree_hash):
+        pth = os.path.join(folder_path, obj.get_path())
+        if obj.get_type() == "tree":
+            os.makedirs(pth, exist_ok=True)
+        else:
+            objects.write_object_to_file(full_repo, obj.get_hash(), pth)
+
+
 class Stash:
     """The main stash class"""
 
@@ -133,31 +152,42 @@ class Stash:
         Logger.println("stash: Unknown subcommand. see 'stash help remote' for help.")
 
     @cli_parser.register_command(1)
-    def commit(self, message: str):
+    def commit(self, message: str, jobs=None):
         """
         Record changes to the repository
-        stash commit <message>
+        stash commit [--jobs=<n>] <message>
 
         Description:
             Records local changes to the repository.
             This command may be used before pushing the changes to the remote server.
 
         Flags:
-            None
+            --jobs=<n>
+            Read, hash and compress changed files with <n> threads. defaults to the number of processors.
 
         Examples:
             'stash commit "Initial Commit"'
                 Records the changes to the current working repository.
+
+            'stash commit --jobs=16 "Import vendored libraries"'
+                Records the changes, hashing the changed files with 16 threads.
         """
         if not self.initialized:
             Logger.println("stash: repository isn't initialized, use 'stash init'.")
             return ""
 
-        cmt_hash = self.commit_handler.commit(message=message, branch_name=self.branch_name)
+        if not is_valid_jobs(jobs):
+            Logger.println("stash: '--jobs' must be a positive number.")
+            return ""
+
+        cmt_hash = self.commit_handler.commit(message=message, branch_name=self.branch_name,
+                                              jobs=int(jobs) if jobs is not None else None)
         if self.print_mode:
             return cmt_hash
 
         Logger.highlight("stash: changes were committed")
+        Logger.println(f"stash: {objects.write_statistics.written} object(s) written, "
+                       f"{objects.write_statistics.skipped} unchanged object(s) skipped.")
         return cmt_hash
 
     @cli_parser.register_command(2)
@@ -194,18 +224,19 @@ class Stash:
             Logger.error("stash: Remote was not provided, or cannot be found.")
             quit(1)
 
+        # The remote branch is only updated if no other push moved it since it was read
+        remote_head_commit = self.remote_handler.get_remote_head_commit(branch)
         prep_file = self.commit_handler.find_diff(current_commit, "", True, local_branch=self.branch_name, remote_branch=branch)
-        pack_file = self.remote_handler.generate_pack_file(prep_file)
-        self.remote_handler.push_pkt("stash-send-packfile", pack_file)
-        d = self.remote_handler.push_pkt("stash-update-head", self.commit_handler.get_head_commit(self.branch_name))
+        self.remote_handler.push_stream("stash-send-packfile", self.remote_handler.generate_pack_file(prep_file))
+        d = self.remote_handler.push_pkt("stash-update-head", f"{remote_head_commit} {current_commit}")
         print(d)
         self.remote_handler.close()
 
     @cli_parser.register_command(1)
-    def merge(self, wanted_branch: str):
+    def merge(self, wanted_branch: str, jobs=None):
         """
         Join two or more development histories together
-        stash merge <branch_name>
+        stash merge [--jobs=<n>] <branch_name>
 
         Description:
             Joins two development branches together.
@@ -213,19 +244,25 @@ class Stash:
             Conflicts between the two branches might be thrown. if that's the case, conflicts must be solved manually.
 
         Flags:
-            None
+            --jobs=<n>
+            Read, hash and compress the files of a merge commit with <n> threads. defaults to the number of processors.
         """
         if self.branch_name == wanted_branch:
             Logger.println("stash: cannot merge between two exact branches.")
             exit(1)
 
+        if not is_valid_jobs(jobs):
+            Logger.println("stash: '--jobs' must be a positive number.")
+            exit(1)
+
         if self.branch_handler.can_fast_forward(self.branch_name, wanted_branch):
             Logger.custom("Fast Forward:", ColorCode.CITALIC)
             self.branch_handler.local_fast_forward_merge(self.branch_name, wanted_branch)
 
         else:
             Logger.custom("Three Way Merge: ", ColorCode.CITALIC)
-            self.branch_handler.local_three_way_merge(self.branch_name, wanted_branch)
+            self.branch_handler.local_three_way_merge(self.branch_name, wanted_branch,
+                                                      jobs=int(jobs) if jobs is not None else None)
         Logger.highlight(f"stash: Successfully merged branches. {wanted_branch} -> {self.branch_name}")
 
     @cli_parser.register_command(-1)
@@ -326,12 +363,13 @@ class Stash:
 
             buffer = traverse_dirs(path)
             files_added = len(buffer) - 1
+            # Keep the stat data of files that were already hashed by a commit
             for i in buffer:
-                indices[i] = True
+                indices.setdefault(i, True)
 
         else:
-            indices[os.path.dirname(path)] = True
-            indices[path] = True
+            indices.setdefault(os.path.dirname(path), True)
+            indices.setdefault(path, True)
 
         write_file(index_path, pickle.dumps(indices))
 
@@ -360,23 +398,27 @@ class Stash:
         if len(remotes) == 0:
             Logger.println("stash: Couldn't find remote to pull from. are you sure you set up the remotes?")
             quit(1)
-        repo_fingerprint = self.remote_handler.get_remote(remotes[0])
+        repo_fingerprint = self.remote_handler.get_option(remotes[0], "url")
         self.remote_handler.connect(repo_fingerprint)
         local_latest_commit = self.commit_handler.get_head_commit("main")
-        local_commit_tree = self.commit_handler.extract_commit_data(local_latest_commit).get_tree_hash()
+        if local_latest_commit == "":
+            # Nothing to merge with, the whole branch is fetched as a single pack
+            remote_head_commit = self.remote_handler.get_remote_head_commit("main")
+            self.remote_handler.download_remote_pack("main")
+            write_file(os.path.join(self.repo_path, "refs", "head", "main"), remote_head_commit, binary_=False)
+            remote_commit = self.commit_handler.extract_commit_data(remote_head_commit)
+            write_working_tree(self.repo_path, remote_commit.get_tree_hash(), self.folder_path)
+            Logger.highlight("stash: Pulled the remote branch 'main'.")
+            self.remote_handler.close()
 
         remote_head_commit = self.remote_handler.get_remote_head_commit("main")
-        remote_commit_tree = self.remote_handler.resolve_remote_commit_data(remote_head_commit).get_tree_hash()
-
-        diffs = self.commit_handler.compare_remote_with_local(local_commit_tree,
-                                                              remote_commit_tree) + f"{remote_head_commit} commit\n "
-
-        diffs_list = diffs.split("\n")
-        del diffs_list[-1]
+        if remote_head_commit == local_latest_commit:
+            Logger.println("stash: Already up to date.")
+            self.remote_handler.close()
 
-        for line in diffs_list:
-            sha, tp = line.split(" ")
-            self.remote_handler.download_remote_object(sha)
+        # The server walks its history back to the newest commit we have, and sends only what is missing since
+        haves = self.commit_handler.get_recent_commits(local_latest_commit, MAX_HAVES)
+        self.remote_handler.download_remote_pack("main", haves=haves)
 
         remote_branch_name = f"remote_pull_{datetime.datetime.now().strftime('%y%m%d%f')}"
         self.branch_handler.create_branch(remote_branch_name, remote_head_commit)
@@ -441,31 +483,36 @@ class Stash:
         # head file, where current commit hash is stored
         write_file(os.path.join(main_folder, ".stash", "refs/head", "main"), head_commit, binary_=False)
 
-        remote_commit = self.remote_handler.resolve_remote_commit_data(head_commit)
-
-        def apply_local_changes(sha1_tree: str):
-            remote_obj = self.remote_handler.resolve_remote_object(sha1_tree)
-            parsed_tree = Tree.parse_tree(remote_obj)
-            for key, obj in parsed_tree.items():
-                pth = os.path.join(main_folder, obj.get_path())
-                if obj.get_type() == "tree":
-                    os.mkdir(pth)
-                    apply_local_changes(obj.get_hash())
-                if obj.get_type() == "blob":
-                    blob_data = self.remote_handler.resolve_remote_object(obj.get_hash())
-                    # Write blob data
-                    os.mkdir(os.path.join(main_folder, ".stash", "objects", obj.get_hash()[:2]))
-                    write_file(os.path.join(main_folder, ".stash", "objects", obj.get_hash()[:2], obj.get_hash()[2:]),
-                               blob_data.encode())
-
-                    # Create actual file
-                    write_file(pth, blob_data, binary_=False)
-
-        apply_local_changes(remote_commit.get_tree_hash())
+        clone_repo_path = os.path.join(main_folder, ".stash")
+        self.remote_handler.download_remote_pack("main", clone_repo_path)
+        remote_commit = self.commit_handler.extract_commit_data(head_commit, clone_repo_path)
+        write_working_tree(clone_repo_path, remote_commit.get_tree_hash(), main_folder)
         Logger.println(f"stash: Fully cloned {repo_fingerprint} to {full_name}-main.")
 
         self.remote_handler.close()
 
+    @cli_parser.register_command(0)
+    def repack(self):
+        """
+        Pack loose objects into a single indexed pack
+        stash repack
+
+        Description:
+            Consolidates all loose objects of the repository into one pack file, with a sorted index next to it.
+            Packed objects are looked up by a binary search over the memory-mapped index,
+            which keeps the amount of files in the objects database low on large repositories.
+
+        Flags:
+            None
+        """
+        if not self.initialized:
+            Logger.println("stash: repository isn't initialized, use 'stash init'.")
+            return
+
+        packed = objects.pack_loose_objects(self.repo_path)
+        if not self.print_mode:
+            Logger.highlight(f"stash: packed {packed} object(s).")
+
     @cli_parser.register_command(1)
     def checkout(self, branch_name: str, upsert=False):
         """
@@ -498,11 +545,17 @@ class Stash:
         if not branch_exists and upsert:
             self.branch_handler.create_branch(branch_name, self.commit_handler.get_head_commit(self.branch_name))
 
+        # Checking out the current branch restores the whole working tree, otherwise only the differences are applied
+        previous_commit = None
+        current_branch_path = os.path.join(self.repo_path, "refs/head", self.branch_name)
+        if branch_name != self.branch_name and os.path.exists(current_branch_path):
+            previous_commit = self.commit_handler.get_head_commit(self.branch_name)
+
         write_file(os.path.join(self.repo_path, "HEAD"),
                    f"ref: refs/head/{branch_name}", binary_=False)
 
         if branch_exists:
-            self.branch_handler.load_branch(branch_name)
+            self.branch_handler.load_branch(branch_name, previous_commit)
 
         self.current_branch_ref = f"ref: refs/head/{branch_name}"  # Important for tests
         self.branch_name = branch_name